@@ -1,6 +1,5 @@
 import os
 from flask import Flask, render_template, request, jsonify, session, redirect, url_for, make_response, send_file
-import time
 from io import BytesIO
 import uuid
 from openai import BadRequestError
@@ -16,22 +15,33 @@ from config import (
     SESSION_COOKIE_SECURE, SESSION_COOKIE_HTTPONLY, SESSION_COOKIE_SAMESITE,
     SESSION_USE_SIGNER, SESSION_REFRESH_EACH_REQUEST,
     AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION,
-    STICKER_COSTS
+    STICKER_COSTS, DYNAMODB_CALLS_HEADER
 )
 
 
 from services.generate_sticker import generate_sticker, generate_sticker_with_reference
 from utils.s3_utils import (
     get_s3_client, 
-    list_files_by_user_id
+    list_files_by_user_id,
+    list_sticker_page,
+    is_reference_upload_of,
+    delete_file_from_s3
 )
+from utils.s3_filename_index import start_background_refresh
+from utils import upload_spool
+from utils.sticker_ids import sticker_filename, sticker_sort_key
+from utils.request_identity_map import dynamodb_call_count
+from utils.dynamodb_telemetry import DynamoDBThrottledError
 
 # Import DynamoDB utils
 from utils.dynamodb_utils import (
     ensure_tables_exist,
     get_user,
+    get_user_cached,
     create_transaction,
+    InsufficientCoinsError,
     verify_email_index,
+    start_email_index_refresh,
 )
 
 # Import route blueprints
@@ -72,6 +82,21 @@ app.register_blueprint(coupon_bp)
 def make_session_permanent():
     session.permanent = True
 
+if DYNAMODB_CALLS_HEADER:
+    @app.after_request
+    def add_dynamodb_calls_header(response):
+        response.headers['X-DynamoDB-Calls'] = str(dynamodb_call_count())
+        return response
+
+# Throttling de DynamoDB agotado el deadline de reintentos: 503 reintentable en lugar de 500
+@app.errorhandler(DynamoDBThrottledError)
+def handle_dynamodb_throttled(error):
+    app.logger.warning(str(error))
+    response = jsonify({"error": "Service is busy, please try again in a moment"})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
 # TheStickerHouse - Sticker generation web application
 
 # Create static directories if they don't exist
@@ -96,6 +121,12 @@ try:
     # Test bucket existence
     s3_client.head_bucket(Bucket=bucket_name)
     print(f"Successfully connected to AWS S3 bucket: {bucket_name}")
+    
+    # El CORS del bucket (modo 'redirect' y subidas directas) se configura una
+    # sola vez con: PYTHONPATH=app python -m utils.s3_utils setup-bucket
+    
+    # Índice filename -> key para /direct-s3-img, se mantiene en segundo plano
+    start_background_refresh(get_s3_client, bucket_name)
 except Exception as e:
     error_msg = f"ERROR: S3 configuration is invalid or connection failed: {e}"
     print(error_msg)
@@ -106,11 +137,17 @@ except Exception as e:
         # En producción, no permitir que la aplicación inicie sin S3 configurado
         raise RuntimeError(error_msg)
 
+# Subidas write-behind de stickers generados; recupera las pendientes de un reinicio.
+# Se inicia aunque S3 haya fallado: los reintentos suben los pendientes cuando vuelva
+upload_spool.start(get_s3_client)
+
 
 # Setup DB tables if enabled
 try:
     ensure_tables_exist()
-    verify_email_index()
+    # Si el EmailIndex aún se está creando, se sigue comprobando en segundo plano
+    if not verify_email_index():
+        start_email_index_refresh()
     print("DB tables successfully configured")
 except Exception as e:
     error_msg = f"ERROR: DB configuration is invalid or connection failed: {e}"
@@ -127,7 +164,7 @@ def index():
     user_id = session.get('user_id')
     if user_id:
         # Get user from DB - this is an authenticated user
-        user = get_user(user_id)
+        user = get_user_cached(user_id)
         if user:
             # Update session with latest data
             session['coins'] = user.get('coins', 0)
@@ -160,12 +197,15 @@ def generate():
         quality = data.get('quality', 'low')
         mode = data.get('mode', 'simple')
         reference_image_data = data.get('reference_image', None)
+        # Key de una imagen subida directamente a S3 (/reference-upload)
+        reference_key = data.get('reference_key', None)
         style = data.get('style', None)
     else:
         prompt = request.form.get('prompt', '')
         quality = request.form.get('quality', 'low')
         mode = request.form.get('mode', 'simple')
         style = request.form.get('style', None)
+        reference_key = request.form.get('reference_key', None)
         reference_image_data = None
         if 'reference_image' in request.files:
             ref_file = request.files['reference_image']
@@ -174,7 +214,8 @@ def generate():
                 import base64
                 reference_image_data = f"data:image/{ref_file.content_type.split('/')[-1]};base64,{base64.b64encode(ref_file_data).decode('utf-8')}"
     
-    if not prompt and not (reference_image_data and style):
+    has_reference = bool(reference_image_data or reference_key)
+    if not prompt and not (has_reference and style):
         return jsonify({"error": "No prompt provided. You must enter a description, or upload a reference image and select a style."}), 400
     
     user_id = session.get('user_id')
@@ -211,14 +252,21 @@ def generate():
         else:
             identifier = user_id
 
-        timestamp = int(time.time())
-        filename = f"sticker_{identifier}_{timestamp}.png"
+        # Solo se aceptan imágenes subidas por el mismo usuario/sesión
+        if reference_key and not is_reference_upload_of(reference_key, identifier):
+            return jsonify({"error": "Invalid reference image"}), 400
+        if reference_key and mode != 'reference':
+            # Fuera del modo referencia la subida no se usa: se borra para no dejarla huérfana
+            delete_file_from_s3(reference_key)
+
+        # Id ULID: único y ordenado por tiempo (dos stickers en el mismo segundo ya no se pisan)
+        filename = sticker_filename(identifier)
         img_path = os.path.join(folder_path, filename)
 
         image_b64, s3_url, s3_url_high_res = None, None, None
-        if mode == 'reference' and reference_image_data:
+        if mode == 'reference' and has_reference:
             image_b64, s3_url, s3_url_high_res = generate_sticker_with_reference(
-                prompt, img_path, reference_image_data, quality, style=style
+                prompt, img_path, reference_image_data, quality, style=style, reference_key=reference_key
             )
         else:
             image_b64, s3_url, s3_url_high_res = generate_sticker(
@@ -233,17 +281,34 @@ def generate():
                 'style': style or 'default',
                 'filename': filename,
                 'cost': actual_sticker_cost,
-                'included_image': bool(reference_image_data),
-                'image_url': s3_url if reference_image_data else '',
+                'included_image': has_reference,
+                'image_url': s3_url if has_reference else '',
                 'used_style': bool(style),
                 'style_description': style if style else ''
             }
-            create_transaction(
-                user_id=user_id,
-                coins_amount=-actual_sticker_cost,
-                transaction_type='usage',
-                details=details
-            )
+            try:
+                create_transaction(
+                    user_id=user_id,
+                    coins_amount=-actual_sticker_cost,
+                    transaction_type='usage',
+                    details=details,
+                    user=current_user_data
+                )
+            except InsufficientCoinsError as e:
+                # Otra petición gastó el saldo mientras se generaba: el sticker no se entrega
+                app.logger.warning(f"Sticker {filename} generated but not charged: {e}")
+                user_now = get_user(user_id)
+                balance = user_now.get('coins', 0) if user_now else 0
+                session['coins'] = balance
+                return jsonify({"error": f"Insufficient coins. You need {actual_sticker_cost} coins. Your balance: {balance}"}), 402
+            except RuntimeError as e:
+                # Demasiadas escrituras concurrentes sobre el saldo: reintentable
+                app.logger.warning(f"Sticker {filename} generated but not charged: {e}")
+                response = jsonify({"error": "Service is busy, please try again in a moment"})
+                response.status_code = 503
+                response.headers['Retry-After'] = '1'
+                return response
+            # Sale del identity map de la petición (saldo calculado por create_transaction)
             user_after_deduction = get_user(user_id)
             if user_after_deduction:
                 session['coins'] = user_after_deduction.get('coins', 0)
@@ -295,6 +360,9 @@ def generate():
         if "billing_hard_limit_reached" in error_str or error_code == "billing_hard_limit_reached":
             return jsonify({"error": "No se pudo generar el sticker. Ha ocurrido un problema interno. Por favor, ponte en contacto con el administrador para resolverlo."}), 400
         return jsonify({"error": f"Error al generar el sticker: {error_str}"}), 400
+    except DynamoDBThrottledError:
+        # Lo responde handle_dynamodb_throttled (503 reintentable)
+        raise
     except Exception as e:
         app.logger.error(f"Error during sticker generation for user {user_id}: {str(e)}", exc_info=True)
         return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
@@ -318,13 +386,33 @@ def get_history():
     # Permitir solicitud de tamaño específico de página para paginación
     page = request.args.get('page', 1, type=int)
     items_per_page = request.args.get('items_per_page', 0, type=int)  # 0 = todos los items
+    # Solo los stickers más nuevos que este (filename o id), p.ej. para refrescar el historial
+    newer_than = request.args.get('since')
+    # Paginación por cursor (último filename de la página anterior): solo se lista
+    # el rango de keys de la página. Con ?page=N sin cursor se lista todo el prefijo
+    cursor = request.args.get('cursor')
     
     # Get sticker files - check S3 first if enabled, fall back to local files
     sticker_files = []
     
+    if items_per_page > 0 and not newer_than and (cursor or page == 1):
+        try:
+            paginated_files, next_cursor = list_sticker_page(identifier, cursor or None, items_per_page, S3_STICKERS_FOLDER)
+            # Sin stickers en S3 se sigue con el listado completo y los archivos locales
+            if paginated_files or cursor:
+                return jsonify({
+                    "success": True,
+                    "stickers": paginated_files,
+                    "next_cursor": next_cursor,
+                    "items_per_page": items_per_page,
+                    "source": "s3"
+                })
+        except Exception as e:
+            print(f"Error listing S3 sticker page: {e}")
+    
     try:
         # Get files from S3 stickers folder filtered by user_id or session_id
-        s3_files = list_files_by_user_id(identifier, S3_STICKERS_FOLDER)
+        s3_files = list_files_by_user_id(identifier, S3_STICKERS_FOLDER, newer_than=newer_than)
         
         # Extract just the filenames without folder prefix
         for file_key in s3_files:
@@ -333,11 +421,8 @@ def get_history():
                 sticker_files.append(filename)
                 
         if sticker_files:
-            # Ordenar por fecha descendente (asumiendo que el nombre del archivo contiene timestamp)
-            try:
-                sticker_files.sort(key=lambda x: os.path.basename(x), reverse=True)
-            except:
-                pass
+            # Ordenar por fecha de creación descendente (el id del nombre lleva el tiempo)
+            sticker_files.sort(key=sticker_sort_key, reverse=True)
                 
             total_items = len(sticker_files)
             
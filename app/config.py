@@ -85,6 +85,44 @@ DYNAMODB_USER_TABLE = os.getenv('DYNAMODB_USER_TABLE', 'test-thestickerhouse-use
 DYNAMODB_TRANSACTION_TABLE = os.getenv('DYNAMODB_TRANSACTION_TABLE', 'test-thestickerhouse-transactions')
 DYNAMODB_REQUEST_TABLE = os.getenv('DYNAMODB_REQUEST_TABLE', 'test-thestickerhouse-admin-requests')
 DYNAMODB_COUPONES_TABLE = os.getenv('DYNAMODB_COUPONES_TABLE', 'test-thestickerhouse-coupons')
+# Claves de idempotencia de pagos (payment_id -> transaction_id), escritas en la misma transacción que el ledger
+DYNAMODB_PAYMENT_KEYS_TABLE = os.getenv('DYNAMODB_PAYMENT_KEYS_TABLE', 'test-thestickerhouse-payment-keys')
+# Poner a True cuando `backfill-payment-keys` haya registrado los pagos antiguos del ledger;
+# hasta entonces cada pago también se busca en PaymentIdIndex antes de escribirlo
+PAYMENT_KEYS_BACKFILLED = os.getenv('PAYMENT_KEYS_BACKFILLED', 'False').lower() == 'true'
+# PINs de login por email, con TTL nativo de DynamoDB sobre expires_at
+DYNAMODB_LOGIN_PIN_TABLE = os.getenv('DYNAMODB_LOGIN_PIN_TABLE', 'test-thestickerhouse-login-pins')
+
+# DynamoDB client tuning (handles cacheados en utils/dynamodb_utils.py)
+# Endpoint alternativo, p.ej. DynamoDB Local (http://localhost:8000) para desarrollo y benchmarks
+DYNAMODB_ENDPOINT_URL = os.getenv('DYNAMODB_ENDPOINT_URL') or None
+DYNAMODB_MAX_POOL_CONNECTIONS = int(os.getenv('DYNAMODB_MAX_POOL_CONNECTIONS', '50'))
+# Resources (con sus Table) libres que se guardan para los hilos siguientes; con un hilo por petición se reutilizan en vez de reconstruirse
+DYNAMODB_RESOURCE_POOL_SIZE = int(os.getenv('DYNAMODB_RESOURCE_POOL_SIZE', '16'))
+DYNAMODB_CONNECT_TIMEOUT = float(os.getenv('DYNAMODB_CONNECT_TIMEOUT', '2'))
+DYNAMODB_READ_TIMEOUT = float(os.getenv('DYNAMODB_READ_TIMEOUT', '5'))
+DYNAMODB_MAX_ATTEMPTS = int(os.getenv('DYNAMODB_MAX_ATTEMPTS', '5'))
+DYNAMODB_RETRY_MODE = os.getenv('DYNAMODB_RETRY_MODE', 'adaptive')
+# Reintentos ante throttling (backoff exponencial con jitter) hasta el deadline y métricas de capacidad
+DYNAMODB_RETRY_DEADLINE = float(os.getenv('DYNAMODB_RETRY_DEADLINE', '5'))
+DYNAMODB_RETRY_BASE_DELAY = float(os.getenv('DYNAMODB_RETRY_BASE_DELAY', '0.05'))
+DYNAMODB_RETRY_MAX_DELAY = float(os.getenv('DYNAMODB_RETRY_MAX_DELAY', '1'))
+DYNAMODB_METRICS_LOG_INTERVAL = float(os.getenv('DYNAMODB_METRICS_LOG_INTERVAL', '60'))
+# Scans paralelos por segmentos (utils/dynamodb_scan.py)
+DYNAMODB_SCAN_SEGMENTS = int(os.getenv('DYNAMODB_SCAN_SEGMENTS', '4'))
+DYNAMODB_SCAN_MAX_WORKERS = int(os.getenv('DYNAMODB_SCAN_MAX_WORKERS', '8'))
+# Cache del estado del EmailIndex (describe_table solo al arrancar y en segundo plano)
+EMAIL_INDEX_STATUS_TTL = int(os.getenv('EMAIL_INDEX_STATUS_TTL', '3600'))
+EMAIL_INDEX_POLL_INTERVAL = int(os.getenv('EMAIL_INDEX_POLL_INTERVAL', '30'))
+# Reintentos de create_transaction cuando otra escritura cambia el saldo a la vez
+DYNAMODB_TRANSACTION_MAX_ATTEMPTS = int(os.getenv('DYNAMODB_TRANSACTION_MAX_ATTEMPTS', '5'))
+# Cabecera X-DynamoDB-Calls con el número de llamadas a DynamoDB de cada petición (depuración)
+DYNAMODB_CALLS_HEADER = os.getenv('DYNAMODB_CALLS_HEADER', 'False').lower() == 'true'
+# Cache de lectura de usuarios (saldo/perfil) con TTL corto: memory | sqlite | none
+USER_CACHE_BACKEND = os.getenv('USER_CACHE_BACKEND', 'memory').lower()
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '5'))
+USER_CACHE_MAX_ENTRIES = int(os.getenv('USER_CACHE_MAX_ENTRIES', '10000'))
+USER_CACHE_PATH = os.getenv('USER_CACHE_PATH', 'app/cache/users.sqlite3')
 
 # Mercado Pago configuration
 MP_ACCESS_TOKEN = os.getenv("PROD_ACCESS_TOKEN")
@@ -106,6 +144,106 @@ AWS_S3_BUCKET_NAME = os.getenv('AWS_S3_BUCKET_NAME')
 S3_STICKERS_FOLDER = os.getenv('S3_STICKERS_FOLDER', 'stickers')
 S3_TEMPLATES_FOLDER = os.getenv('S3_TEMPLATES_FOLDER', 'templates')
 
+# S3 transfer tuning (multipart uploads/downloads and batch operations)
+S3_MULTIPART_THRESHOLD = int(os.getenv('S3_MULTIPART_THRESHOLD', str(8 * 1024 * 1024)))
+S3_MULTIPART_CHUNKSIZE = int(os.getenv('S3_MULTIPART_CHUNKSIZE', str(8 * 1024 * 1024)))
+S3_TRANSFER_MAX_CONCURRENCY = int(os.getenv('S3_TRANSFER_MAX_CONCURRENCY', '10'))
+S3_BATCH_MAX_WORKERS = int(os.getenv('S3_BATCH_MAX_WORKERS', '16'))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '50'))
+
+# Image serving configuration for /img
+# - 'buffered': descarga el objeto completo a memoria y lo sirve (modo original)
+# - 'stream': proxy en streaming por chunks, respeta Content-Length y Range
+# - 'redirect': 302 a la CDN (si esta configurada) o a una URL prefirmada de S3
+IMAGE_SERVE_MODES = ('buffered', 'stream', 'redirect')
+IMAGE_SERVE_MODE = os.getenv('IMAGE_SERVE_MODE', 'buffered').lower()
+if IMAGE_SERVE_MODE not in IMAGE_SERVE_MODES:
+    print(f"Warning: invalid IMAGE_SERVE_MODE '{IMAGE_SERVE_MODE}', using 'buffered'")
+    IMAGE_SERVE_MODE = 'buffered'
+IMAGE_CDN_BASE_URL = os.getenv('IMAGE_CDN_BASE_URL', '')
+IMAGE_PRESIGNED_EXPIRATION = int(os.getenv('IMAGE_PRESIGNED_EXPIRATION', '3600'))
+IMAGE_REDIRECT_MAX_AGE = int(os.getenv('IMAGE_REDIRECT_MAX_AGE', '1800'))
+IMAGE_STREAM_CHUNK_SIZE = int(os.getenv('IMAGE_STREAM_CHUNK_SIZE', str(64 * 1024)))
+S3_CORS_ALLOWED_ORIGINS = [o.strip() for o in os.getenv('S3_CORS_ALLOWED_ORIGINS', '*').split(',') if o.strip()]
+IMAGE_BATCH_MAX_FILES = int(os.getenv('IMAGE_BATCH_MAX_FILES', '100'))
+IMAGE_BATCH_MAX_DIMENSION = int(os.getenv('IMAGE_BATCH_MAX_DIMENSION', '2048'))
+# Variantes bajo demanda: /img/<filename>?w=<ancho>&fmt=webp|png (solo anchos permitidos)
+IMAGE_VARIANT_WIDTHS = [int(w) for w in os.getenv('IMAGE_VARIANT_WIDTHS', '96,160,250,320,512,1024').split(',') if w.strip()]
+IMAGE_VARIANT_WEBP_QUALITY = int(os.getenv('IMAGE_VARIANT_WEBP_QUALITY', '85'))
+IMAGE_VARIANT_STORE_S3 = os.getenv('IMAGE_VARIANT_STORE_S3', 'True').lower() == 'true'
+S3_VARIANTS_FOLDER = os.getenv('S3_VARIANTS_FOLDER', 'variants')
+
+# Local disk LRU cache for hot S3 images (shared by all workers on the machine)
+IMAGE_CACHE_ENABLED = os.getenv('IMAGE_CACHE_ENABLED', 'True').lower() == 'true'
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', 'app/cache/images')
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+IMAGE_CACHE_MAX_ITEM_BYTES = int(os.getenv('IMAGE_CACHE_MAX_ITEM_BYTES', str(10 * 1024 * 1024)))
+IMAGE_CACHE_SCAN_INTERVAL = int(os.getenv('IMAGE_CACHE_SCAN_INTERVAL', '60'))
+
+# Write-behind spool: generated stickers are stored on local disk and uploaded
+# to S3 in background threads (retries with exponential backoff)
+UPLOAD_SPOOL_ENABLED = os.getenv('UPLOAD_SPOOL_ENABLED', 'True').lower() == 'true'
+UPLOAD_SPOOL_DIR = os.getenv('UPLOAD_SPOOL_DIR', 'app/cache/spool')
+UPLOAD_SPOOL_WORKERS = int(os.getenv('UPLOAD_SPOOL_WORKERS', '2'))
+UPLOAD_SPOOL_RETRY_BASE_DELAY = float(os.getenv('UPLOAD_SPOOL_RETRY_BASE_DELAY', '2'))
+UPLOAD_SPOOL_MAX_RETRY_DELAY = float(os.getenv('UPLOAD_SPOOL_MAX_RETRY_DELAY', '300'))
+UPLOAD_SPOOL_SCAN_INTERVAL = float(os.getenv('UPLOAD_SPOOL_SCAN_INTERVAL', '30'))
+
+# Content-addressed sticker storage (utils/content_store.py)
+# - Los bytes se guardan una sola vez en S3_CONTENT_FOLDER/{sha256}.ext y la
+#   clave del sticker es una referencia de 0 bytes que apunta al contenido
+# - Desactivado por defecto: la limpieza de stickers anónimos solo borra las
+#   referencias y todavía no hay recolección de los objetos de contenido
+STICKER_CONTENT_ADDRESSING = os.getenv('STICKER_CONTENT_ADDRESSING', 'False').lower() == 'true'
+S3_CONTENT_FOLDER = os.getenv('S3_CONTENT_FOLDER', 'content')
+CONTENT_KNOWN_KEYS_MAX = int(os.getenv('CONTENT_KNOWN_KEYS_MAX', '100000'))
+
+# Direct browser uploads of reference images (presigned POST to a staging prefix)
+# - El navegador sube la imagen a S3 y /generate solo recibe la key
+REFERENCE_DIRECT_UPLOAD_ENABLED = os.getenv('REFERENCE_DIRECT_UPLOAD_ENABLED', 'True').lower() == 'true'
+S3_REFERENCE_UPLOADS_FOLDER = os.getenv('S3_REFERENCE_UPLOADS_FOLDER', 'uploads/references')
+REFERENCE_UPLOAD_MAX_BYTES = int(os.getenv('REFERENCE_UPLOAD_MAX_BYTES', str(15 * 1024 * 1024)))
+REFERENCE_UPLOAD_EXPIRATION = int(os.getenv('REFERENCE_UPLOAD_EXPIRATION', '300'))
+REFERENCE_UPLOAD_CONTENT_TYPES = [t.strip() for t in os.getenv('REFERENCE_UPLOAD_CONTENT_TYPES', 'image/png,image/jpeg,image/webp').split(',') if t.strip()]
+
+# Preprocesado de imágenes de referencia antes de enviarlas a OpenAI
+# - Se reducen al tamaño de trabajo del modelo y se rechazan las que superan
+#   REFERENCE_IMAGE_MAX_PIXELS (bombas de descompresión)
+REFERENCE_IMAGE_MAX_DIMENSION = int(os.getenv('REFERENCE_IMAGE_MAX_DIMENSION', '1024'))
+REFERENCE_IMAGE_MAX_PIXELS = int(os.getenv('REFERENCE_IMAGE_MAX_PIXELS', str(40 * 1000 * 1000)))
+
+# S3 key resolution cache for /img (filename -> key)
+S3_KEY_CACHE_TTL = int(os.getenv('S3_KEY_CACHE_TTL', str(24 * 3600)))
+S3_KEY_NEGATIVE_TTL = int(os.getenv('S3_KEY_NEGATIVE_TTL', '60'))
+# Máximo de filenames cacheados por proceso (LRU): URLs arbitrarias no hacen crecer la memoria
+S3_KEY_CACHE_MAX = int(os.getenv('S3_KEY_CACHE_MAX', '100000'))
+S3_KEY_MANIFEST_PATH = os.getenv('S3_KEY_MANIFEST_PATH', 'app/cache/s3_key_manifest.json')
+
+# Filename -> key index for /direct-s3-img, shared by the workers of a machine
+# - Las subidas lo mantienen al día; el listado completo solo reconcilia cada
+#   S3_INDEX_REFRESH_INTERVAL segundos (un único worker por máquina)
+S3_INDEX_ENABLED = os.getenv('S3_INDEX_ENABLED', 'True').lower() == 'true'
+S3_INDEX_REFRESH_INTERVAL = int(os.getenv('S3_INDEX_REFRESH_INTERVAL', str(24 * 3600)))
+S3_INDEX_PATH = os.getenv('S3_INDEX_PATH', 'app/cache/s3_filename_index.sqlite3')
+
+# Cleanup of abandoned anonymous stickers (utils/sticker_cleanup.py)
+# - Un sticker anónimo se borra si el último sticker de su sesión tiene más de
+#   STICKER_CLEANUP_MIN_AGE_DAYS días (mayor que SESSION_PERMANENT_LIFETIME)
+# - Las sesiones que compraron quedan marcadas en S3_PURCHASES_FOLDER
+S3_PURCHASES_FOLDER = os.getenv('S3_PURCHASES_FOLDER', 'purchases')
+STICKER_CLEANUP_MIN_AGE_DAYS = int(os.getenv('STICKER_CLEANUP_MIN_AGE_DAYS', '45'))
+STICKER_CLEANUP_BATCHES_PER_SECOND = float(os.getenv('STICKER_CLEANUP_BATCHES_PER_SECOND', '2'))
+STICKER_CLEANUP_CHECKPOINT_PATH = os.getenv('STICKER_CLEANUP_CHECKPOINT_PATH', 'app/cache/sticker_cleanup_checkpoint.json')
+
+# History page sprite sheets (one WebP + offset map per page, cached in S3)
+S3_SPRITES_FOLDER = os.getenv('S3_SPRITES_FOLDER', 'sprites')
+# Días hasta que la regla de lifecycle (setup-bucket) borra los sprites; se regeneran en la siguiente visita
+HISTORY_SPRITE_EXPIRATION_DAYS = int(os.getenv('HISTORY_SPRITE_EXPIRATION_DAYS', '7'))
+HISTORY_SPRITE_TILE_SIZE = int(os.getenv('HISTORY_SPRITE_TILE_SIZE', '160'))
+HISTORY_SPRITE_COLUMNS = int(os.getenv('HISTORY_SPRITE_COLUMNS', '5'))
+HISTORY_SPRITE_QUALITY = int(os.getenv('HISTORY_SPRITE_QUALITY', '80'))
+HISTORY_SPRITE_MAX_PAGE_SIZE = int(os.getenv('HISTORY_SPRITE_MAX_PAGE_SIZE', '50'))
+
 # Custom JSON encoder for handling Decimal and other DynamoDB-specific types
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -1,8 +1,9 @@
-from flask import Blueprint, request, session, redirect, url_for, render_template, abort, flash
+from flask import Blueprint, request, session, redirect, url_for, render_template, abort, flash, jsonify
 from utils.dynamodb_utils import get_user, create_admin_request, get_admin_request, approve_admin_request, update_user_role
 from functools import wraps
 from config import ADMIN_REQUEST_PASSWORD
 from utils.utils import send_admin_request_email, format_timestamp
+from utils.dynamodb_telemetry import get_dynamodb_stats
 from utils.admin_kpi_utils import (
     get_total_users, get_new_users, get_active_users, get_total_transactions,
     get_total_revenue, get_average_order_value, get_recent_admin_requests, get_paid_users
@@ -54,6 +55,15 @@ def admin_root():
         recent_admin_requests=recent_admin_requests
     )
 
+@admin_bp.route('/dynamodb-metrics')
+@admin_required
+def dynamodb_metrics():
+    """
+    Capacidad consumida, throttling y latencia de DynamoDB por punto de llamada
+    y por tabla (worker actual), para elegir entre capacidad aprovisionada y on-demand
+    """
+    return jsonify(get_dynamodb_stats())
+
 @admin_bp.route('/request', methods=['GET', 'POST'])
 def request_admin():
     user_id = session.get('user_id')
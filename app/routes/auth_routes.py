@@ -5,12 +5,14 @@ from datetime import datetime
 from utils.dynamodb_utils import (
     create_user, 
     get_user, 
+    get_user_cached,
     get_user_by_email, 
     generate_pin,
     store_login_pin,
     verify_login_pin,
     create_transaction,
-    get_user_transactions,
+    get_user_transactions_page,
+    TRANSACTION_LIST_FIELDS,
     update_user_name
 )
 from utils.utils import send_login_email
@@ -122,7 +124,8 @@ def verify_pin():
                 user_id=user['user_id'],
                 coins_amount=coins_to_add,
                 transaction_type='bonus',
-                details={'reason': 'New user registration bonus + session coins transfer'}
+                details={'reason': 'New user registration bonus + session coins transfer'},
+                user=user
             )
             # Get the updated user from the transaction result
             updated_user = transaction.get('updated_user', {})
@@ -201,7 +204,7 @@ def get_current_user():
             return jsonify({"error": "Not authenticated"}), 401
     
     # Get full user data from DynamoDB
-    user = get_user(user_id)
+    user = get_user_cached(user_id)
     
     if not user:
         # Clear invalid session
@@ -318,11 +321,16 @@ def get_my_transactions():
     user_id = session.get('user_id')
     if not user_id:
         return jsonify({"error": "Not authenticated"}), 401
+    limit = request.args.get('limit', 50, type=int)
+    cursor = request.args.get('cursor')
     try:
-        transactions = get_user_transactions(user_id)
+        # Página ordenada por el índice user_id + timestamp (más recientes primero)
+        transactions, next_cursor = get_user_transactions_page(
+            user_id, limit=limit, cursor=cursor, fields=TRANSACTION_LIST_FIELDS
+        )
         transactions = sanitize_dynamodb_response(transactions)
-        # Ordenar por timestamp descendente si existe, sino por date
-        transactions.sort(key=lambda tx: tx.get('timestamp', 0), reverse=True)
-        return jsonify({"success": True, "transactions": transactions})
+        return jsonify({"success": True, "transactions": transactions, "next_cursor": next_cursor})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": f"Failed to fetch transactions: {str(e)}"}), 500 
\ No newline at end of file
@@ -6,9 +6,10 @@ from decimal import Decimal
 from datetime import datetime
 from utils.dynamodb_utils import (
     get_user,
+    get_user_cached,
     create_transaction,
     get_user_by_email,
-    get_user_transactions
+    get_user_transactions_page
 )
 from config import INITIAL_COINS, BONUS_COINS, COIN_PACKAGES_CONFIG, STICKER_COSTS, sdk
 
@@ -35,7 +36,7 @@ def get_coins():
     
     if user_id:
         # Get latest user data from DB
-        user = get_user(user_id)
+        user = get_user_cached(user_id)
         if user:
             # Update session with latest coins
             session['coins'] = user.get('coins', 0)
@@ -209,7 +210,7 @@ def get_coin_balance():
     
     # For authenticated users, get from DynamoDB
     # Get latest user data
-    user = get_user(user_id)
+    user = get_user_cached(user_id)
     
     if not user:
         return jsonify({"error": "User not found"}), 404
@@ -334,16 +335,20 @@ def get_transactions():
         return jsonify({"error": "Not authenticated"}), 401
     
     limit = request.args.get('limit', 50, type=int)
+    cursor = request.args.get('cursor')
     
     try:
-        transactions = get_user_transactions(user_id, limit=limit)
+        transactions, next_cursor = get_user_transactions_page(user_id, limit=limit, cursor=cursor)
         
         # Sanitize data for JSON serialization
         transactions = sanitize_dynamodb_response(transactions)
         
         return jsonify({
-            "transactions": transactions
+            "transactions": transactions,
+            "next_cursor": next_cursor
         })
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": f"Failed to retrieve transactions: {str(e)}"}), 500
 
@@ -1,23 +1,99 @@
 from flask import Blueprint, request, jsonify, session, url_for, redirect, current_app
 import json
 import os
+import shutil
 import tempfile
 import time
 from datetime import datetime
 from datetime import datetime, timedelta
+from botocore.exceptions import ClientError
 from utils.dynamodb_utils import (
     get_user,
+    get_user_cached,
     create_transaction,
     get_transaction_by_payment_id
 )
 
 from utils.utils import send_sticker_email, create_template_zip
-from utils.s3_utils import get_s3_client, upload_file_to_s3
-from config import sdk, AWS_S3_BUCKET_NAME, S3_STICKERS_FOLDER, S3_TEMPLATES_FOLDER
+from utils.s3_utils import upload_file_to_s3, download_files_from_s3, get_s3_client
+from utils.s3_key_resolver import resolve_key, canonical_key, forget as forget_key
+from utils.sticker_cleanup import record_purchase
+from utils import upload_spool
+from config import sdk, AWS_S3_BUCKET_NAME, S3_TEMPLATES_FOLDER
 
 
 payment_bp = Blueprint('payment', __name__)
 
+# Rondas de descarga de los stickers de un ZIP de plantilla antes de fallar
+TEMPLATE_DOWNLOAD_ATTEMPTS = 3
+
+
+def _copy_spooled_sticker(filename, path):
+    """
+    Copy a sticker that is still waiting in the upload spool, as /img/ serves it
+
+    Returns:
+        bool: True if it was spooled and copied
+    """
+    spooled_file, _ = upload_spool.get(canonical_key(filename))
+    if not spooled_file:
+        return False
+    try:
+        with spooled_file, open(path, 'wb') as local_file:
+            shutil.copyfileobj(spooled_file, local_file)
+        return True
+    except OSError as e:
+        current_app.logger.warning(f"Error copiando {filename} desde el spool: {e}")
+        return False
+
+
+def _download_template_stickers(filenames, temp_dir, payment_id=None):
+    """
+    Copy the purchased stickers to temp_dir for the template ZIP. Stickers still
+    in the write-behind spool are copied from it (they may not be in S3 yet);
+    the rest are downloaded from S3, retrying the ones that fail.
+
+    Returns:
+        list: Local paths, one per filename
+
+    Raises:
+        RuntimeError: If a sticker still couldn't be downloaded
+    """
+    s3_client = get_s3_client()
+    paths = {filename: os.path.join(temp_dir, filename) for filename in filenames}
+    pending = list(filenames)
+    for attempt in range(TEMPLATE_DOWNLOAD_ATTEMPTS):
+        if attempt:
+            time.sleep(attempt)
+        downloads = []
+        for filename in pending:
+            if _copy_spooled_sticker(filename, paths[filename]):
+                continue
+            if attempt:
+                # No fiarse de una resolución (o un 404) cacheada en el intento anterior
+                forget_key(filename)
+            # La key del sticker puede ser una referencia: se descarga el contenido
+            try:
+                key = resolve_key(s3_client, AWS_S3_BUCKET_NAME, filename)[0] or canonical_key(filename)
+            except ClientError as e:
+                current_app.logger.warning(f"Error resolviendo {filename}: {e}")
+                key = canonical_key(filename)
+            downloads.append((key, filename))
+        results = download_files_from_s3(
+            [(key, paths[filename]) for key, filename in downloads],
+            bucket_name=AWS_S3_BUCKET_NAME
+        )
+        pending = [filename for key, filename in downloads if not results.get(key)]
+        if not pending:
+            return [paths[filename] for filename in filenames]
+        current_app.logger.warning(
+            f"Intento {attempt + 1}: no se pudieron descargar {len(pending)} stickers del pago {payment_id}: {pending}"
+        )
+
+    current_app.logger.error(f"ZIP de plantilla del pago {payment_id} sin generar, faltan stickers: {pending}")
+    raise RuntimeError(f"Missing stickers for template ZIP of payment {payment_id}: {', '.join(pending)}")
+
+
 @payment_bp.route('/coin_payment_feedback')
 def coin_payment_feedback():
     """
@@ -42,7 +118,7 @@ def coin_payment_feedback():
     # Solo mostramos feedback visual dependiendo del estado del pago
     if payment_status == 'approved':
         # Actualizar la sesión con las monedas actuales del usuario
-        user = get_user(user_id)
+        user = get_user_cached(user_id)
         if user:
             session['coins'] = user.get('coins', 0)
             current_app.logger.info(f"Sesión actualizada para usuario {user_id}, monedas: {session['coins']}")
@@ -137,12 +213,6 @@ def process_payment_webhook(payment_data):
             current_app.logger.warning(f"Pago {payment_id} sin external_reference, no se puede procesar")
             return
         
-        # Primero verificamos si esta transacción ya fue procesada (verificación explícita)
-        existing_transaction = get_transaction_by_payment_id(payment_id)
-        if existing_transaction:
-            current_app.logger.info(f"Pago {payment_id} ya fue procesado anteriormente en transacción {existing_transaction.get('transaction_id')}. No se realiza acción adicional.")
-            return
-        
         # Solo procesamos pagos aprobados
         if status == 'approved':
             # Parsear external_reference: COINPKG_{user_id}_{package_id}_{coins}_{timestamp}
@@ -159,7 +229,8 @@ def process_payment_webhook(payment_data):
                     current_app.logger.error(f"Usuario {user_id} no encontrado, no se pueden asignar monedas")
                     return
                 
-                # Crear la transacción (con idempotencia basada en payment_id)
+                # Crear la transacción: la clave del payment_id se escribe en la misma
+                # transacción, así que un webhook duplicado no vuelve a sumar monedas
                 transaction = create_transaction(
                     user_id=user_id,
                     coins_amount=coins_to_add,
@@ -171,7 +242,8 @@ def process_payment_webhook(payment_data):
                         'package_id': package_id,
                         'source': 'webhook'
                     },
-                    payment_id=payment_id  # Usar payment_id para idempotencia
+                    payment_id=payment_id,  # Usar payment_id para idempotencia
+                    user=user
                 )
                 
                 # Verificar si la transacción fue realmente creada o si ya existía
@@ -459,6 +531,15 @@ def payment_feedback():
         # Obtener la lista de archivos de stickers
         template_stickers = session.get('template_stickers', [])
         
+        # Marcar las sesiones dueñas de estos stickers para que la limpieza
+        # de stickers anónimos no los borre
+        try:
+            record_purchase([
+                sticker.get('filename', '') for sticker in template_stickers if isinstance(sticker, dict)
+            ], bucket=AWS_S3_BUCKET_NAME)
+        except Exception as e:
+            current_app.logger.error(f"Error registrando la compra {payment_id}: {e}")
+        
         # Get S3 URLs from session
         s3_urls = session.get('s3_urls', {})
         sticker_s3_urls = {}
@@ -481,18 +562,9 @@ def payment_feedback():
             temp_files = []
             
             try:
-                # Descargar archivos temporalmente para crear el ZIP
-                s3_client = get_s3_client()
-                bucket = AWS_S3_BUCKET_NAME
-                
-                for filename, url in sticker_s3_urls.items():
-                    # Obtener key de S3 desde URL
-                    key = f"{S3_STICKERS_FOLDER}/{filename}"
-                    temp_file_path = os.path.join(temp_dir, filename)
-                    
-                    # Descargar archivo
-                    s3_client.download_file(bucket, key, temp_file_path)
-                    temp_files.append(temp_file_path)
+                # Descargar archivos temporalmente (en paralelo) para crear el ZIP.
+                # Si falta algún sticker se falla el pedido: nunca se envía un ZIP incompleto
+                temp_files = _download_template_stickers(list(sticker_s3_urls), temp_dir, payment_id)
                 
                 # Crear template zip
                 if temp_files:
@@ -510,13 +582,8 @@ def payment_feedback():
                             template_s3_url = url
                 
             finally:
-                # Limpiar archivos temporales
-                for file in temp_files:
-                    if os.path.exists(file):
-                        os.remove(file)
-                if template_zip_path and os.path.exists(template_zip_path):
-                    os.remove(template_zip_path)
-                os.rmdir(temp_dir)
+                # Limpiar archivos temporales (también descargas parciales)
+                shutil.rmtree(temp_dir, ignore_errors=True)
         
         # Enviar correo electrónico al diseñador y al cliente con enlaces a los archivos
         if sticker_s3_urls:
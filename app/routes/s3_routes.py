@@ -1,59 +1,458 @@
-from flask import Blueprint, jsonify, session, redirect, make_response, send_file
+import os
+import re
+import json
+import uuid
+import struct
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Blueprint, jsonify, session, redirect, make_response, send_file, request, Response, stream_with_context, url_for
 from io import BytesIO
+from botocore.exceptions import ClientError
+from PIL import Image
 
-from utils.s3_utils import get_s3_client
-from config import AWS_S3_BUCKET_NAME, S3_STICKERS_FOLDER, S3_TEMPLATES_FOLDER, USE_S3, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION
+from utils.s3_utils import get_s3_client, create_reference_upload, list_sticker_page
+from routes.admin_routes import admin_required
+from utils import image_cache, upload_spool
+from utils.s3_filename_index import lookup as lookup_filename, get_index_stats, add_key as index_key, discard as unindex_filename
+from utils.s3_key_resolver import (
+    resolve_key, canonical_key, remember_key, remember_missing, is_missing_error
+)
+from utils.sticker_ids import STICKER_ID_PATTERN
+from utils.image_variants import parse_variant_request, needs_high_source, get_variant, variant_key
+from utils.history_sprites import get_or_build_sprite, sprite_key
+from config import (
+    AWS_S3_BUCKET_NAME, S3_STICKERS_FOLDER, S3_TEMPLATES_FOLDER, USE_S3,
+    AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION,
+    IMAGE_SERVE_MODE, IMAGE_CDN_BASE_URL, IMAGE_PRESIGNED_EXPIRATION,
+    IMAGE_REDIRECT_MAX_AGE, IMAGE_STREAM_CHUNK_SIZE, HISTORY_SPRITE_MAX_PAGE_SIZE,
+    IMAGE_BATCH_MAX_FILES, IMAGE_BATCH_MAX_DIMENSION, S3_BATCH_MAX_WORKERS,
+    STICKER_CONTENT_ADDRESSING, REFERENCE_DIRECT_UPLOAD_ENABLED, REFERENCE_UPLOAD_MAX_BYTES
+)
 
 
 s3_bp = Blueprint('s3', __name__)
 
+# Los stickers se nombran sticker_{owner}_{id}[_high].png (id ULID o timestamp) y
+# su contenido nunca cambia, así que se pueden cachear como inmutables en el navegador
+IMMUTABLE_IMAGE_PATTERN = re.compile(r'^sticker_[A-Za-z0-9-]+_' + STICKER_ID_PATTERN + r'(_high)?\.(png|webp|jpe?g)$')
+# Los sprites del historial se nombran con el hash de su contenido
+SPRITE_IMAGE_PATTERN = re.compile(r'^sprite_[0-9a-f]{64}\.webp$')
+IMMUTABLE_MAX_AGE = 31536000  # 1 año
+
+def _guess_content_type(filename):
+    """
+    Determina el tipo de contenido a partir de la extensión del archivo
+    """
+    lower = filename.lower()
+    if lower.endswith('.jpg') or lower.endswith('.jpeg'):
+        return 'image/jpeg'
+    if lower.endswith('.gif'):
+        return 'image/gif'
+    if lower.endswith('.webp'):
+        return 'image/webp'
+    return 'image/png'
+
+def _is_immutable_image(filename):
+    return bool(filename and (IMMUTABLE_IMAGE_PATTERN.match(filename) or SPRITE_IMAGE_PATTERN.match(filename)))
+
+def _add_image_headers(response, max_age=86400, filename=None):
+    """
+    Añade cabeceras CORS y de cache a una respuesta de imagen
+    """
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Methods'] = 'GET'
+    if _is_immutable_image(filename):
+        response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = f'public, max-age={max_age}'
+    return response
+
+def _to_datetime(value):
+    """
+    Normaliza un Last-Modified (datetime de S3 o timestamp de la cache) a datetime UTC
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    return value.astimezone(timezone.utc).replace(microsecond=0)
+
+def _s3_conditional_params():
+    """
+    Reenvía los validadores del cliente a S3 para que responda 304 sin enviar el cuerpo
+    """
+    params = {}
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        params['IfNoneMatch'] = if_none_match
+    elif request.if_modified_since:
+        # If-Modified-Since solo se evalúa si no hay If-None-Match (RFC 7232)
+        params['IfModifiedSince'] = request.if_modified_since
+    return params
+
+def _is_s3_not_modified(error):
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    code = error.response.get('Error', {}).get('Code')
+    return status == 304 or code in ('304', 'NotModified')
+
+def _not_modified_response(error, filename):
+    """
+    Respuesta 304 a partir del error NotModified de S3
+    """
+    headers = error.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    response = make_response('', 304)
+    etag = headers.get('etag') or request.headers.get('If-None-Match')
+    if etag:
+        response.headers['ETag'] = etag
+    if headers.get('last-modified'):
+        response.headers['Last-Modified'] = headers['last-modified']
+    return _add_image_headers(response, filename=filename)
+
+def _public_image_url(s3_client, bucket, key):
+    """
+    URL pública para redirigir: CDN si está configurada, si no una URL prefirmada
+    """
+    if IMAGE_CDN_BASE_URL:
+        return f"{IMAGE_CDN_BASE_URL.rstrip('/')}/{key}"
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': key},
+        ExpiresIn=IMAGE_PRESIGNED_EXPIRATION
+    )
+
+def _send_image_file(file_obj, filename, etag, last_modified):
+    """
+    send_file condicional: responde 304 a If-None-Match/If-Modified-Since y soporta Range
+    """
+    return make_response(send_file(
+        file_obj,
+        mimetype=_guess_content_type(filename),
+        as_attachment=False,
+        download_name=filename,
+        conditional=True,
+        etag=etag.strip('"') if etag else False,
+        last_modified=_to_datetime(last_modified)
+    ))
+
+def _cached_file_response(cached_file, metadata, filename):
+    """
+    Sirve una imagen desde la cache local en disco
+    """
+    response = _send_image_file(cached_file, filename, metadata.get('etag'), metadata.get('last_modified'))
+    response.headers['X-Image-Cache'] = 'HIT'
+    return _add_image_headers(response, filename=filename)
+
+def _buffered_s3_response(s3_client, bucket, key, filename):
+    """
+    Modo 'buffered': descarga el objeto completo a memoria y lo sirve
+    """
+    try:
+        s3_object = s3_client.get_object(Bucket=bucket, Key=key, **_s3_conditional_params())
+    except ClientError as e:
+        if _is_s3_not_modified(e):
+            return _not_modified_response(e, filename)
+        raise
+    
+    data = s3_object['Body'].read()
+    etag = s3_object.get('ETag')
+    last_modified = _to_datetime(s3_object.get('LastModified'))
+    image_cache.put(key, data, etag, int(last_modified.timestamp()) if last_modified else None)
+    
+    response = _send_image_file(BytesIO(data), filename, etag, last_modified)
+    response.headers['X-Image-Cache'] = 'MISS'
+    return _add_image_headers(response, filename=filename)
+
+def _streaming_s3_response(s3_client, bucket, key, filename):
+    """
+    Modo 'stream': proxy por chunks sin cargar el objeto completo en memoria.
+    Reenvía la cabecera Range del cliente y devuelve Content-Length/Content-Range de S3.
+    """
+    params = {'Bucket': bucket, 'Key': key}
+    params.update(_s3_conditional_params())
+    range_header = request.headers.get('Range')
+    if range_header:
+        params['Range'] = range_header
+    
+    try:
+        s3_object = s3_client.get_object(**params)
+    except ClientError as e:
+        if _is_s3_not_modified(e):
+            return _not_modified_response(e, filename)
+        if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+            return _add_image_headers(make_response('Requested range not satisfiable', 416))
+        raise
+    
+    body = s3_object['Body']
+    etag = s3_object.get('ETag')
+    last_modified = _to_datetime(s3_object.get('LastModified'))
+    
+    # Solo se guardan en cache las respuestas completas (sin Range)
+    cache_writer = None
+    if not range_header:
+        cache_writer = image_cache.open_writer(
+            key, s3_object['ContentLength'], etag,
+            int(last_modified.timestamp()) if last_modified else None
+        )
+    
+    def generate():
+        completed = False
+        try:
+            for chunk in body.iter_chunks(chunk_size=IMAGE_STREAM_CHUNK_SIZE):
+                if cache_writer:
+                    cache_writer.write(chunk)
+                yield chunk
+            completed = True
+        finally:
+            body.close()
+            if cache_writer:
+                if completed:
+                    cache_writer.commit()
+                else:
+                    cache_writer.abort()
+    
+    content_range = s3_object.get('ContentRange')
+    response = Response(
+        stream_with_context(generate()),
+        status=206 if content_range else 200,
+        mimetype=s3_object.get('ContentType') or _guess_content_type(filename),
+        direct_passthrough=True
+    )
+    response.headers['Content-Length'] = str(s3_object['ContentLength'])
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['X-Image-Cache'] = 'MISS'
+    if content_range:
+        response.headers['Content-Range'] = content_range
+    if etag:
+        response.headers['ETag'] = etag
+    if last_modified:
+        response.last_modified = last_modified
+    return _add_image_headers(response, filename=filename)
+
+def _serve_s3_image(s3_client, bucket, key, filename, allow_redirect=True):
+    """
+    Sirve un objeto de S3 según IMAGE_SERVE_MODE ('buffered', 'stream' o 'redirect')
+    """
+    # Recién generada y aún no subida a S3: se sirve desde el spool local
+    spooled_file, metadata = upload_spool.get(key)
+    if spooled_file:
+        response = _send_image_file(spooled_file, filename, metadata.get('etag'), metadata.get('last_modified'))
+        response.headers['X-Image-Cache'] = 'SPOOL'
+        return _add_image_headers(response, filename=filename)
+    
+    if IMAGE_SERVE_MODE == 'redirect' and allow_redirect:
+        url = _public_image_url(s3_client, bucket, key)
+        return _add_image_headers(redirect(url, code=302), max_age=IMAGE_REDIRECT_MAX_AGE)
+    
+    cached_file, metadata = image_cache.get(key)
+    if cached_file:
+        return _cached_file_response(cached_file, metadata, filename)
+    
+    if IMAGE_SERVE_MODE in ('stream', 'redirect'):
+        return _streaming_s3_response(s3_client, bucket, key, filename)
+    return _buffered_s3_response(s3_client, bucket, key, filename)
+
+def _stored_key(s3_client, bucket, filename):
+    """
+    Key que contiene los bytes de la imagen: la canónica mientras siga en el
+    spool de subida, si no la resuelta (las referencias ya desreferenciadas)
+    """
+    candidate = canonical_key(filename)
+    if upload_spool.contains(candidate):
+        return candidate
+    key, _ = resolve_key(s3_client, bucket, filename)
+    return key
+
+def _high_res_filename(filename):
+    name, ext = filename.rsplit('.', 1)
+    return filename if name.endswith('_high') else f"{name}_high.{ext}"
+
+def _read_image_bytes(s3_client, bucket, filename):
+    """
+    Lee una imagen completa (cache local o S3). Devuelve None si no existe.
+    """
+    candidate = canonical_key(filename)
+    spooled_file, _ = upload_spool.get(candidate)
+    if spooled_file:
+        with spooled_file:
+            return spooled_file.read()
+    
+    key, verified = resolve_key(s3_client, bucket, filename, verify=False)
+    if not key:
+        return None
+    
+    cached_file, _ = image_cache.get(key)
+    if cached_file:
+        with cached_file:
+            return cached_file.read()
+    
+    try:
+        s3_object = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if is_missing_error(e):
+            remember_missing(filename)
+            return None
+        raise
+    if not verified:
+        remember_key(filename, key)
+    
+    data = s3_object['Body'].read()
+    last_modified = _to_datetime(s3_object.get('LastModified'))
+    image_cache.put(key, data, s3_object.get('ETag'), int(last_modified.timestamp()) if last_modified else None)
+    return data
+
+def _fetch_batch_item(s3_client, bucket, filename, size, max_dimension):
+    """
+    Obtiene una imagen del lote: con size='high' prueba primero la versión _high
+    y cae a la estándar en el servidor. Si se pide max_dimension se reduce a PNG.
+    
+    Returns:
+        tuple: (dict cabecera, bytes contenido)
+    """
+    candidates = [filename]
+    if size == 'high' and _high_res_filename(filename) != filename:
+        candidates.insert(0, _high_res_filename(filename))
+    
+    for candidate in candidates:
+        data = _read_image_bytes(s3_client, bucket, candidate)
+        if data is None:
+            continue
+        content_type = _guess_content_type(candidate)
+        if max_dimension:
+            image = Image.open(BytesIO(data))
+            if max(image.size) > max_dimension:
+                image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+                output = BytesIO()
+                image.save(output, format='PNG', optimize=False)
+                data, content_type = output.getvalue(), 'image/png'
+        return {'filename': filename, 'resolved': candidate, 'status': 200,
+                'content_type': content_type, 'size': len(data)}, data
+    
+    return {'filename': filename, 'resolved': None, 'status': 404, 'content_type': None, 'size': 0}, b''
+
+def _pack_batch_item(header, data):
+    """
+    Formato de cada imagen: [uint32 BE longitud][cabecera JSON][uint32 BE longitud][bytes]
+    """
+    header_bytes = json.dumps(header).encode('utf-8')
+    return struct.pack('>I', len(header_bytes)) + header_bytes + struct.pack('>I', len(data)) + data
+
+@s3_bp.route('/img/batch', methods=['POST'])
+def get_images_batch():
+    """
+    Descarga varias imágenes de S3 en paralelo y las devuelve en una sola respuesta
+    binaria con prefijo de longitud, en el orden en que se completan.
+    
+    Body JSON: {"filenames": [...], "size": "high"|"standard", "max_dimension": 300}
+    """
+    data = request.get_json(silent=True) or {}
+    filenames = data.get('filenames') or []
+    size = data.get('size', 'standard')
+    max_dimension = data.get('max_dimension')
+    
+    if not isinstance(filenames, list) or not filenames:
+        return jsonify({"error": "filenames must be a non-empty list"}), 400
+    # Las cantidades de la plantilla repiten nombres: cada imagen se descarga una vez
+    filenames = list(dict.fromkeys(filenames))
+    if len(filenames) > IMAGE_BATCH_MAX_FILES:
+        return jsonify({"error": f"At most {IMAGE_BATCH_MAX_FILES} filenames per batch"}), 400
+    if any(not isinstance(f, str) or '/' in f or '.' not in f for f in filenames):
+        return jsonify({"error": "Invalid filename in batch"}), 400
+    if size not in ('high', 'standard'):
+        return jsonify({"error": "size must be 'high' or 'standard'"}), 400
+    if max_dimension is not None:
+        if not isinstance(max_dimension, int) or max_dimension <= 0:
+            return jsonify({"error": "max_dimension must be a positive integer"}), 400
+        max_dimension = min(max_dimension, IMAGE_BATCH_MAX_DIMENSION)
+    
+    s3_client = get_s3_client()
+    bucket = AWS_S3_BUCKET_NAME
+    
+    def generate():
+        with ThreadPoolExecutor(max_workers=min(S3_BATCH_MAX_WORKERS, len(filenames))) as executor:
+            futures = {
+                executor.submit(_fetch_batch_item, s3_client, bucket, filename, size, max_dimension): filename
+                for filename in filenames
+            }
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    header, body = future.result()
+                except Exception as e:
+                    print(f"[IMG-BATCH] Error fetching {filename}: {e}")
+                    header, body = {'filename': filename, 'resolved': None, 'status': 500,
+                                    'content_type': None, 'size': 0}, b''
+                yield _pack_batch_item(header, body)
+    
+    response = Response(stream_with_context(generate()), mimetype='application/x-image-batch')
+    response.headers['X-Image-Batch-Count'] = str(len(filenames))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def _serve_image_variant(filename, width, fmt):
+    """
+    Variante redimensionada/recodificada de una imagen (?w=&fmt=). Se genera la
+    primera vez y luego se sirve desde la cache local o S3 sin trabajo de PIL.
+    """
+    s3_client = get_s3_client()
+    bucket = AWS_S3_BUCKET_NAME
+    
+    # Para anchos mayores que la versión estándar se parte de la versión _high
+    source_filename = filename
+    if needs_high_source(width) and _high_res_filename(filename) != filename:
+        if _stored_key(s3_client, bucket, _high_res_filename(filename)):
+            source_filename = _high_res_filename(filename)
+    source_key = _stored_key(s3_client, bucket, source_filename)
+    if not source_key:
+        return f"Image {filename} not found in S3", 404
+    
+    variant_file, metadata = get_variant(
+        s3_client, bucket, source_key,
+        lambda: _read_image_bytes(s3_client, bucket, source_filename),
+        width, fmt
+    )
+    if not variant_file:
+        return f"Image {filename} not found in S3", 404
+    
+    variant_name = os.path.basename(variant_key(source_key, width, fmt))
+    response = _send_image_file(variant_file, variant_name, metadata.get('etag'), metadata.get('last_modified'))
+    response.headers['X-Image-Cache'] = {'cache': 'HIT', 's3': 'VARIANT', 'render': 'RENDER'}[metadata['source']]
+    # La variante de un sticker es tan inmutable como el original
+    return _add_image_headers(response, filename=filename)
+
 @s3_bp.route('/img/<filename>')
 def get_image(filename):
     """
-    Sirve imágenes exclusivamente desde S3
+    Sirve imágenes exclusivamente desde S3.
+    Con ?w=<ancho>&fmt=webp|png sirve una variante (solo anchos de IMAGE_VARIANT_WIDTHS).
     """
-    print(f"[GET_IMAGE] Accessing image: {filename}")
+    print(f"[GET_IMAGE] Accessing image: {filename} (mode: {IMAGE_SERVE_MODE})")
+    
+    try:
+        width, fmt = parse_variant_request(request.args)
+    except ValueError as e:
+        return str(e), 400
+    if width or fmt:
+        try:
+            return _serve_image_variant(filename, width, fmt)
+        except Exception as e:
+            print(f"[GET_IMAGE] Error serving variant of {filename}: {e}")
+            return f"Error accessing S3: {str(e)}", 500
     
     # 1. Intentar obtener URL de la sesión primero
     s3_urls = session.get('s3_urls', {})
     if filename in s3_urls:
         print(f"[GET_IMAGE] Image URL found in session cache: {filename}")
         url = s3_urls[filename]
-        print(f"[GET_IMAGE] Redirecting to cached S3 URL: {url}")
         
-        # En lugar de redireccionar directamente, intentar descargar y servir
-        # para evitar problemas de CORS cuando se usa en un canvas
+        # En modo 'buffered'/'stream' se sirve a través del servidor para evitar
+        # problemas de CORS cuando se usa en un canvas
         try:
             s3_client = get_s3_client()
             bucket = AWS_S3_BUCKET_NAME
-            key = f"{S3_STICKERS_FOLDER}/{filename}"
-            
-            # Descargar el archivo a memoria
-            file_obj = BytesIO()
-            s3_client.download_fileobj(Bucket=bucket, Key=key, Fileobj=file_obj)
-            file_obj.seek(0)
-            
-            # Determinar el tipo de contenido
-            content_type = 'image/png'
-            if filename.lower().endswith('.jpg') or filename.lower().endswith('.jpeg'):
-                content_type = 'image/jpeg'
-            elif filename.lower().endswith('.gif'):
-                content_type = 'image/gif'
-                
-            # Añadir cabeceras CORS
-            response = make_response(send_file(
-                file_obj,
-                mimetype=content_type,
-                as_attachment=False,
-                download_name=filename
-            ))
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            response.headers['Access-Control-Allow-Methods'] = 'GET'
-            response.headers['Cache-Control'] = 'public, max-age=86400'  # Cache por 24 horas
-            
-            return response
+            key = _stored_key(s3_client, bucket, filename) or canonical_key(filename)
+            return _serve_s3_image(s3_client, bucket, key, filename)
         except Exception as e:
-            print(f"[GET_IMAGE] Error downloading from S3, using redirect: {e}")
+            print(f"[GET_IMAGE] Error serving from S3, using redirect: {e}")
             # Si falla, usar redirección como fallback
             return redirect(url)
     
@@ -67,80 +466,157 @@ def get_image(filename):
             print(f"[GET_IMAGE] Error: {error_msg}")
             return f"Configuration error: {error_msg}", 500
         
-        # Lista de posibles rutas a probar en S3
-        possible_keys = [
-            f"{S3_STICKERS_FOLDER}/{filename}",  # Ruta estándar con carpeta stickers
-            filename,                           # Directamente en la raíz del bucket
-            f"stickers/{filename}",             # Carpeta stickers estándar (por si S3_STICKERS_FOLDER es diferente)
-            f"images/{filename}",               # Otra posible carpeta
-            f"imgs/{filename}"                  # Otra posible carpeta
-        ]
-        
-        # Probar cada posible ruta
-        found_key = None
-        for key in possible_keys:
-            print(f"[GET_IMAGE] Checking if object exists in S3: {bucket}/{key}")
-            try:
-                s3_client.head_object(Bucket=bucket, Key=key)
-                print(f"[GET_IMAGE] ✓ Object found in S3: {bucket}/{key}")
-                found_key = key
-                break
-            except Exception as e:
-                print(f"[GET_IMAGE] ✗ Object not found at {key}: {str(e)}")
-        
-        # Si se encontró el archivo, intentar descargarlo y servirlo
-        if found_key:
-            try:
-                print(f"[GET_IMAGE] Downloading and serving: {bucket}/{found_key}")
-                # Descargar el archivo a memoria
-                file_obj = BytesIO()
-                s3_client.download_fileobj(Bucket=bucket, Key=found_key, Fileobj=file_obj)
-                file_obj.seek(0)
-                
-                # Generar URL prefirmada para futuras peticiones
-                presigned_url = s3_client.generate_presigned_url(
-                    'get_object',
-                    Params={'Bucket': bucket, 'Key': found_key},
-                    ExpiresIn=3600  # URL válida por 1 hora
-                )
-                
-                # Guardar URL en la sesión para futuras solicitudes
-                s3_urls[filename] = presigned_url
-                session['s3_urls'] = s3_urls
-                
-                # Determinar el tipo de contenido
-                content_type = 'image/png'
-                if filename.lower().endswith('.jpg') or filename.lower().endswith('.jpeg'):
-                    content_type = 'image/jpeg'
-                elif filename.lower().endswith('.gif'):
-                    content_type = 'image/gif'
-                
-                # Añadir cabeceras CORS
-                response = make_response(send_file(
-                    file_obj,
-                    mimetype=content_type,
-                    as_attachment=False,
-                    download_name=filename
-                ))
-                
-                # Añadir cabeceras CORS y cache
-                response.headers['Access-Control-Allow-Origin'] = '*'
-                response.headers['Access-Control-Allow-Methods'] = 'GET'
-                response.headers['Cache-Control'] = 'public, max-age=86400'  # Cache por 24 horas
-                
-                return response
-            except Exception as e:
-                print(f"[GET_IMAGE] Error serving file directly, using redirect: {e}")
-                # Si falla, usar redirección como fallback
-                return redirect(presigned_url)
+        # Resolver la key con la cache de resoluciones (positivas y negativas) y el
+        # manifiesto de ubicaciones antiguas, en lugar de probar cada carpeta con head_object.
+        # Si la imagen está en la cache local no hace falta verificar nada en S3.
+        candidate = canonical_key(filename)
+        if image_cache.contains(candidate) or upload_spool.contains(candidate):
+            found_key, verified = candidate, True
         else:
-            print(f"[GET_IMAGE] ✗ File {filename} not found in any expected S3 location")
+            # En modo 'redirect' se verifica con head_object (el servidor no descarga el objeto);
+            # en los demás modos la propia descarga confirma si existe: una sola llamada a S3
+            found_key, verified = resolve_key(
+                s3_client, bucket, filename, verify=(IMAGE_SERVE_MODE == 'redirect')
+            )
+        
+        if not found_key:
+            print(f"[GET_IMAGE] ✗ File {filename} not found in S3 (cached lookup)")
             return f"Image {filename} not found in S3", 404
+        
+        # Generar URL prefirmada para futuras peticiones
+        presigned_url = s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket, 'Key': found_key},
+            ExpiresIn=IMAGE_PRESIGNED_EXPIRATION
+        )
+        
+        try:
+            print(f"[GET_IMAGE] Serving: {bucket}/{found_key}")
+            response = _serve_s3_image(s3_client, bucket, found_key, filename)
+        except ClientError as e:
+            if is_missing_error(e):
+                remember_missing(filename)
+                print(f"[GET_IMAGE] ✗ File {filename} not found in S3")
+                return f"Image {filename} not found in S3", 404
+            print(f"[GET_IMAGE] Error serving file directly, using redirect: {e}")
+            return redirect(presigned_url)
+        except Exception as e:
+            print(f"[GET_IMAGE] Error serving file directly, using redirect: {e}")
+            # Si falla, usar redirección como fallback
+            return redirect(presigned_url)
+        
+        if not verified:
+            remember_key(filename, found_key)
+        
+        # Guardar URL en la sesión para futuras solicitudes
+        s3_urls[filename] = presigned_url
+        session['s3_urls'] = s3_urls
+        
+        return response
     except Exception as e:
         error_msg = f"Error accessing S3: {str(e)}"
         print(f"[GET_IMAGE] {error_msg}")
         return error_msg, 500
 
+def _history_identifier():
+    """
+    user_id del usuario autenticado o session_id del visitante anónimo (igual que /get-history)
+    """
+    user_id = session.get('user_id')
+    if user_id:
+        return user_id
+    session_id = session.get('session_id')
+    if not session_id:
+        session_id = str(uuid.uuid4())
+        session['session_id'] = session_id
+    return session_id
+
+@s3_bp.route('/history-sprite')
+def history_sprite():
+    """
+    Página del historial como un único sprite WebP más el mapa de offsets de cada sticker.
+    Paginación por cursor: ?cursor=<último filename de la página anterior>&page_size=20
+    """
+    identifier = _history_identifier()
+    cursor = request.args.get('cursor') or None
+    page_size = max(1, min(request.args.get('page_size', 20, type=int), HISTORY_SPRITE_MAX_PAGE_SIZE))
+    
+    try:
+        s3_client = get_s3_client()
+        bucket = AWS_S3_BUCKET_NAME
+        # Solo se lista el rango de keys de la página, no todo el prefijo del usuario
+        page, next_cursor = list_sticker_page(identifier, cursor, page_size, bucket_name=bucket)
+        
+        response = {
+            "success": True,
+            "stickers": page,
+            "next_cursor": next_cursor,
+            "page_size": page_size,
+            "sprite_url": None,
+            "sprite": None
+        }
+        if page:
+            name, sprite_map = get_or_build_sprite(s3_client, bucket, identifier, page)
+            # Sin sprite (faltaba alguna miniatura) el cliente pide cada sticker a /img/
+            if name:
+                response["sprite_url"] = url_for('s3.history_sprite_image', sprite_file=name)
+                response["sprite"] = sprite_map
+        return jsonify(response)
+    except Exception as e:
+        print(f"[HISTORY-SPRITE] Error building history sprite for {identifier}: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@s3_bp.route('/history-sprite/<sprite_file>')
+def history_sprite_image(sprite_file):
+    """
+    Sirve un sprite del historial del usuario actual (inmutable: su nombre es el hash del contenido)
+    """
+    if not SPRITE_IMAGE_PATTERN.match(sprite_file):
+        return "Invalid sprite name", 400
+    
+    try:
+        s3_client = get_s3_client()
+        key = sprite_key(_history_identifier(), sprite_file)
+        return _serve_s3_image(s3_client, AWS_S3_BUCKET_NAME, key, sprite_file)
+    except ClientError as e:
+        if is_missing_error(e):
+            return f"Sprite {sprite_file} not found", 404
+        return f"Error accessing S3: {str(e)}", 500
+    except Exception as e:
+        return f"Error accessing S3: {str(e)}", 500
+
+@s3_bp.route('/reference-upload', methods=['POST'])
+def reference_upload():
+    """
+    POST prefirmado para que el navegador suba la imagen de referencia directo a S3.
+    Body JSON: {"content_type": "image/jpeg"}. /generate recibe luego solo la key.
+    """
+    if not REFERENCE_DIRECT_UPLOAD_ENABLED:
+        return jsonify({"success": False, "error": "Direct uploads are disabled"}), 404
+    
+    data = request.get_json(silent=True) or {}
+    content_type = data.get('content_type', '')
+    upload = create_reference_upload(_history_identifier(), content_type)
+    if not upload:
+        return jsonify({"success": False, "error": f"Unsupported content type: {content_type}"}), 400
+    
+    response = jsonify({"success": True, "max_bytes": REFERENCE_UPLOAD_MAX_BYTES, **upload})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@s3_bp.route('/debug-image-cache')
+@admin_required
+def debug_image_cache():
+    """
+    Métricas de la cache local de imágenes (hit ratio y bytes ahorrados) y del
+    índice de nombres de archivo del worker actual (solo administradores)
+    """
+    return jsonify({
+        "image_cache": image_cache.get_cache_stats(),
+        "filename_index": get_index_stats(),
+        "upload_spool": upload_spool.get_spool_stats()
+    })
+
 @s3_bp.route('/debug-s3')
 def debug_s3():
     """
@@ -241,72 +717,26 @@ def direct_s3_image(filename):
             print(f"[DIRECT-S3] ERROR: {error_msg}")
             return f"Configuration error: {error_msg}", 500
         
-        # Lista de posibles rutas a probar
-        possible_keys = [
-            f"{S3_STICKERS_FOLDER}/{filename}",
-            filename,
-            f"stickers/{filename}",
-            f"images/{filename}",
-            f"imgs/{filename}"
-        ]
-        
-        # Primero, listar todos los objetos en el bucket para diagnóstico
-        try:
-            print(f"[DIRECT-S3] Listing objects in bucket: {bucket} to find possible matches")
-            all_objects = s3_client.list_objects_v2(Bucket=bucket)
-            
-            if 'Contents' in all_objects and all_objects['Contents']:
-                print(f"[DIRECT-S3] ✓ Found {len(all_objects['Contents'])} objects in bucket")
-                
-                # Buscar posibles coincidencias para diagnóstico
-                possible_matches = []
-                for obj in all_objects['Contents']:
-                    key = obj['Key']
-                    if filename in key:
-                        possible_matches.append(key)
-                
-                if possible_matches:
-                    print(f"[DIRECT-S3] Possible matches found for {filename}:")
-                    for match in possible_matches:
-                        print(f"[DIRECT-S3]   - {match}")
-                    
-                    # Añadir las coincidencias encontradas a las rutas a probar
-                    possible_keys.extend(possible_matches)
-                else:
-                    print(f"[DIRECT-S3] No filename matches for {filename} in bucket contents")
-            else:
-                print(f"[DIRECT-S3] Warning: No objects found in bucket {bucket}")
-        except Exception as e:
-            print(f"[DIRECT-S3] Error listing bucket contents: {str(e)}")
+        # Buscar la key en el índice compartido (filename -> key), que mantienen
+        # las subidas. Si no está indexada (p.ej. un objeto subido fuera de la
+        # app) se usa el resolvedor de keys y el resultado se añade al índice.
+        key = lookup_filename(filename)
+        if key and STICKER_CONTENT_ADDRESSING and key == canonical_key(filename):
+            # La key canónica puede ser una referencia al contenido
+            key = _stored_key(s3_client, bucket, filename)
+        if key:
+            print(f"[DIRECT-S3] ✓ Key found in filename index: {key}")
+        else:
+            key, _ = resolve_key(s3_client, bucket, filename, verify=True)
+            if key:
+                index_key(key)
         
-        # Intentar encontrar y descargar el archivo
-        for key in possible_keys:
+        if key:
             try:
-                print(f"[DIRECT-S3] Attempting to download: {bucket}/{key}")
+                print(f"[DIRECT-S3] ✓ Serving image from {bucket}/{key}")
                 
-                # Verificar si el objeto existe
-                try:
-                    s3_client.head_object(Bucket=bucket, Key=key)
-                    print(f"[DIRECT-S3] ✓ Object exists: {bucket}/{key}")
-                except Exception as e:
-                    print(f"[DIRECT-S3] ✗ Object does not exist: {bucket}/{key} - {str(e)}")
-                    continue
-                
-                # Descargar el objeto a un buffer en memoria
-                file_obj = BytesIO()
-                s3_client.download_fileobj(Bucket=bucket, Key=key, Fileobj=file_obj)
-                
-                # Resetear la posición del buffer
-                file_obj.seek(0)
-                
-                # Determinar el tipo de contenido
-                content_type = 'image/png'  # Por defecto
-                if filename.lower().endswith('.jpg') or filename.lower().endswith('.jpeg'):
-                    content_type = 'image/jpeg'
-                elif filename.lower().endswith('.gif'):
-                    content_type = 'image/gif'
-                
-                print(f"[DIRECT-S3] ✓ Success! Serving image from {bucket}/{key}")
+                # Este endpoint nunca redirige: sirve el contenido a través del servidor
+                response = _serve_s3_image(s3_client, bucket, key, filename, allow_redirect=False)
                 
                 # Guardar la ruta correcta para futuras referencias
                 s3_urls = session.get('s3_urls', {})
@@ -315,31 +745,20 @@ def direct_s3_image(filename):
                 presigned_url = s3_client.generate_presigned_url(
                     'get_object',
                     Params={'Bucket': bucket, 'Key': key},
-                    ExpiresIn=3600
+                    ExpiresIn=IMAGE_PRESIGNED_EXPIRATION
                 )
                 
                 # Guardar la URL para futuras solicitudes
                 s3_urls[filename] = presigned_url
                 session['s3_urls'] = s3_urls
                 
-                # Crear respuesta con cabeceras CORS
-                response = make_response(send_file(
-                    file_obj,
-                    mimetype=content_type,
-                    as_attachment=False,
-                    download_name=filename
-                ))
-                
-                # Añadir cabeceras CORS y cache
-                response.headers['Access-Control-Allow-Origin'] = '*'
-                response.headers['Access-Control-Allow-Methods'] = 'GET'
-                response.headers['Cache-Control'] = 'public, max-age=86400'  # Cache por 24 horas
-                
                 return response
-                
-            except Exception as e:
-                print(f"[DIRECT-S3] Error with {key}: {str(e)}")
-                continue
+            except ClientError as e:
+                if not is_missing_error(e):
+                    raise
+                remember_missing(filename)
+                unindex_filename(filename)
+                print(f"[DIRECT-S3] ✗ Indexed key no longer exists: {bucket}/{key}")
         
         # Si llegamos aquí, no pudimos encontrar el archivo
         print(f"[DIRECT-S3] ✗ Image {filename} not found in any location in S3 bucket")
@@ -1,5 +1,5 @@
 # Servicios para la gestión de cupones
-from utils.dynamodb_utils import get_dynamodb_resource, COUPON_TABLE, TRANSACTION_TABLE, get_user
+from utils.dynamodb_utils import get_table, COUPON_TABLE, TRANSACTION_TABLE, get_user
 import uuid
 import time
 from datetime import datetime
@@ -7,11 +7,11 @@ from boto3.dynamodb.conditions import Key, Attr
 from decimal import Decimal
 from utils.utils import safe_int, safe_decimal
 from utils.dynamodb_utils import create_transaction
+from utils.dynamodb_scan import scan_items
 
 # Crear cupón
 def create_coupon(data):
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(COUPON_TABLE)
+    table = get_table(COUPON_TABLE)
     now = int(time.time())
     # Validar unicidad del código de cupón
     existing = get_coupon_by_code(data['coupon_code'])
@@ -35,8 +35,7 @@ def create_coupon(data):
 
 # Obtener cupón por código
 def get_coupon_by_code(coupon_code):
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(COUPON_TABLE)
+    table = get_table(COUPON_TABLE)
     resp = table.query(
         IndexName='CouponCodeIndex',
         KeyConditionExpression=Key('coupon_code').eq(coupon_code)
@@ -46,8 +45,6 @@ def get_coupon_by_code(coupon_code):
 
 # Listar cupones (con filtros opcionales)
 def list_coupons(filters=None):
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(COUPON_TABLE)
     scan_kwargs = {}
     if filters:
         filter_expr = None
@@ -56,14 +53,13 @@ def list_coupons(filters=None):
             filter_expr = cond if filter_expr is None else filter_expr & cond
         if filter_expr is not None:
             scan_kwargs['FilterExpression'] = filter_expr
-    resp = table.scan(**scan_kwargs)
-    return resp.get('Items', [])
+    # Todas las páginas (una sola página se corta en 1 MB)
+    return list(scan_items(COUPON_TABLE, **scan_kwargs))
 
 # Redimir cupón
 def redeem_coupon(user_id, coupon_code):
-    dynamodb = get_dynamodb_resource()
-    coupon_table = dynamodb.Table(COUPON_TABLE)
-    transaction_table = dynamodb.Table(TRANSACTION_TABLE)
+    coupon_table = get_table(COUPON_TABLE)
+    transaction_table = get_table(TRANSACTION_TABLE)
     # 1. Buscar cupón
     coupon = get_coupon_by_code(coupon_code)
     if not coupon:
@@ -115,8 +111,7 @@ def redeem_coupon(user_id, coupon_code):
 
 # Activar/desactivar cupón
 def set_coupon_active(coupon_code, is_active):
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(COUPON_TABLE)
+    table = get_table(COUPON_TABLE)
     coupon = get_coupon_by_code(coupon_code)
     if not coupon:
         return {'error': 'Cupón no encontrado'}, 404
@@ -129,8 +124,7 @@ def set_coupon_active(coupon_code, is_active):
 
 # Eliminar cupón
 def delete_coupon(coupon_code):
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(COUPON_TABLE)
+    table = get_table(COUPON_TABLE)
     coupon = get_coupon_by_code(coupon_code)
     if not coupon:
         return {'error': 'Cupón no encontrado'}, 404
@@ -141,8 +135,7 @@ def get_coupon_redemptions(coupon_code):
     """
     Devuelve una lista de usuarios que usaron el cupón, con nombre, email y fecha de redención.
     """
-    dynamodb = get_dynamodb_resource()
-    transaction_table = dynamodb.Table(TRANSACTION_TABLE)
+    transaction_table = get_table(TRANSACTION_TABLE)
     # Buscar todas las transacciones con ese coupon_code
     resp = transaction_table.query(
         IndexName='CouponCodeIndex',
@@ -1,12 +1,9 @@
 import base64
-import io
-import os
-import tempfile
 import logging
-import time
 from utils.utils import save_image, create_placeholder_image
+from utils.s3_utils import open_reference_upload, delete_file_from_s3
+from utils.reference_images import prepare_reference_image, REFERENCE_IMAGE_FILENAME
 from openai import OpenAI
-from PIL import Image
 from config import USE_PLACEHOLDER_STICKER, STICKER_STYLE_CONFIG
 
 # Configurar logging
@@ -50,10 +47,29 @@ La imagen debe tener un fondo transparente, para que al imprimir el sticker no s
     return image_data
 
 
-def generate_sticker_with_reference(user_prompt, img_path, img_base64, quality='low', style=None):
+def _read_reference_upload(reference_key):
+    """
+    Bytes of a reference image uploaded by the browser to the staging prefix.
+    The staged object is kept so a failed generation can be retried; it is
+    deleted after the sticker is saved (and expired by the bucket lifecycle rule
+    otherwise, see setup-bucket).
+    """
+    body = open_reference_upload(reference_key)
+    if body is None:
+        raise ValueError("La imagen de referencia no existe o expiró")
+    try:
+        img_bytes = body.read()
+    finally:
+        body.close()
+    return img_bytes
+
+
+def generate_sticker_with_reference(user_prompt, img_path, img_base64, quality='low', style=None, reference_key=None):
     # Check if we should use placeholder instead of actual generation
     if USE_PLACEHOLDER_STICKER:
         logger.info("Using placeholder sticker instead of actual generation with reference")
+        if reference_key:
+            delete_file_from_s3(reference_key)
         return create_placeholder_image(img_path)
         
     client = OpenAI()
@@ -75,55 +91,41 @@ La imagen debe tener un fondo transparente, para que al imprimir el sticker no s
 """
     
     try:
-        # Convert base64 to image file
-        if img_base64.startswith('data:image'):
-            # Remove the data URL prefix if present
-            img_base64 = img_base64.split(',')[1]
-        
-        # Decode base64 string to bytes
-        img_bytes = base64.b64decode(img_base64)
-        logger.info(f"Imagen decodificada correctamente, tamaño: {len(img_bytes)} bytes")
-        
-        # Create a temporary directory that won't be automatically deleted
-        temp_dir = tempfile.mkdtemp()
-        tmp_file_path = os.path.join(temp_dir, "reference_image.png")
+        if reference_key:
+            # Subida directa desde el navegador: se lee de S3 sin pasar por base64
+            img_bytes = _read_reference_upload(reference_key)
+            logger.info(f"Imagen de referencia leída de S3 ({reference_key}), tamaño: {len(img_bytes)} bytes")
+        else:
+            # Convert base64 to image file
+            if img_base64.startswith('data:image'):
+                # Remove the data URL prefix if present
+                img_base64 = img_base64.split(',')[1]
+            
+            # Decode base64 string to bytes
+            img_bytes = base64.b64decode(img_base64)
+            logger.info(f"Imagen decodificada correctamente, tamaño: {len(img_bytes)} bytes")
         
         try:
-            # Convert to PNG format with error handling
-            img = Image.open(io.BytesIO(img_bytes))
+            # Orientar, reducir y codificar en memoria (sin archivos temporales)
+            reference_png = prepare_reference_image(img_bytes)
+            del img_bytes
             
-            # Registrar información de la imagen para depuración
-            logger.info(f"Imagen cargada: formato={img.format}, tamaño={img.size}, modo={img.mode}")
-            
-            # Asegurar que la imagen esté en formato RGBA
-            img = img.convert('RGBA')
-            
-            # Guardar imagen en formato PNG
-            img.save(tmp_file_path, format="PNG")
-            logger.info(f"Imagen temporal guardada en: {tmp_file_path}")
-            
-            # Verificar que el archivo existe y tiene tamaño correcto
-            if os.path.exists(tmp_file_path):
-                file_size = os.path.getsize(tmp_file_path)
-                logger.info(f"Archivo temporal creado correctamente: {file_size} bytes")
-            else:
-                raise ValueError("El archivo temporal no se creó correctamente")
-            
-            # Open the file with proper MIME type recognition
-            with open(tmp_file_path, 'rb') as img_file:
-                logger.info("Enviando solicitud a OpenAI para edición de imagen")
-                result = client.images.edit(
-                    model="gpt-image-1",
-                    image=img_file,
-                    prompt=formatted_prompt,
-                    quality=quality,
-                    size="1024x1024",
-                )
-                logger.info("Respuesta de OpenAI recibida correctamente")
+            logger.info("Enviando solicitud a OpenAI para edición de imagen")
+            result = client.images.edit(
+                model="gpt-image-1",
+                image=(REFERENCE_IMAGE_FILENAME, reference_png, "image/png"),
+                prompt=formatted_prompt,
+                quality=quality,
+                size="1024x1024",
+            )
+            logger.info("Respuesta de OpenAI recibida correctamente")
             
             # save_image now returns a tuple (image_b64, s3_url, high_res_s3_url)
             image_data = save_image(result, img_path)
             logger.info("Imagen guardada correctamente")
+            if reference_key:
+                # Solo tras generar: si OpenAI falla, el reintento aún encuentra la subida
+                delete_file_from_s3(reference_key)
             return image_data
             
         except Exception as e:
@@ -133,12 +135,3 @@ La imagen debe tener un fondo transparente, para que al imprimir el sticker no s
     except Exception as e:
         logger.error(f"Error general: {str(e)}", exc_info=True)
         raise
-    finally:
-        # Clean up the temporary file and directory
-        try:
-            if 'tmp_file_path' in locals() and os.path.exists(tmp_file_path):
-                os.remove(tmp_file_path)
-            if 'temp_dir' in locals() and os.path.exists(temp_dir):
-                os.rmdir(temp_dir)
-        except Exception as cleanup_error:
-            logger.error(f"Error al limpiar archivos temporales: {str(cleanup_error)}")
\ No newline at end of file
@@ -938,6 +938,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 document.body.appendChild(downloadLink);
                 downloadLink.click();
                 document.body.removeChild(downloadLink);
+                batchBlobUrls.forEach(url => URL.revokeObjectURL(url)); // Liberar memoria
                 
                 showSuccess('¡Plantilla descargada!');
             }
@@ -957,6 +958,66 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         };
         
+        // Descarga todas las imágenes de la plantilla en una sola petición a /img/batch.
+        // El servidor elige la versión _high si existe y las reduce al tamaño del canvas.
+        // Formato: por cada imagen [uint32 longitud][cabecera JSON][uint32 longitud][bytes]
+        const batchBlobUrls = [];
+        const fetchImagesBatch = async (filenames) => {
+            const response = await fetch('/img/batch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    filenames: filenames,
+                    size: 'high',
+                    max_dimension: Math.max(stickerWidth, stickerHeight)
+                })
+            });
+            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            
+            const buffer = await response.arrayBuffer();
+            const view = new DataView(buffer);
+            const decoder = new TextDecoder();
+            const blobUrls = {};
+            let offset = 0;
+            while (offset + 4 <= buffer.byteLength) {
+                const headerLength = view.getUint32(offset);
+                offset += 4;
+                const header = JSON.parse(decoder.decode(new Uint8Array(buffer, offset, headerLength)));
+                offset += headerLength;
+                const bodyLength = view.getUint32(offset);
+                offset += 4;
+                if (header.status === 200) {
+                    const blob = new Blob([new Uint8Array(buffer, offset, bodyLength)], { type: header.content_type });
+                    blobUrls[header.filename] = URL.createObjectURL(blob);
+                    batchBlobUrls.push(blobUrls[header.filename]);
+                }
+                offset += bodyLength;
+            }
+            return blobUrls;
+        };
+        
+        // Dibuja una imagen ya descargada por /img/batch (la URL se libera al terminar la plantilla)
+        const drawImageAt = (blobUrl, filename, index) => {
+            const col = index % columns;
+            const row = Math.floor(index / columns);
+            const x = padding + col * (stickerWidth + padding);
+            const y = padding + row * (stickerHeight + padding);
+            
+            const img = new Image();
+            img.onload = () => {
+                ctx.drawImage(img, x, y, stickerWidth, stickerHeight);
+                loadedCount++;
+                drawTemplateAndDownload();
+            };
+            img.onerror = () => {
+                console.error(`Failed to load batch image for ${filename}`);
+                drawPlaceholder(x, y);
+                loadedCount++;
+                drawTemplateAndDownload();
+            };
+            img.src = blobUrl;
+        };
+        
         // Función para cargar y dibujar la imagen en el canvas
         const loadAndDrawImage = async (filename, index) => {
             // Posición donde se dibujará esta imagen
@@ -1023,10 +1084,24 @@ document.addEventListener('DOMContentLoaded', () => {
             ctx.fillText('?', x + stickerWidth/2, y + stickerHeight/2);
         };
         
-        // Iniciar la carga de todas las imágenes
-        stickerInstances.forEach((filename, index) => {
-            loadAndDrawImage(filename, index);
-        });
+        // Iniciar la carga de todas las imágenes: una sola petición para todo el lote y,
+        // si falla, la carga individual de cada imagen
+        const loadAllImages = async () => {
+            let batchUrls = {};
+            try {
+                batchUrls = await fetchImagesBatch([...new Set(stickerInstances)]);
+            } catch (error) {
+                console.warn(`Batch image fetch failed, loading images one by one: ${error}`);
+            }
+            stickerInstances.forEach((filename, index) => {
+                if (batchUrls[filename]) {
+                    drawImageAt(batchUrls[filename], filename, index);
+                } else {
+                    loadAndDrawImage(filename, index);
+                }
+            });
+        };
+        loadAllImages();
         
         // Si después de 15 segundos no se ha completado, forzar la descarga con lo que se tenga
         setTimeout(() => {
@@ -1480,11 +1555,16 @@ document.addEventListener('DOMContentLoaded', () => {
             
             if (hasReferenceImage) {
                 formData.append('mode', 'reference');
-                if (isIOS && hasReferenceImage) {
-                    formData.append('reference_image', dataURItoBlob(referenceImageData));
-                    formData.append('device_type', 'ios');
+                const referenceBlob = dataURItoBlob(referenceImageData);
+                // Subir directo a S3; si falla, se envía la imagen al servidor como antes
+                const referenceKey = await uploadReferenceImage(referenceBlob);
+                if (referenceKey) {
+                    formData.append('reference_key', referenceKey);
                 } else {
-                    formData.append('reference_image', dataURItoBlob(referenceImageData));
+                    formData.append('reference_image', referenceBlob);
+                }
+                if (isIOS) {
+                    formData.append('device_type', 'ios');
                 }
             } else {
                 formData.append('mode', 'simple');
@@ -1536,6 +1616,30 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
+    // Sube la imagen de referencia a S3 con un POST prefirmado y devuelve su key (o null)
+    async function uploadReferenceImage(blob) {
+        try {
+            const presignResponse = await fetch('/reference-upload', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ content_type: blob.type })
+            });
+            if (!presignResponse.ok) return null;
+            const upload = await presignResponse.json();
+            if (!upload.success || blob.size > upload.max_bytes) return null;
+            
+            const uploadForm = new FormData();
+            Object.entries(upload.fields).forEach(([name, value]) => uploadForm.append(name, value));
+            // S3 exige que el archivo sea el último campo del formulario
+            uploadForm.append('file', blob);
+            const uploadResponse = await fetch(upload.url, { method: 'POST', body: uploadForm });
+            return uploadResponse.ok ? upload.key : null;
+        } catch (error) {
+            console.warn('Direct reference upload failed, falling back to /generate upload:', error);
+            return null;
+        }
+    }
+    
     function dataURItoBlob(dataURI) {
         const byteString = atob(dataURI.split(',')[1]);
         const mimeString = dataURI.split(',')[0].split(':')[1].split(';')[0];
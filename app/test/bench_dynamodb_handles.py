@@ -0,0 +1,73 @@
+"""
+Microbenchmark de la creación de handles de DynamoDB.
+
+Compara lo que hacía cada función de dynamodb_utils (crear un boto3.resource
+nuevo y llamar a .Table()) con los handles cacheados de get_table(). No hace
+llamadas de red: solo mide el coste de construir los objetos, que se pagaba
+varias veces en cada /generate. También mide un hilo nuevo por llamada, como
+el servidor de desarrollo (un hilo por petición): el resource sale del pool
+compartido en lugar de reconstruirse.
+
+    PYTHONPATH=app python app/test/bench_dynamodb_handles.py
+"""
+import os
+import time
+import threading
+
+import boto3
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+
+from config import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION
+from utils.dynamodb_utils import get_table, USER_TABLE
+
+CALLS = 200
+
+
+def uncached_table():
+    dynamodb = boto3.resource(
+        'dynamodb',
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=AWS_REGION
+    )
+    return dynamodb.Table(USER_TABLE)
+
+
+def measure(factory):
+    start = time.perf_counter()
+    for _ in range(CALLS):
+        factory()
+    return (time.perf_counter() - start) / CALLS
+
+
+def in_new_thread(factory):
+    # Un hilo por petición: al terminar, sus handles vuelven al pool
+    def run():
+        thread = threading.Thread(target=factory)
+        thread.start()
+        thread.join()
+    return run
+
+
+def main():
+    # La primera llamada a get_table() crea el resource del hilo; se mide aparte
+    start = time.perf_counter()
+    get_table(USER_TABLE)
+    first_call = time.perf_counter() - start
+
+    uncached = measure(uncached_table)
+    cached = measure(lambda: get_table(USER_TABLE))
+    thread_baseline = measure(in_new_thread(lambda: None))
+    per_thread = measure(in_new_thread(lambda: get_table(USER_TABLE))) - thread_baseline
+    print(f"boto3.resource() + Table() per call: {uncached * 1000:8.3f} ms")
+    print(f"get_table() first call:              {first_call * 1000:8.3f} ms")
+    print(f"get_table() cached:                  {cached * 1000:8.3f} ms")
+    print(f"get_table() in a new thread:         {per_thread * 1000:8.3f} ms (thread start excluded)")
+    print(f"Saved per call: {(uncached - cached) * 1000:.3f} ms "
+          f"(~{(uncached - cached) * 3000:.1f} ms per /generate with 3 lookups)")
+
+
+if __name__ == '__main__':
+    main()
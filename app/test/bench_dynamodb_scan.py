@@ -0,0 +1,104 @@
+"""
+Benchmark de utils.dynamodb_scan contra DynamoDB Local con 1M de items.
+
+Compara lo que hacían los KPIs de admin (un único scan: solo la primera página
+de 1 MB, resultado incorrecto) con el scan paginado secuencial y con 2..16
+segmentos en paralelo, leyendo items completos, con proyección y con
+Select='COUNT'. La primera ejecución carga la tabla (tarda varios minutos).
+
+    docker run -p 8000:8000 amazon/dynamodb-local
+    DYNAMODB_ENDPOINT_URL=http://localhost:8000 PYTHONPATH=app python app/test/bench_dynamodb_scan.py
+"""
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+os.environ.setdefault('DYNAMODB_SCAN_MAX_WORKERS', '16')
+
+from config import DYNAMODB_ENDPOINT_URL
+from utils.dynamodb_utils import get_dynamodb_resource
+from utils.dynamodb_scan import scan_items, scan_count
+
+TABLE_NAME = 'bench-dynamodb-scan'
+ITEMS = int(os.getenv('BENCH_ITEMS', '1000000'))
+LOAD_THREADS = 8
+SEGMENTS = [1, 2, 4, 8, 16]
+
+
+def ensure_table():
+    dynamodb = get_dynamodb_resource()
+    if TABLE_NAME not in dynamodb.meta.client.list_tables()['TableNames']:
+        dynamodb.create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        dynamodb.meta.client.get_waiter('table_exists').wait(TableName=TABLE_NAME)
+
+    existing = scan_count(TABLE_NAME, segments=8)
+    if existing >= ITEMS:
+        return existing
+
+    # Items parecidos a los usuarios reales (~250 bytes)
+    def load(count):
+        table = get_dynamodb_resource().Table(TABLE_NAME)
+        now = int(time.time())
+        with table.batch_writer() as batch:
+            for i in range(count):
+                batch.put_item(Item={
+                    'user_id': str(uuid.uuid4()),
+                    'email': f"user{uuid.uuid4().hex[:12]}@example.com",
+                    'name': 'Bench User',
+                    'coins': i % 500,
+                    'created_at': now - (i % 365) * 86400,
+                    'last_login': now - (i % 30) * 86400,
+                    'role': 'user',
+                    'status': 'active'
+                })
+
+    missing = ITEMS - existing
+    print(f"Loading {missing} items into {TABLE_NAME}...")
+    start = time.perf_counter()
+    per_thread = missing // LOAD_THREADS
+    with ThreadPoolExecutor(LOAD_THREADS) as pool:
+        list(pool.map(load, [per_thread] * (LOAD_THREADS - 1) + [missing - per_thread * (LOAD_THREADS - 1)]))
+    print(f"Loaded in {time.perf_counter() - start:.0f}s")
+    return ITEMS
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<38} {result:>9} {elapsed:>8.2f}s")
+    return elapsed
+
+
+def main():
+    if not DYNAMODB_ENDPOINT_URL:
+        raise SystemExit("Set DYNAMODB_ENDPOINT_URL to a DynamoDB Local endpoint")
+    total = ensure_table()
+    print(f"{TABLE_NAME}: {total} items\n")
+    print(f"{'scan':<38} {'result':>9} {'time':>9}")
+
+    table = get_dynamodb_resource().Table(TABLE_NAME)
+    timed("single page (old KPI code)", lambda: table.scan(Select='COUNT').get('Count', 0))
+    since = int(time.time()) - 7 * 86400
+    for segments in SEGMENTS:
+        timed(f"COUNT, {segments} segments",
+              lambda: scan_count(TABLE_NAME, segments=segments))
+        timed(f"COUNT + filter, {segments} segments",
+              lambda: scan_count(TABLE_NAME, segments=segments, FilterExpression='created_at >= :since',
+                                 ExpressionAttributeValues={':since': since}))
+        timed(f"items, {segments} segments",
+              lambda: sum(1 for _ in scan_items(TABLE_NAME, segments=segments)))
+        timed(f"items (projection), {segments} segments",
+              lambda: sum(1 for _ in scan_items(TABLE_NAME, segments=segments, ProjectionExpression='coins')))
+
+
+if __name__ == '__main__':
+    main()
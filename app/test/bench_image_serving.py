@@ -0,0 +1,62 @@
+"""
+Benchmark de throughput para /img/ bajo carga concurrente.
+
+El modo de servicio se configura en el servidor (IMAGE_SERVE_MODE), así que hay
+que levantar la app una vez por modo y ejecutar este script contra cada una:
+
+    IMAGE_SERVE_MODE=buffered python app.py
+    python test/bench_image_serving.py --base-url http://localhost:5000 \
+        --filename sticker_xxx_high.png --concurrency 32 --requests 500
+
+En modo 'redirect' el cliente sigue el 302, por lo que el tiempo medido incluye
+la descarga desde S3/CDN (igual que en el navegador).
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def fetch(session, url):
+    start = time.perf_counter()
+    response = session.get(url, allow_redirects=True)
+    elapsed = time.perf_counter() - start
+    return response.status_code, len(response.content), elapsed
+
+
+def run(base_url, filename, concurrency, total_requests):
+    url = f"{base_url.rstrip('/')}/img/{filename}"
+    # Una sesión HTTP por worker para reutilizar conexiones
+    sessions = [requests.Session() for _ in range(concurrency)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(fetch, sessions[i % concurrency], url)
+            for i in range(total_requests)
+        ]
+        results = [f.result() for f in futures]
+    wall_time = time.perf_counter() - start
+
+    latencies = sorted(r[2] for r in results)
+    total_bytes = sum(r[1] for r in results)
+    errors = sum(1 for r in results if r[0] >= 400)
+
+    print(f"URL: {url}")
+    print(f"Requests: {total_requests}, concurrency: {concurrency}, errors: {errors}")
+    print(f"Throughput: {total_requests / wall_time:.1f} req/s, {total_bytes / wall_time / 1024 / 1024:.2f} MB/s")
+    print(f"Latency p50: {statistics.median(latencies) * 1000:.1f} ms, "
+          f"p95: {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} ms, "
+          f"max: {latencies[-1] * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark de /img/ bajo carga concurrente")
+    parser.add_argument('--base-url', default='http://localhost:5000')
+    parser.add_argument('--filename', required=True)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+    run(args.base_url, args.filename, args.concurrency, args.requests)
@@ -0,0 +1,78 @@
+"""
+Benchmark del preprocesado de imágenes de referencia.
+
+Compara el pipeline anterior (decodificar a resolución completa, convertir a
+RGBA, guardar el PNG en un directorio temporal y volver a leerlo) con
+prepare_reference_image (orientación EXIF, reducción a 1024 px y un único PNG
+en memoria). Muestra el tiempo de CPU y el tamaño de lo que se sube a OpenAI,
+con el tiempo de subida estimado para un enlace de UPLOAD_MBPS.
+
+    PYTHONPATH=app python app/test/bench_reference_images.py
+"""
+import os
+import shutil
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from utils.reference_images import prepare_reference_image
+
+UPLOAD_MBPS = 20
+RUNS = 3
+# Tamaños típicos: foto de móvil de 12 MP, captura de pantalla y una imagen pequeña
+SIZES = [(4032, 3024), (1170, 2532), (800, 800)]
+
+
+def make_photo(size):
+    # Ruido suavizado para que el JPEG tenga un tamaño parecido al de una foto real;
+    # orientación EXIF 6 (rotada 90°) como las fotos verticales de los móviles
+    img = Image.effect_noise((size[0] // 8, size[1] // 8), 48).convert('RGB').resize(size, Image.BICUBIC)
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    output = BytesIO()
+    img.save(output, format="JPEG", quality=90, exif=exif)
+    return output.getvalue()
+
+
+def old_pipeline(img_bytes):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(temp_dir, "reference_image.png")
+        Image.open(BytesIO(img_bytes)).convert('RGBA').save(path, format="PNG")
+        with open(path, 'rb') as img_file:
+            return img_file.read()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def new_pipeline(img_bytes):
+    return prepare_reference_image(img_bytes).getvalue()
+
+
+def measure(pipeline, img_bytes):
+    best = None
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        data = pipeline(img_bytes)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(data)
+
+
+def main():
+    print(f"{'size':>12} {'input':>9} | {'old ms':>8} {'old MB':>7} {'old up s':>8} | "
+          f"{'new ms':>8} {'new MB':>7} {'new up s':>8}")
+    for size in SIZES:
+        img_bytes = make_photo(size)
+        old_time, old_size = measure(old_pipeline, img_bytes)
+        new_time, new_size = measure(new_pipeline, img_bytes)
+        upload_seconds = lambda n: n * 8 / (UPLOAD_MBPS * 1000 * 1000)
+        print(f"{size[0]:>5}x{size[1]:<6} {len(img_bytes) / 1024 / 1024:>7.1f}MB | "
+              f"{old_time * 1000:>8.0f} {old_size / 1024 / 1024:>7.1f} {upload_seconds(old_size):>8.2f} | "
+              f"{new_time * 1000:>8.0f} {new_size / 1024 / 1024:>7.1f} {upload_seconds(new_size):>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
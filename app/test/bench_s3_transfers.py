@@ -0,0 +1,92 @@
+"""
+Benchmark de transferencias S3 para plantillas de 5, 50 y 200 stickers.
+
+Compara la descarga secuencial (download_file por key, como hacía
+payment_feedback) contra download_files_from_s3, y la subida secuencial
+contra upload_files_to_s3. Usa el bucket configurado en .env y un prefijo
+temporal que se borra al terminar.
+
+    PYTHONPATH=app python app/test/bench_s3_transfers.py
+"""
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from PIL import Image
+
+from utils.s3_utils import (
+    get_s3_client, get_transfer_config,
+    upload_files_to_s3, download_files_from_s3
+)
+
+BENCH_PREFIX = f"bench-transfers-{uuid.uuid4().hex[:8]}"
+SIZES = [5, 50, 200]
+
+
+def make_stickers(directory, count):
+    # Imágenes 1024x1024 con ruido para que el PNG tenga un tamaño realista
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"sticker_bench_{i}_high.png")
+        Image.effect_noise((1024, 1024), 64).convert('RGBA').save(path, format="PNG")
+        paths.append(path)
+    return paths
+
+
+def run(count):
+    bucket = os.getenv('AWS_S3_BUCKET_NAME')
+    s3_client = get_s3_client()
+    work_dir = tempfile.mkdtemp()
+    try:
+        paths = make_stickers(work_dir, count)
+        total_mb = sum(os.path.getsize(p) for p in paths) / 1024 / 1024
+        folder = f"{BENCH_PREFIX}/{count}"
+
+        start = time.perf_counter()
+        for path in paths:
+            s3_client.upload_file(path, bucket, f"{folder}/seq/{os.path.basename(path)}")
+        seq_upload = time.perf_counter() - start
+
+        start = time.perf_counter()
+        upload_files_to_s3([(p, None) for p in paths], folder=f"{folder}/batch")
+        batch_upload = time.perf_counter() - start
+
+        keys = [f"{folder}/batch/{os.path.basename(p)}" for p in paths]
+        download_dir = os.path.join(work_dir, 'download')
+        os.makedirs(download_dir)
+
+        start = time.perf_counter()
+        for key in keys:
+            s3_client.download_file(bucket, key, os.path.join(download_dir, os.path.basename(key)))
+        seq_download = time.perf_counter() - start
+
+        start = time.perf_counter()
+        download_files_from_s3([(k, os.path.join(download_dir, f"b_{os.path.basename(k)}")) for k in keys])
+        batch_download = time.perf_counter() - start
+
+        print(f"{count:>4} stickers ({total_mb:.1f} MB): "
+              f"upload seq {seq_upload:.2f}s / batch {batch_upload:.2f}s, "
+              f"download seq {seq_download:.2f}s / batch {batch_download:.2f}s")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def cleanup():
+    bucket = os.getenv('AWS_S3_BUCKET_NAME')
+    s3_client = get_s3_client()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{BENCH_PREFIX}/"):
+        objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if objects:
+            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+
+
+if __name__ == '__main__':
+    print(f"TransferConfig: {vars(get_transfer_config())}")
+    try:
+        for size in SIZES:
+            run(size)
+    finally:
+        cleanup()
@@ -1,105 +1,87 @@
 import time
 from datetime import datetime, timedelta
-from .dynamodb_utils import get_dynamodb_resource, USER_TABLE, TRANSACTION_TABLE, ADMIN_REQUEST_TABLE
+from .dynamodb_utils import USER_TABLE, TRANSACTION_TABLE, ADMIN_REQUEST_TABLE
+from .dynamodb_scan import scan_items, scan_count
+
+# Los KPIs recorren tablas completas: scans paralelos por segmentos que siguen
+# LastEvaluatedKey (una sola página se corta en 1 MB) y leen solo los atributos
+# necesarios (o Select='COUNT')
 
 def get_total_users():
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(USER_TABLE)
-    response = table.scan(Select='COUNT')
-    return response.get('Count', 0)
+    return scan_count(USER_TABLE)
 
 def get_new_users(days=7):
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(USER_TABLE)
     since = int(time.time()) - days * 86400
-    response = table.scan(
+    return scan_count(
+        USER_TABLE,
         FilterExpression='#created_at >= :since',
         ExpressionAttributeNames={'#created_at': 'created_at'},
-        ExpressionAttributeValues={':since': since},
-        Select='COUNT'
+        ExpressionAttributeValues={':since': since}
     )
-    return response.get('Count', 0)
 
 def get_active_users(days=1):
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(USER_TABLE)
     since = int(time.time()) - days * 86400
-    response = table.scan(
+    return scan_count(
+        USER_TABLE,
         FilterExpression='#last_login >= :since',
         ExpressionAttributeNames={'#last_login': 'last_login'},
-        ExpressionAttributeValues={':since': since},
-        Select='COUNT'
+        ExpressionAttributeValues={':since': since}
     )
-    return response.get('Count', 0)
 
 def get_total_transactions():
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(TRANSACTION_TABLE)
-    response = table.scan(Select='COUNT')
-    return response.get('Count', 0)
+    return scan_count(TRANSACTION_TABLE)
 
-def get_total_revenue():
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(TRANSACTION_TABLE)
-    # Solo sumar transacciones de tipo 'purchase' o 'coin_purchase_mp'
-    response = table.scan(
+def _purchase_amounts():
+    # Solo transacciones de tipo 'purchase' o 'coin_purchase_mp'
+    for item in scan_items(
+        TRANSACTION_TABLE,
         FilterExpression='transaction_type IN (:purchase, :coin_purchase)',
         ExpressionAttributeValues={
             ':purchase': 'purchase',
             ':coin_purchase': 'coin_purchase_mp'
-        }
-    )
-    total = 0
-    for item in response.get('Items', []):
-        total += int(item.get('coins_amount', 0))
-    return total
+        },
+        ProjectionExpression='coins_amount'
+    ):
+        yield int(item.get('coins_amount', 0))
+
+def get_total_revenue():
+    return sum(_purchase_amounts())
 
 def get_average_order_value():
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(TRANSACTION_TABLE)
-    response = table.scan(
-        FilterExpression='transaction_type IN (:purchase, :coin_purchase)',
-        ExpressionAttributeValues={
-            ':purchase': 'purchase',
-            ':coin_purchase': 'coin_purchase_mp'
-        }
-    )
     total = 0
     count = 0
-    for item in response.get('Items', []):
-        total += int(item.get('coins_amount', 0))
+    for amount in _purchase_amounts():
+        total += amount
         count += 1
     return (total / count) if count > 0 else 0
 
 def get_recent_admin_requests(limit=5):
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(ADMIN_REQUEST_TABLE)
-    response = table.scan(
+    items = scan_items(
+        ADMIN_REQUEST_TABLE,
         FilterExpression='#status = :pending',
         ExpressionAttributeNames={'#status': 'status'},
         ExpressionAttributeValues={':pending': 'pending'}
     )
     # Ordenar por fecha descendente y limitar
-    items = sorted(response.get('Items', []), key=lambda x: x.get('created_at', 0), reverse=True)
+    items = sorted(items, key=lambda x: x.get('created_at', 0), reverse=True)
     return items[:limit]
 
 def get_paid_users(days=30):
     """
     Cuenta la cantidad de usuarios únicos que compraron monedas en los últimos X días.
     """
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(TRANSACTION_TABLE)
     since = int(time.time()) - days * 86400
-    response = table.scan(
+    user_ids = set()
+    for item in scan_items(
+        TRANSACTION_TABLE,
         FilterExpression='transaction_type = :coin_purchase AND #timestamp >= :since',
         ExpressionAttributeNames={'#timestamp': 'timestamp'},
         ExpressionAttributeValues={
             ':coin_purchase': 'coin_purchase_mp',
             ':since': since
-        }
-    )
-    user_ids = set()
-    for item in response.get('Items', []):
+        },
+        ProjectionExpression='user_id'
+    ):
         if 'user_id' in item:
             user_ids.add(item['user_id'])
-    return len(user_ids) 
\ No newline at end of file
+    return len(user_ids)
@@ -0,0 +1,82 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from config import S3_CONTENT_FOLDER, CONTENT_KNOWN_KEYS_MAX
+
+# Content-addressed storage for sticker derivatives.
+# - Image bytes live once under {S3_CONTENT_FOLDER}/{sha256}{ext}; these
+#   objects never change, so they are cached as immutable.
+# - The sticker key ({S3_STICKERS_FOLDER}/{filename}) is a zero-byte reference
+#   object whose 'content-key' metadata points at the content object. Listings
+#   by owner keep working and readers dereference through s3_key_resolver.
+# - Content keys seen by this process are remembered (bounded LRU) so repeated
+#   uploads of the same bytes skip both put_object and head_object.
+
+CONTENT_KEY_METADATA = 'content-key'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_lock = threading.Lock()
+_known = OrderedDict()
+
+
+def content_key_for(data, filename):
+    """
+    Content-addressed key for some bytes, keeping the extension of filename
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    return f"{S3_CONTENT_FOLDER}/{hashlib.sha256(data).hexdigest()}{ext}"
+
+
+def is_known(content_key):
+    with _lock:
+        if content_key in _known:
+            _known.move_to_end(content_key)
+            return True
+        return False
+
+
+def mark_known(content_key):
+    with _lock:
+        _known[content_key] = True
+        _known.move_to_end(content_key)
+        while len(_known) > CONTENT_KNOWN_KEYS_MAX:
+            _known.popitem(last=False)
+
+
+def content_exists(s3_client, bucket, content_key):
+    """
+    True if the content object is already in S3 (remembered for next time)
+    """
+    if is_known(content_key):
+        return True
+    try:
+        s3_client.head_object(Bucket=bucket, Key=content_key)
+    except Exception as e:
+        status = getattr(e, 'response', {}).get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if status == 404:
+            return False
+        raise
+    mark_known(content_key)
+    return True
+
+
+def put_ref(s3_client, bucket, ref_key, content_key, content_type='image/png'):
+    """
+    Write the zero-byte reference object that maps a sticker key to its content
+    """
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=ref_key,
+        Body=b'',
+        ContentType=content_type,
+        Metadata={CONTENT_KEY_METADATA: content_key}
+    )
+
+
+def ref_target(head_response):
+    """
+    Content key from a head_object/get_object response, or None for a regular object
+    """
+    return (head_response.get('Metadata') or {}).get(CONTENT_KEY_METADATA)
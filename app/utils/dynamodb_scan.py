@@ -0,0 +1,122 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import dynamodb_utils, dynamodb_telemetry
+from config import DYNAMODB_SCAN_SEGMENTS, DYNAMODB_SCAN_MAX_WORKERS
+
+# Full-table scans with pagination and parallel segments.
+# - A scan returns at most 1 MB per call; every page is followed through
+#   LastEvaluatedKey, so results stay correct as tables grow.
+# - With segments > 1 the table is split with Segment/TotalSegments and the
+#   segments are read concurrently on a shared thread pool (the pool threads
+#   are reused, so their thread-local boto3 resources are too).
+# - Items are streamed through a generator with a bounded page queue: memory
+#   stays at a few pages, and closing the generator early (e.g. after the
+#   first match) stops the remaining segments.
+# - scan_count() uses Select='COUNT', which returns no items.
+
+_DONE = object()
+_PUT_TIMEOUT = 0.1
+
+_executor_lock = threading.Lock()
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=DYNAMODB_SCAN_MAX_WORKERS, thread_name_prefix='dynamodb-scan')
+    return _executor
+
+
+def _segment_pages(table, scan_kwargs, stop=None):
+    while stop is None or not stop.is_set():
+        response = table.scan(**scan_kwargs)
+        yield response
+        if 'LastEvaluatedKey' not in response:
+            return
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def _put(pages, item, stop):
+    # Si el consumidor dejó de leer, no quedarse bloqueado con la cola llena
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=_PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _scan_responses(table_name, segments, call_site, scan_kwargs):
+    if segments <= 1:
+        table = dynamodb_utils.get_table(table_name).for_call_site(call_site)
+        yield from _segment_pages(table, dict(scan_kwargs))
+        return
+
+    stop = threading.Event()
+    pages = queue.Queue(maxsize=segments * 2)
+
+    def read_segment(segment):
+        try:
+            table = dynamodb_utils.get_table(table_name).for_call_site(call_site)
+            kwargs = dict(scan_kwargs, Segment=segment, TotalSegments=segments)
+            for response in _segment_pages(table, kwargs, stop):
+                if not _put(pages, response, stop):
+                    return
+        except Exception as e:
+            _put(pages, e, stop)
+        finally:
+            _put(pages, _DONE, stop)
+
+    executor = _get_executor()
+    for segment in range(segments):
+        executor.submit(read_segment, segment)
+    try:
+        remaining = segments
+        while remaining:
+            response = pages.get()
+            if response is _DONE:
+                remaining -= 1
+            elif isinstance(response, Exception):
+                raise response
+            else:
+                yield response
+    finally:
+        stop.set()
+
+
+def scan_items(table_name, segments=None, call_site=None, **scan_kwargs):
+    """
+    Yield every item of a scan, following pagination.
+
+    Args:
+        table_name (str): DynamoDB table name
+        segments (int, optional): Parallel segments (default DYNAMODB_SCAN_SEGMENTS; 1 = sequential)
+        call_site (str, optional): Name for the capacity metrics (default: the caller)
+        **scan_kwargs: Scan parameters (FilterExpression, ProjectionExpression, Limit per page...)
+
+    Yields:
+        dict: Items, in no particular order when segments > 1
+    """
+    segments = segments or DYNAMODB_SCAN_SEGMENTS
+    call_site = call_site or dynamodb_telemetry.caller_site()
+    for response in _scan_responses(table_name, segments, call_site, scan_kwargs):
+        yield from response.get('Items', [])
+
+
+def scan_count(table_name, segments=None, call_site=None, **scan_kwargs):
+    """
+    Count the items matching a scan (Select='COUNT'), following pagination.
+
+    Returns:
+        int: Number of matching items
+    """
+    segments = segments or DYNAMODB_SCAN_SEGMENTS
+    call_site = call_site or dynamodb_telemetry.caller_site()
+    scan_kwargs['Select'] = 'COUNT'
+    return sum(response.get('Count', 0) for response in _scan_responses(table_name, segments, call_site, scan_kwargs))
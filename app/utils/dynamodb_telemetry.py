@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+import logging
+from functools import partial
+from botocore.exceptions import ClientError
+
+from config import (
+    DYNAMODB_RETRY_DEADLINE, DYNAMODB_RETRY_BASE_DELAY, DYNAMODB_RETRY_MAX_DELAY,
+    DYNAMODB_METRICS_LOG_INTERVAL
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Throttling-aware retries and consumed-capacity telemetry for DynamoDB.
+# - Every table call (get_table() returns an InstrumentedTable) and the
+#   client calls wrapped with call() ask for ReturnConsumedCapacity=INDEXES.
+#   The units are added up per call site (module.function), per table and per
+#   index.
+# - botocore already retries throttling with the adaptive mode. Once it gives
+#   up, the call is retried here with full-jitter exponential backoff while
+#   the DYNAMODB_RETRY_DEADLINE budget lasts. After that it raises
+#   DynamoDBThrottledError (a 503 in Flask) instead of a generic 500.
+# - Every DYNAMODB_METRICS_LOG_INTERVAL seconds a 'dynamodb_metrics' JSON line
+#   is logged: units consumed, peak units per second per table, throttles and
+#   latency. Totals vs peaks tell whether provisioned or on-demand is cheaper.
+#   The same data is available from get_dynamodb_stats().
+
+THROTTLING_ERROR_CODES = {
+    'ProvisionedThroughputExceededException', 'ThrottlingException',
+    'RequestLimitExceeded', 'LimitExceededException'
+}
+# Códigos de CancellationReasons de TransactWriteItems que indican throttling
+_TRANSACTION_THROTTLING_CODES = {'ThrottlingError', 'ProvisionedThroughputExceeded', 'RequestLimitExceeded'}
+
+CAPACITY_OPERATIONS = {
+    'get_item', 'put_item', 'update_item', 'delete_item', 'query', 'scan',
+    'batch_get_item', 'batch_write_item', 'transact_get_items', 'transact_write_items'
+}
+_READ_OPERATIONS = {'get_item', 'query', 'scan', 'batch_get_item', 'transact_get_items'}
+
+
+class DynamoDBThrottledError(Exception):
+    """
+    A DynamoDB call was still throttled when the retry deadline ran out
+    """
+    def __init__(self, call_site, operation, attempts, elapsed):
+        super().__init__(f"DynamoDB {operation} throttled at {call_site} after {attempts} attempts ({elapsed:.2f}s)")
+        self.call_site = call_site
+        self.operation = operation
+        self.attempts = attempts
+        self.elapsed = elapsed
+
+
+_lock = threading.Lock()
+_started_at = time.time()
+_sites = {}
+_tables = {}
+_last_log = time.time()
+
+
+def _new_site():
+    return {'calls': 0, 'errors': 0, 'throttled': 0, 'retries': 0, 'gave_up': 0,
+            'read_units': 0.0, 'write_units': 0.0, 'latency_ms': 0.0}
+
+
+def _new_table():
+    return {'read_units': 0.0, 'write_units': 0.0, 'peak_read_units_per_second': 0.0,
+            'peak_write_units_per_second': 0.0, 'indexes': {}, '_second': 0, '_second_read': 0.0, '_second_write': 0.0}
+
+
+def is_throttling_error(error):
+    if not isinstance(error, ClientError):
+        return False
+    code = error.response.get('Error', {}).get('Code')
+    if code in THROTTLING_ERROR_CODES:
+        return True
+    if code == 'TransactionCanceledException':
+        reasons = {reason.get('Code') for reason in error.response.get('CancellationReasons', [])}
+        return bool(reasons & _TRANSACTION_THROTTLING_CODES) and reasons <= _TRANSACTION_THROTTLING_CODES | {'None', None}
+    return False
+
+
+def _record_capacity(operation, consumed):
+    # consumed: dict (operaciones simples) o lista (batch/transact)
+    entries = consumed if isinstance(consumed, list) else [consumed]
+    is_read = operation in _READ_OPERATIONS
+    total = 0.0
+    now_second = int(time.time())
+    for entry in entries:
+        units = float(entry.get('CapacityUnits', 0) or 0)
+        total += units
+        table = _tables.setdefault(entry.get('TableName', '?'), _new_table())
+        unit_key = 'read_units' if is_read else 'write_units'
+        table[unit_key] += units
+        # Pico por segundo: lo que habría que aprovisionar
+        if table['_second'] != now_second:
+            table['_second'], table['_second_read'], table['_second_write'] = now_second, 0.0, 0.0
+        second_key = '_second_read' if is_read else '_second_write'
+        table[second_key] += units
+        peak_key = 'peak_read_units_per_second' if is_read else 'peak_write_units_per_second'
+        table[peak_key] = max(table[peak_key], table[second_key])
+        for index_name, index in (entry.get('GlobalSecondaryIndexes') or {}).items():
+            table['indexes'][index_name] = table['indexes'].get(index_name, 0.0) + float(index.get('CapacityUnits', 0) or 0)
+    return total
+
+
+def _record(call_site, operation, elapsed, consumed=None, throttled=0, retries=0, error=False, gave_up=False):
+    with _lock:
+        site = _sites.setdefault(f"{call_site}:{operation}", _new_site())
+        site['calls'] += 1
+        site['throttled'] += throttled
+        site['retries'] += retries
+        site['latency_ms'] += elapsed * 1000
+        if error:
+            site['errors'] += 1
+        if gave_up:
+            site['gave_up'] += 1
+        if consumed:
+            units = _record_capacity(operation, consumed)
+            site['read_units' if operation in _READ_OPERATIONS else 'write_units'] += units
+    _maybe_log()
+
+
+def _maybe_log():
+    global _last_log
+    now = time.time()
+    if now - _last_log < DYNAMODB_METRICS_LOG_INTERVAL:
+        return
+    with _lock:
+        if now - _last_log < DYNAMODB_METRICS_LOG_INTERVAL:
+            return
+        _last_log = now
+    logger.info("dynamodb_metrics %s", json.dumps(get_dynamodb_stats(), separators=(',', ':')))
+
+
+def call(call_site, operation, method, **kwargs):
+    """
+    Run a DynamoDB call with capacity telemetry and throttling retries.
+
+    Args:
+        call_site (str): Name used to aggregate the metrics (e.g. 'dynamodb_utils.get_user')
+        operation (str): boto3 operation name (e.g. 'query')
+        method (callable): Bound boto3 method
+        **kwargs: Arguments for the call
+
+    Raises:
+        DynamoDBThrottledError: If still throttled when the deadline runs out
+    """
+    if operation in CAPACITY_OPERATIONS:
+        kwargs.setdefault('ReturnConsumedCapacity', 'INDEXES')
+
+    start = time.monotonic()
+    deadline = start + DYNAMODB_RETRY_DEADLINE
+    attempt = 0
+    while True:
+        try:
+            response = method(**kwargs)
+        except ClientError as e:
+            if not is_throttling_error(e):
+                _record(call_site, operation, time.monotonic() - start, throttled=attempt, retries=attempt, error=True)
+                raise
+            # Full jitter: espera aleatoria entre 0 y el backoff exponencial
+            delay = random.uniform(0, min(DYNAMODB_RETRY_MAX_DELAY, DYNAMODB_RETRY_BASE_DELAY * (2 ** attempt)))
+            if time.monotonic() + delay > deadline:
+                elapsed = time.monotonic() - start
+                _record(call_site, operation, elapsed, throttled=attempt + 1, retries=attempt, error=True, gave_up=True)
+                logger.warning(f"DynamoDB {operation} throttled at {call_site}, giving up after {attempt + 1} attempts")
+                raise DynamoDBThrottledError(call_site, operation, attempt + 1, elapsed) from e
+            attempt += 1
+            time.sleep(delay)
+            continue
+        _record(call_site, operation, time.monotonic() - start, consumed=response.get('ConsumedCapacity'),
+                throttled=attempt, retries=attempt)
+        return response
+
+
+def caller_site(depth=2):
+    """
+    'module.function' of the frame `depth` levels up (2: the caller's caller)
+    """
+    frame = sys._getframe(depth)
+    module = frame.f_globals.get('__name__', '?').rsplit('.', 1)[-1]
+    return f"{module}.{frame.f_code.co_name}"
+
+
+class InstrumentedTable:
+    """
+    boto3 Table whose item operations go through call(); the call site is the
+    calling function unless one is fixed with for_call_site(). Everything else
+    is forwarded to the Table.
+    """
+    _OPERATIONS = {'get_item', 'put_item', 'update_item', 'delete_item', 'query', 'scan'}
+
+    def __init__(self, table, call_site=None):
+        self._table = table
+        self._call_site = call_site
+
+    def for_call_site(self, call_site):
+        return InstrumentedTable(self._table, call_site)
+
+    def __getattr__(self, name):
+        attr = getattr(self._table, name)
+        if name in self._OPERATIONS:
+            return partial(call, self._call_site or caller_site(), name, attr)
+        return attr
+
+
+def get_dynamodb_stats():
+    """
+    Consumed capacity, throttles and latency for this worker process
+    """
+    with _lock:
+        elapsed = max(time.time() - _started_at, 1e-9)
+        sites = {}
+        for name, site in _sites.items():
+            site = dict(site)
+            site['avg_latency_ms'] = site.pop('latency_ms') / site['calls'] if site['calls'] else 0.0
+            sites[name] = site
+        tables = {}
+        for name, table in _tables.items():
+            table = {key: value for key, value in table.items() if not key.startswith('_')}
+            table['indexes'] = dict(table['indexes'])
+            table['avg_read_units_per_second'] = table['read_units'] / elapsed
+            table['avg_write_units_per_second'] = table['write_units'] / elapsed
+            tables[name] = table
+    return {
+        'pid': os.getpid(),
+        'window_seconds': elapsed,
+        'call_sites': sites,
+        'tables': tables
+    }
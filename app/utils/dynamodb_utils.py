@@ -1,15 +1,28 @@
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import threading
+import queue
+import weakref
 import uuid
 import time
 import json
+import base64
+from decimal import Decimal
 import random
 import string
 from datetime import datetime
+from utils import request_identity_map, user_cache, dynamodb_telemetry, dynamodb_scan
 from config import (
     INITIAL_COINS, BONUS_COINS,
     AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION,
-    DYNAMODB_USER_TABLE, DYNAMODB_TRANSACTION_TABLE, DYNAMODB_REQUEST_TABLE, DYNAMODB_COUPONES_TABLE
+    DYNAMODB_USER_TABLE, DYNAMODB_TRANSACTION_TABLE, DYNAMODB_REQUEST_TABLE, DYNAMODB_COUPONES_TABLE,
+    DYNAMODB_PAYMENT_KEYS_TABLE, DYNAMODB_LOGIN_PIN_TABLE, PAYMENT_KEYS_BACKFILLED,
+    DYNAMODB_MAX_POOL_CONNECTIONS, DYNAMODB_RESOURCE_POOL_SIZE, DYNAMODB_CONNECT_TIMEOUT, DYNAMODB_READ_TIMEOUT,
+    DYNAMODB_MAX_ATTEMPTS, DYNAMODB_RETRY_MODE, DYNAMODB_ENDPOINT_URL,
+    EMAIL_INDEX_STATUS_TTL, EMAIL_INDEX_POLL_INTERVAL, DYNAMODB_TRANSACTION_MAX_ATTEMPTS
 )
 
 # Define table variables from config
@@ -17,6 +30,28 @@ USER_TABLE = DYNAMODB_USER_TABLE
 TRANSACTION_TABLE = DYNAMODB_TRANSACTION_TABLE
 ADMIN_REQUEST_TABLE = DYNAMODB_REQUEST_TABLE
 COUPON_TABLE = DYNAMODB_COUPONES_TABLE
+PAYMENT_KEYS_TABLE = DYNAMODB_PAYMENT_KEYS_TABLE
+LOGIN_PIN_TABLE = DYNAMODB_LOGIN_PIN_TABLE
+
+# Historial de transacciones por usuario ordenado por tiempo (user_id + timestamp)
+TRANSACTION_TIME_INDEX = 'UserTimestampIndex'
+TRANSACTION_TIME_INDEX_DEFINITION = {
+    'IndexName': TRANSACTION_TIME_INDEX,
+    'KeySchema': [
+        {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+        {'AttributeName': 'timestamp', 'KeyType': 'RANGE'},
+    ],
+    'Projection': {
+        'ProjectionType': 'ALL'
+    },
+    'ProvisionedThroughput': {
+        'ReadCapacityUnits': 5,
+        'WriteCapacityUnits': 5
+    }
+}
+# Campos de la vista de lista del historial
+TRANSACTION_LIST_FIELDS = ('transaction_id', 'transaction_type', 'coins_amount', 'timestamp', 'date', 'coupon_code')
+TRANSACTION_PAGE_MAX = 100
 
 # Function to check if table is ready (not in CREATING or UPDATING state)
 def is_table_ready(table_name):
@@ -29,12 +64,64 @@ def is_table_ready(table_name):
         print(f"Error checking table status: {e}")
         return False
 
+# Estado del EmailIndex cacheado: describe_table es una API de control con
+# límites de tasa bajos, así que no se llama en cada búsqueda por email.
+# - verify_email_index() (al arrancar) guarda el resultado.
+# - Mientras el índice se construye, un hilo en segundo plano lo vuelve a
+#   comprobar cada EMAIL_INDEX_POLL_INTERVAL segundos.
+# - Un índice activo se revalida en segundo plano tras EMAIL_INDEX_STATUS_TTL.
+_email_index_lock = threading.Lock()
+_email_index_ready = None
+_email_index_checked_at = 0.0
+_email_index_refreshing = False
+
+def _set_email_index_status(ready):
+    global _email_index_ready, _email_index_checked_at
+    with _email_index_lock:
+        _email_index_ready = ready
+        _email_index_checked_at = time.time()
+
+def _refresh_email_index_status():
+    global _email_index_refreshing
+    try:
+        while not verify_email_index():
+            time.sleep(EMAIL_INDEX_POLL_INTERVAL)
+        print("EmailIndex is ACTIVE")
+    finally:
+        with _email_index_lock:
+            _email_index_refreshing = False
+
+def start_email_index_refresh():
+    global _email_index_refreshing
+    with _email_index_lock:
+        if _email_index_refreshing:
+            return
+        _email_index_refreshing = True
+    threading.Thread(target=_refresh_email_index_status, name='email-index-status', daemon=True).start()
+
+def email_index_ready():
+    """
+    Cached EmailIndex status. Only the first call (if verify_email_index()
+    didn't run at startup) hits describe_table synchronously.
+    """
+    if _email_index_ready is None:
+        return verify_email_index()
+    if not _email_index_ready or time.time() - _email_index_checked_at > EMAIL_INDEX_STATUS_TTL:
+        start_email_index_refresh()
+    return _email_index_ready
+
 # Function to verify EmailIndex exists
 def verify_email_index():
     """
     Verify the EmailIndex exists on the user table, try to fix if not.
     Returns True if index exists or was created, False otherwise.
+    The result is cached for email_index_ready().
     """
+    ready = _check_email_index()
+    _set_email_index_status(ready)
+    return ready
+
+def _check_email_index():
     dynamodb = get_dynamodb_client()
     
     try:
@@ -101,51 +188,107 @@ def find_user_by_email_scan(email):
     """
     Fallback method to find a user by email using scan instead of query
     """
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(USER_TABLE)
-    
-    response = table.scan(
-        FilterExpression=Attr('email').eq(email)
+    # Todas las páginas y segmentos; se detiene en la primera coincidencia
+    items = dynamodb_scan.scan_items(USER_TABLE, FilterExpression=Attr('email').eq(email))
+    try:
+        return next(items, None)
+    finally:
+        items.close()
+
+# Handles de DynamoDB reutilizables.
+# - El client de boto3 es thread-safe: uno por proceso.
+# - Los resources (y sus Table) no lo son: cada hilo usa uno en exclusiva,
+#   creado con su propia Session. Cuando el hilo termina (el servidor de
+#   desarrollo crea uno por petición) el resource vuelve a un pool compartido
+#   de hasta DYNAMODB_RESOURCE_POOL_SIZE, así que el siguiente hilo lo reutiliza
+#   con sus Table ya construidos en lugar de crearlo de nuevo.
+# - botocore Config ajustado: pool de conexiones, timeouts cortos y reintentos
+#   adaptativos (con rate limiting en el cliente ante throttling).
+# - Cada llamada se cuenta en la petición en curso (cabecera de depuración).
+# - Los Table se envuelven en InstrumentedTable: reintentos ante throttling y
+#   capacidad consumida por punto de llamada (utils/dynamodb_telemetry.py).
+_client_lock = threading.Lock()
+_client = None
+_local = threading.local()
+_resource_pool = queue.LifoQueue(maxsize=DYNAMODB_RESOURCE_POOL_SIZE)
+
+def _dynamodb_config():
+    return Config(
+        max_pool_connections=DYNAMODB_MAX_POOL_CONNECTIONS,
+        connect_timeout=DYNAMODB_CONNECT_TIMEOUT,
+        read_timeout=DYNAMODB_READ_TIMEOUT,
+        retries={'max_attempts': DYNAMODB_MAX_ATTEMPTS, 'mode': DYNAMODB_RETRY_MODE}
     )
-    
-    items = response.get('Items', [])
-    return items[0] if items else None
+
+def _session_kwargs():
+    if not AWS_ACCESS_KEY_ID or not AWS_SECRET_ACCESS_KEY:
+        raise ValueError("AWS credentials not found in environment variables")
+    return {
+        'aws_access_key_id': AWS_ACCESS_KEY_ID,
+        'aws_secret_access_key': AWS_SECRET_ACCESS_KEY,
+        'region_name': AWS_REGION
+    }
 
 def get_dynamodb_client():
     """
-    Returns a boto3 DynamoDB client using environment variables for credentials.
+    Returns the process-wide boto3 DynamoDB client (created on first use).
     """
-    aws_access_key = AWS_ACCESS_KEY_ID
-    aws_secret_key = AWS_SECRET_ACCESS_KEY
-    aws_region = AWS_REGION
-    
-    if not aws_access_key or not aws_secret_key:
-        raise ValueError("AWS credentials not found in environment variables")
-    
-    return boto3.client(
-        'dynamodb',
-        aws_access_key_id=aws_access_key,
-        aws_secret_access_key=aws_secret_key,
-        region_name=aws_region
-    )
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                session = boto3.session.Session(**_session_kwargs())
+                _client = session.client('dynamodb', config=_dynamodb_config(), endpoint_url=DYNAMODB_ENDPOINT_URL)
+                _client.meta.events.register('before-call.dynamodb', request_identity_map.count_dynamodb_call)
+    return _client
+
+def _release_handles(handles):
+    # El hilo terminó: nadie más usa este resource, se devuelve al pool (o se descarta si está lleno)
+    try:
+        _resource_pool.put_nowait(handles)
+    except queue.Full:
+        pass
+
+class _ThreadHandles:
+    """
+    Resource and Table handles lent to one thread; returned to the pool when
+    the thread ends and its thread-local storage is released.
+    """
+    def __init__(self):
+        try:
+            self.resource, self.tables = _resource_pool.get_nowait()
+        except queue.Empty:
+            session = boto3.session.Session(**_session_kwargs())
+            self.resource = session.resource('dynamodb', config=_dynamodb_config(), endpoint_url=DYNAMODB_ENDPOINT_URL)
+            self.resource.meta.client.meta.events.register('before-call.dynamodb', request_identity_map.count_dynamodb_call)
+            self.tables = {}
+        weakref.finalize(self, _release_handles, (self.resource, self.tables))
+
+def _thread_handles():
+    handles = getattr(_local, 'handles', None)
+    if handles is None:
+        handles = _ThreadHandles()
+        _local.handles = handles
+    return handles
 
 def get_dynamodb_resource():
     """
-    Returns a boto3 DynamoDB resource using environment variables for credentials.
+    Returns the boto3 DynamoDB resource of the current thread (taken from the
+    shared pool or created on first use).
     """
-    aws_access_key = AWS_ACCESS_KEY_ID
-    aws_secret_key = AWS_SECRET_ACCESS_KEY
-    aws_region = AWS_REGION
-    
-    if not aws_access_key or not aws_secret_key:
-        raise ValueError("AWS credentials not found in environment variables")
-    
-    return boto3.resource(
-        'dynamodb',
-        aws_access_key_id=aws_access_key,
-        aws_secret_access_key=aws_secret_key,
-        region_name=aws_region
-    )
+    return _thread_handles().resource
+
+def get_table(table_name):
+    """
+    Returns a cached Table handle for the current thread.
+    """
+    handles = _thread_handles()
+    resource = handles.resource
+    table = handles.tables.get(table_name)
+    if table is None:
+        table = dynamodb_telemetry.InstrumentedTable(resource.Table(table_name))
+        handles.tables[table_name] = table
+    return table
 
 def ensure_tables_exist():
     """
@@ -199,8 +342,10 @@ def ensure_tables_exist():
                 {'AttributeName': 'user_id', 'AttributeType': 'S'},
                 {'AttributeName': 'payment_id', 'AttributeType': 'S'},  # Nuevo atributo para payment_id
                 {'AttributeName': 'coupon_code', 'AttributeType': 'S'},  # Nuevo campo para cupones
+                {'AttributeName': 'timestamp', 'AttributeType': 'N'},
             ],
             GlobalSecondaryIndexes=[
+                TRANSACTION_TIME_INDEX_DEFINITION,
                 {
                     'IndexName': 'UserIdIndex',
                     'KeySchema': [
@@ -307,6 +452,26 @@ def ensure_tables_exist():
                 print(f"PaymentIdIndex added to {TRANSACTION_TABLE}")
         except Exception as e:
             print(f"Error checking/updating PaymentIdIndex: {e}")
+        
+        # Índice por user_id + timestamp para el historial paginado. DynamoDB lo
+        # rellena en línea con las transacciones existentes; mientras tanto las
+        # lecturas usan UserIdIndex (ver transactions_index_ready)
+        try:
+            table_description = dynamodb.meta.client.describe_table(TableName=TRANSACTION_TABLE)
+            index_names = [index['IndexName'] for index in table_description['Table'].get('GlobalSecondaryIndexes', [])]
+            if TRANSACTION_TIME_INDEX not in index_names:
+                print(f"Adding {TRANSACTION_TIME_INDEX} to {TRANSACTION_TABLE}...")
+                dynamodb.meta.client.update_table(
+                    TableName=TRANSACTION_TABLE,
+                    AttributeDefinitions=[
+                        {'AttributeName': 'user_id', 'AttributeType': 'S'},
+                        {'AttributeName': 'timestamp', 'AttributeType': 'N'},
+                    ],
+                    GlobalSecondaryIndexUpdates=[{'Create': TRANSACTION_TIME_INDEX_DEFINITION}]
+                )
+                print(f"{TRANSACTION_TIME_INDEX} added to {TRANSACTION_TABLE}")
+        except Exception as e:
+            print(f"Error checking/updating {TRANSACTION_TIME_INDEX}: {e}")
 
     # Tabla de solicitudes de admin
     if ADMIN_REQUEST_TABLE not in existing_tables:
@@ -358,6 +523,47 @@ def ensure_tables_exist():
         )
         print(f"Created table {COUPON_TABLE}")
 
+    # Tabla de claves de idempotencia de pagos
+    if PAYMENT_KEYS_TABLE not in existing_tables:
+        dynamodb.create_table(
+            TableName=PAYMENT_KEYS_TABLE,
+            KeySchema=[
+                {'AttributeName': 'payment_id', 'KeyType': 'HASH'},  # Partition key
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'payment_id', 'AttributeType': 'S'},
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 5,
+                'WriteCapacityUnits': 5
+            }
+        )
+        print(f"Created table {PAYMENT_KEYS_TABLE}")
+        # Los pagos ya registrados en el ledger se migran aparte (backfill-payment-keys)
+
+    # Tabla de PINs de login: uno por email, borrados por el TTL nativo de DynamoDB
+    if LOGIN_PIN_TABLE not in existing_tables:
+        dynamodb.create_table(
+            TableName=LOGIN_PIN_TABLE,
+            KeySchema=[
+                {'AttributeName': 'email', 'KeyType': 'HASH'},  # Partition key
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'email', 'AttributeType': 'S'},
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 5,
+                'WriteCapacityUnits': 5
+            }
+        )
+        print(f"Created table {LOGIN_PIN_TABLE}")
+        dynamodb.meta.client.get_waiter('table_exists').wait(TableName=LOGIN_PIN_TABLE)
+        dynamodb.meta.client.update_time_to_live(
+            TableName=LOGIN_PIN_TABLE,
+            TimeToLiveSpecification={'Enabled': True, 'AttributeName': 'expires_at'}
+        )
+        print(f"Enabled TTL on {LOGIN_PIN_TABLE}")
+
 # User Management Functions
 def create_user(email, initial_coins=None, name=None, role='user', referral=None):
     """
@@ -373,8 +579,7 @@ def create_user(email, initial_coins=None, name=None, role='user', referral=None
     Returns:
         dict: User data including user_id
     """
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(USER_TABLE)
+    table = get_table(USER_TABLE)
     
     # Check if user with this email already exists
     existing_user = get_user_by_email(email)
@@ -408,33 +613,69 @@ def create_user(email, initial_coins=None, name=None, role='user', referral=None
         user_data['referral'] = referral
     
     table.put_item(Item=user_data)
-    return user_data
+    return _user_written(user_data)
 
 def get_user(user_id):
     """
-    Get user by user_id
+    Get user by user_id (read once per request, see request_identity_map)
     
     Args:
         user_id (str): User ID to lookup
         
     Returns:
         dict or None: User data if found, None otherwise
+        
+    Raises:
+        DynamoDBThrottledError: If the read is still throttled after retries
+        ClientError: On DynamoDB errors other than a missing table
     """
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(USER_TABLE)
+    cached = request_identity_map.lookup(user_id=user_id)
+    if not request_identity_map.is_missing(cached):
+        return cached
+    
+    table = get_table(USER_TABLE)
     
     try:
         response = table.get_item(
             Key={'user_id': user_id}
         )
         
-        return response.get('Item')
+        return request_identity_map.remember(response.get('Item'), user_id=user_id)
+    except dynamodb_telemetry.DynamoDBThrottledError:
+        # Throttling no es "usuario inexistente": el handler de la app responde 503
+        raise
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'ResourceNotFoundException':
+            raise
+        return None
     except Exception:
         return None
 
+def get_user_cached(user_id):
+    """
+    Get user by user_id for balance/profile reads, through the short-TTL
+    user cache (may be up to USER_CACHE_TTL seconds old). Reads that are
+    followed by a write should use get_user.
+    
+    Args:
+        user_id (str): User ID to lookup
+        
+    Returns:
+        dict or None: User data if found, None otherwise
+    """
+    cached = request_identity_map.lookup(user_id=user_id)
+    if not request_identity_map.is_missing(cached):
+        return cached
+    
+    user = user_cache.get(user_id)
+    if user is None:
+        user = get_user(user_id)
+        user_cache.put(user)
+    return user
+
 def get_user_by_email(email):
     """
-    Get user by email
+    Get user by email (read once per request, see request_identity_map)
     
     Args:
         email (str): Email to lookup
@@ -442,14 +683,17 @@ def get_user_by_email(email):
     Returns:
         dict or None: User data if found, None otherwise
     """
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(USER_TABLE)
+    cached = request_identity_map.lookup(email=email)
+    if not request_identity_map.is_missing(cached):
+        return cached
+    
+    table = get_table(USER_TABLE)
     
-    # First try to verify that the index exists
-    if not verify_email_index():
+    # Estado del índice cacheado (sin describe_table en cada búsqueda)
+    if not email_index_ready():
         # If index doesn't exist or is being created, use scan as fallback
         print(f"Using scan fallback to find user with email {email}")
-        return find_user_by_email_scan(email)
+        return request_identity_map.remember(find_user_by_email_scan(email), email=email)
     
     try:
         # Query the email GSI
@@ -459,12 +703,22 @@ def get_user_by_email(email):
         )
         
         items = response.get('Items', [])
-        return items[0] if items else None
+        return request_identity_map.remember(items[0] if items else None, email=email)
+    except dynamodb_telemetry.DynamoDBThrottledError:
+        # Con la tabla saturada un scan completo solo empeora las cosas
+        raise
     except Exception as e:
         print(f"Error querying EmailIndex: {e}, falling back to scan")
-        return find_user_by_email_scan(email)
+        # El índice puede haber desaparecido: volver a comprobarlo en segundo plano
+        start_email_index_refresh()
+        return request_identity_map.remember(find_user_by_email_scan(email), email=email)
 
 
+def _user_written(user):
+    # Escritura con el item completo (ALL_NEW o saldo calculado): actualizar las caches
+    user_cache.put(user)
+    return request_identity_map.remember(user)
+
 def update_user_last_login(user_id):
     """
     Update a user's last login timestamp
@@ -475,8 +729,7 @@ def update_user_last_login(user_id):
     Returns:
         dict: Updated user data
     """
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(USER_TABLE)
+    table = get_table(USER_TABLE)
     
     timestamp = int(time.time())
     
@@ -489,7 +742,7 @@ def update_user_last_login(user_id):
         ReturnValues='ALL_NEW'
     )
     
-    return response.get('Attributes')
+    return _user_written(response.get('Attributes'))
 
 # Pin generation and verification
 def generate_pin(length=6):
@@ -508,6 +761,9 @@ def store_login_pin(email, pin, expiry_seconds=600, create_if_not_exists=False):
     """
     Store a login PIN for a user
     
+    The PIN goes to LOGIN_PIN_TABLE (one item per email, replacing any
+    previous PIN); DynamoDB's TTL deletes it once expired.
+    
     Args:
         email (str): User's email
         pin (str): The PIN to store
@@ -517,10 +773,7 @@ def store_login_pin(email, pin, expiry_seconds=600, create_if_not_exists=False):
     Returns:
         tuple: (bool success, bool user_exists)
     """
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(USER_TABLE)
-    
-    # Get user by email
+    # Get user by email (normalmente ya leído en esta petición)
     user = get_user_by_email(email)
     is_new_user = False
     
@@ -533,34 +786,26 @@ def store_login_pin(email, pin, expiry_seconds=600, create_if_not_exists=False):
         user = create_user(email, BONUS_COINS)
         is_new_user = True
     
-    user_id = user['user_id']
-    expiry_time = int(time.time()) + expiry_seconds
-    
-    # Update user with PIN and new user flag if applicable
-    update_expression = 'SET login_pin = :pin, pin_expiry = :expiry'
-    expression_values = {
-        ':pin': pin,
-        ':expiry': expiry_time
+    pin_record = {
+        'email': email,
+        'pin': pin,
+        'user_id': user['user_id'],
+        'expires_at': int(time.time()) + expiry_seconds
     }
-    
     if is_new_user:
-        update_expression += ', is_new_user = :is_new'
-        expression_values[':is_new'] = True
+        pin_record['is_new_user'] = True
     
-    # Update user with PIN
-    response = table.update_item(
-        Key={'user_id': user_id},
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_values,
-        ReturnValues='UPDATED_NEW'
-    )
-    
-    return bool(response.get('Attributes')), True
+    get_table(LOGIN_PIN_TABLE).put_item(Item=pin_record)
+    return True, True
 
 def verify_login_pin(email, pin):
     """
     Verify a login PIN for a user
     
+    One conditional delete consumes the PIN (so it can't be reused) and
+    returns the stored record; one update then records the login and
+    returns the user.
+    
     Args:
         email (str): User's email
         pin (str): The PIN to verify
@@ -568,48 +813,95 @@ def verify_login_pin(email, pin):
     Returns:
         dict or None: User data if PIN is valid, None otherwise
     """
-    user = get_user_by_email(email)
-    if not user:
+    pins = get_table(LOGIN_PIN_TABLE)
+    current_time = int(time.time())
+    
+    try:
+        # El TTL de DynamoDB puede tardar en borrar: la caducidad se comprueba aquí
+        response = pins.delete_item(
+            Key={'email': email},
+            ConditionExpression='pin = :pin AND expires_at > :now',
+            ExpressionAttributeValues={':pin': pin, ':now': current_time},
+            ReturnValues='ALL_OLD'
+        )
+    except pins.meta.client.exceptions.ConditionalCheckFailedException:
         return None
     
-    stored_pin = user.get('login_pin')
-    pin_expiry = user.get('pin_expiry', 0)
-    current_time = int(time.time())
-    is_new_user = user.get('is_new_user', False)
+    pin_record = response.get('Attributes')
+    if not pin_record:
+        return None
     
-    if stored_pin == pin and current_time < pin_expiry:
-        # Update last login time
-        updated_user = update_user_last_login(user['user_id'])
-        
-        # Remove the PIN after successful verification, but keep is_new_user if it exists
-        dynamodb = get_dynamodb_resource()
-        table = dynamodb.Table(USER_TABLE)
-        
-        # Choose update expression based on whether this is a new user
-        if is_new_user:
-            table.update_item(
-                Key={'user_id': user['user_id']},
-                UpdateExpression='REMOVE login_pin, pin_expiry'
-            )
-            
-            # Ensure is_new_user is set in the updated user
-            if updated_user and 'is_new_user' not in updated_user:
-                updated_user['is_new_user'] = True
-        else:
-            table.update_item(
-                Key={'user_id': user['user_id']},
-                UpdateExpression='REMOVE login_pin, pin_expiry, is_new_user'
-            )
-        
-        return updated_user
+    # Update last login time (y limpiar campos de PIN del formato anterior)
+    table = get_table(USER_TABLE)
+    try:
+        response = table.update_item(
+            Key={'user_id': pin_record['user_id']},
+            UpdateExpression='SET last_login = :timestamp REMOVE login_pin, pin_expiry, is_new_user',
+            ConditionExpression='attribute_exists(user_id)',
+            ExpressionAttributeValues={':timestamp': current_time},
+            ReturnValues='ALL_NEW'
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None
     
-    return None
+    updated_user = _user_written(response.get('Attributes'))
+    if updated_user and pin_record.get('is_new_user'):
+        # Usuario creado al pedir el PIN: solo en su primer login
+        updated_user = dict(updated_user, is_new_user=True)
+    return updated_user
 
 # Transaction Management Functions
-def create_transaction(user_id, coins_amount, transaction_type, details=None, payment_id=None, coupon_code=None):
+class InsufficientCoinsError(ValueError):
+    """
+    The balance change would leave the user with negative coins
+    """
+
+# Serialización al formato de bajo nivel que usa transact_write_items
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+def _serialize_item(item):
+    return {key: _serializer.serialize(value) for key, value in item.items()}
+
+def _deserialize_item(item):
+    return {key: _deserializer.deserialize(value) for key, value in item.items()}
+
+def _to_number(value):
+    # TypeSerializer no acepta float (p.ej. usuarios ya pasados por sanitize_dynamodb_response)
+    return Decimal(str(value)) if isinstance(value, float) else value
+
+def _transaction_id_for(idempotency_key):
+    # Id determinista: reintentar la misma operación choca con attribute_not_exists
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"thestickerhouse:transaction:{idempotency_key}"))
+
+def _cancellation_reasons(error):
+    return error.response.get('CancellationReasons', [])
+
+def _existing_transaction(transaction_id, fallback):
+    existing = get_table(TRANSACTION_TABLE).get_item(
+        Key={'transaction_id': transaction_id}, ConsistentRead=True
+    ).get('Item') or fallback
+    # Marcar la transacción como existente para poder distinguirla
+    existing['is_existing'] = True
+    return existing
+
+def create_transaction(user_id, coins_amount, transaction_type, details=None, payment_id=None, coupon_code=None,
+                       user=None, idempotency_key=None):
     """
     Record a transaction in the transaction table and update user's coin balance
     
+    The ledger insert and the balance change are a single TransactWriteItems:
+    the balance is changed with ADD, conditioned on the balance the caller last
+    saw, so the new balance is known without reading it back. If another write
+    got there first, the cancellation returns the current user item and the
+    write is retried with it.
+    
+    With a payment_id the same transaction also puts the payment key
+    (attribute_not_exists), so a duplicate webhook is rejected atomically
+    instead of by a lookup on the eventually consistent PaymentIdIndex.
+    Until PAYMENT_KEYS_BACKFILLED is set, payments recorded before the keys
+    table existed have no key, so the PaymentIdIndex lookup still runs first.
+    
     Args:
         user_id (str): The user ID associated with this transaction
         coins_amount (int): Number of coins (positive for additions, negative for subtractions)
@@ -617,31 +909,25 @@ def create_transaction(user_id, coins_amount, transaction_type, details=None, pa
         details (dict): Any additional details about the transaction
         payment_id (str, optional): ID de pago externo para transacciones de compra, usado para idempotencia
         coupon_code (str, optional): Código de cupón si aplica
+        user (dict, optional): User item the caller already read (saves the initial get_user)
+        idempotency_key (str, optional): Retries with the same key record the transaction only once
         
     Returns:
         dict: Transaction data with additional 'is_existing' field if transaction already existed
+        
+    Raises:
+        InsufficientCoinsError: If the balance would become negative
     """
-    dynamodb = get_dynamodb_resource()
-    transaction_table = dynamodb.Table(TRANSACTION_TABLE)
-    user_table = dynamodb.Table(USER_TABLE)
-    
-    # Si se proporciona payment_id, verificar si ya existe una transacción con ese payment_id
-    if payment_id:
-        existing_transaction = get_transaction_by_payment_id(payment_id)
-        if existing_transaction:
-            print(f"Transaction with payment_id {payment_id} already exists, returning existing transaction")
-            # Marcar la transacción como existente para poder distinguirla
-            existing_transaction['is_existing'] = True
-            return existing_transaction
-
-    transaction_id = str(uuid.uuid4())
-    timestamp = int(time.time())
-    date_str = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
-
     valid_transaction_types = ['purchase', 'usage', 'bonus', 'coin_purchase_mp', 'sticker_generation_authenticated', 'coupon']
     if transaction_type not in valid_transaction_types:
         raise ValueError(f"Invalid transaction type: {transaction_type}, must be one of: {', '.join(valid_transaction_types)}")
     
+    if idempotency_key is None and payment_id:
+        idempotency_key = f"payment:{payment_id}"
+    transaction_id = _transaction_id_for(idempotency_key) if idempotency_key else str(uuid.uuid4())
+    timestamp = int(time.time())
+    date_str = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+    
     transaction_data = {
         'transaction_id': transaction_id,
         'user_id': user_id,
@@ -660,35 +946,222 @@ def create_transaction(user_id, coins_amount, transaction_type, details=None, pa
     if coupon_code:
         transaction_data['coupon_code'] = coupon_code
     
-    # Record the transaction
-    transaction_table.put_item(Item=transaction_data)
+    # Pagos antiguos sin clave: se siguen buscando en el índice hasta confirmar el backfill
+    if payment_id and not PAYMENT_KEYS_BACKFILLED:
+        existing_transaction = get_transaction_by_payment_id(payment_id)
+        if existing_transaction:
+            print(f"Transaction with payment_id {payment_id} already exists, returning existing transaction")
+            # Marcar la transacción como existente para poder distinguirla
+            existing_transaction['is_existing'] = True
+            return existing_transaction
     
-    # Update user's coin balance
-    # First get current user data
-    user = get_user(user_id)
+    if user is None:
+        user = get_user(user_id)
     if not user:
         raise ValueError(f"User with ID {user_id} not found")
     
-    # Update coins and timestamp
-    current_coins = user.get('coins', 0)
-    new_coins = max(0, current_coins + coins_amount)  # Prevent negative coins
+    client = get_dynamodb_client()
+    ledger_item = _serialize_item(transaction_data)
+    # Clave del pago: la primera escritura gana, las demás cancelan la transacción
+    payment_key_items = []
+    if payment_id:
+        payment_key_items.append({
+            'Put': {
+                'TableName': PAYMENT_KEYS_TABLE,
+                'Item': _serialize_item({
+                    'payment_id': str(payment_id),
+                    'transaction_id': transaction_id,
+                    'user_id': user_id,
+                    'created_at': timestamp
+                }),
+                'ConditionExpression': 'attribute_not_exists(payment_id)',
+                'ReturnValuesOnConditionCheckFailure': 'ALL_OLD'
+            }
+        })
+    for _ in range(DYNAMODB_TRANSACTION_MAX_ATTEMPTS):
+        expected_coins = _to_number(user.get('coins', 0))
+        new_coins = expected_coins + _to_number(coins_amount)
+        if new_coins < 0:
+            raise InsufficientCoinsError(f"Insufficient coins: user {user_id} has {expected_coins} coins, cannot apply {coins_amount}")
+        
+        # Saldo esperado: si no coincide, otra escritura se adelantó (sin lost updates)
+        if 'coins' in user:
+            balance_condition = 'attribute_exists(user_id) AND coins = :expected'
+            condition_values = {':expected': _serializer.serialize(expected_coins)}
+        else:
+            balance_condition = 'attribute_exists(user_id) AND attribute_not_exists(coins)'
+            condition_values = {}
+        
+        transact_items = payment_key_items + [
+            {
+                'Put': {
+                    'TableName': TRANSACTION_TABLE,
+                    'Item': ledger_item,
+                    'ConditionExpression': 'attribute_not_exists(transaction_id)'
+                }
+            },
+            {
+                'Update': {
+                    'TableName': USER_TABLE,
+                    'Key': {'user_id': {'S': user_id}},
+                    'UpdateExpression': 'ADD coins :delta SET updated_at = :timestamp',
+                    'ConditionExpression': balance_condition,
+                    'ExpressionAttributeValues': {
+                        ':delta': _serializer.serialize(_to_number(coins_amount)),
+                        ':timestamp': {'N': str(timestamp)},
+                        **condition_values
+                    },
+                    'ReturnValuesOnConditionCheckFailure': 'ALL_OLD'
+                }
+            }
+        ]
+        
+        try:
+            dynamodb_telemetry.call('dynamodb_utils.create_transaction', 'transact_write_items',
+                                    client.transact_write_items, TransactItems=transact_items)
+        except client.exceptions.TransactionCanceledException as e:
+            reasons = _cancellation_reasons(e) + [{}] * 3
+            if payment_key_items:
+                payment_reason = reasons.pop(0)
+                if payment_reason.get('Code') == 'ConditionalCheckFailed':
+                    # El pago ya se registró (webhook duplicado o reconciliación)
+                    print(f"Transaction with payment_id {payment_id} already exists, returning existing transaction")
+                    existing_id = _deserialize_item(payment_reason.get('Item', {})).get('transaction_id', transaction_id)
+                    return _existing_transaction(existing_id, transaction_data)
+            ledger_reason, user_reason = reasons[:2]
+            if ledger_reason.get('Code') == 'ConditionalCheckFailed':
+                # La misma operación ya se registró (reintento con la misma clave)
+                return _existing_transaction(transaction_id, transaction_data)
+            if user_reason.get('Code') == 'ConditionalCheckFailed':
+                if not user_reason.get('Item'):
+                    raise ValueError(f"User with ID {user_id} not found")
+                # Reintentar con el saldo actual que devuelve la cancelación
+                user = _deserialize_item(user_reason['Item'])
+                continue
+            raise
+        
+        # Return the transaction data and the updated user data
+        transaction_data['updated_user'] = _user_written(dict(user, coins=new_coins, updated_at=timestamp))
+        # Marcar explícitamente como transacción nueva
+        transaction_data['is_existing'] = False
+        return transaction_data
     
-    # Update the user's coin balance
-    response = user_table.update_item(
-        Key={'user_id': user_id},
-        UpdateExpression='SET coins = :coins, updated_at = :timestamp',
-        ExpressionAttributeValues={
-            ':coins': new_coins,
-            ':timestamp': timestamp
-        },
-        ReturnValues='ALL_NEW'
-    )
+    raise RuntimeError(f"Could not update coins for user {user_id}: too many concurrent updates")
+
+# Estado del índice temporal: una vez ACTIVE no cambia; mientras se rellena se
+# vuelve a comprobar como mucho cada EMAIL_INDEX_POLL_INTERVAL segundos
+_transactions_index_ready = False
+_transactions_index_checked_at = 0.0
+
+def transactions_index_ready():
+    global _transactions_index_ready, _transactions_index_checked_at
+    if _transactions_index_ready or time.time() - _transactions_index_checked_at < EMAIL_INDEX_POLL_INTERVAL:
+        return _transactions_index_ready
+    _transactions_index_checked_at = time.time()
+    try:
+        response = get_dynamodb_client().describe_table(TableName=TRANSACTION_TABLE)
+        for index in response['Table'].get('GlobalSecondaryIndexes', []):
+            if index['IndexName'] == TRANSACTION_TIME_INDEX:
+                _transactions_index_ready = index['IndexStatus'] == 'ACTIVE' and not index.get('Backfilling', False)
+    except Exception as e:
+        print(f"Error checking {TRANSACTION_TIME_INDEX} status: {e}")
+    return _transactions_index_ready
+
+def encode_transactions_cursor(last_evaluated_key):
+    """
+    Opaque cursor for the next page (LastEvaluatedKey as URL-safe base64 JSON)
+    """
+    if not last_evaluated_key:
+        return None
+    data = json.dumps({key: str(value) if isinstance(value, Decimal) else value
+                       for key, value in last_evaluated_key.items()}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_transactions_cursor(cursor, user_id):
+    """
+    ExclusiveStartKey from a cursor; it must belong to user_id
+    
+    Raises:
+        ValueError: If the cursor is malformed or belongs to another user
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        start_key = {
+            'transaction_id': str(key['transaction_id']),
+            'user_id': str(key['user_id']),
+            'timestamp': Decimal(key['timestamp'])
+        }
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if start_key['user_id'] != user_id:
+        raise ValueError("Invalid cursor")
+    return start_key
+
+def _projection_kwargs(fields):
+    if not fields:
+        return {}
+    # timestamp y date son palabras reservadas
+    return {
+        'ProjectionExpression': ', '.join(f'#f{i}' for i in range(len(fields))),
+        'ExpressionAttributeNames': {f'#f{i}': field for i, field in enumerate(fields)}
+    }
+
+def get_user_transactions_page(user_id, limit=50, cursor=None, fields=None):
+    """
+    One page of a user's transactions, newest first
+    
+    Uses the user_id + timestamp index, so each page costs one query of at
+    most `limit` items. While the index is being built, the old UserIdIndex
+    is read in full and sorted in memory (first page only).
     
-    # Return the transaction data and the updated user data
-    transaction_data['updated_user'] = response.get('Attributes')
-    # Marcar explícitamente como transacción nueva
-    transaction_data['is_existing'] = False
-    return transaction_data
+    Args:
+        user_id (str): User ID to get transactions for
+        limit (int): Page size (capped at TRANSACTION_PAGE_MAX)
+        cursor (str, optional): next_cursor of the previous page
+        fields (tuple, optional): Attributes to return (e.g. TRANSACTION_LIST_FIELDS)
+        
+    Returns:
+        tuple: (list of transaction dicts, str next_cursor or None)
+        
+    Raises:
+        ValueError: If the cursor is invalid
+    """
+    limit = max(1, min(int(limit), TRANSACTION_PAGE_MAX))
+    table = get_table(TRANSACTION_TABLE)
+    
+    if not transactions_index_ready():
+        if cursor:
+            raise ValueError("Invalid cursor")
+        # Fields used for sorting must be read even if not requested
+        read_fields = tuple(fields) + ('timestamp',) if fields and 'timestamp' not in fields else fields
+        query_kwargs = {
+            'IndexName': 'UserIdIndex',
+            'KeyConditionExpression': Key('user_id').eq(user_id),
+            **_projection_kwargs(read_fields)
+        }
+        items = []
+        while True:
+            response = table.query(**query_kwargs)
+            items.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        items.sort(key=lambda tx: tx.get('timestamp', 0), reverse=True)
+        return items[:limit], None
+    
+    query_kwargs = {
+        'IndexName': TRANSACTION_TIME_INDEX,
+        'KeyConditionExpression': Key('user_id').eq(user_id),
+        'ScanIndexForward': False,  # Sort descending (newest first)
+        'Limit': limit,
+        **_projection_kwargs(fields)
+    }
+    if cursor:
+        query_kwargs['ExclusiveStartKey'] = decode_transactions_cursor(cursor, user_id)
+    
+    response = table.query(**query_kwargs)
+    return response.get('Items', []), encode_transactions_cursor(response.get('LastEvaluatedKey'))
 
 def get_user_transactions(user_id, limit=50):
     """
@@ -701,22 +1174,50 @@ def get_user_transactions(user_id, limit=50):
     Returns:
         list: List of transaction dictionaries
     """
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(TRANSACTION_TABLE)
-    
-    response = table.query(
-        IndexName='UserIdIndex',
-        KeyConditionExpression=Key('user_id').eq(user_id),
-        ScanIndexForward=False,  # Sort descending (newest first)
-        Limit=limit
-    )
+    items, _ = get_user_transactions_page(user_id, limit=limit)
+    return items
+
+def backfill_transaction_timestamps():
+    """
+    Sets 'timestamp' (from 'date') on ledger entries that lack it, so they
+    appear in the user_id + timestamp index. Safe to re-run.
     
-    return response.get('Items', [])
+    Returns:
+        int: Number of transactions updated
+    """
+    table = get_table(TRANSACTION_TABLE)
+    updated = 0
+    for item in dynamodb_scan.scan_items(
+        TRANSACTION_TABLE,
+        FilterExpression=Attr('timestamp').not_exists(),
+        ProjectionExpression='transaction_id, #d',
+        ExpressionAttributeNames={'#d': 'date'}
+    ):
+        try:
+            timestamp = int(datetime.strptime(item.get('date', ''), '%Y-%m-%d').timestamp())
+        except ValueError:
+            timestamp = 0
+        try:
+            table.update_item(
+                Key={'transaction_id': item['transaction_id']},
+                UpdateExpression='SET #ts = :timestamp',
+                ConditionExpression='attribute_not_exists(#ts)',
+                ExpressionAttributeNames={'#ts': 'timestamp'},
+                ExpressionAttributeValues={':timestamp': timestamp}
+            )
+            updated += 1
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+    print(f"Backfilled timestamp on {updated} transactions in {TRANSACTION_TABLE}")
+    return updated
 
 def get_transaction_by_payment_id(payment_id):
     """
     Busca una transacción por su payment_id de Mercado Pago
     
+    Lee la clave del pago y la transacción con lecturas consistentes; el
+    PaymentIdIndex solo se consulta para pagos sin clave registrada.
+    
     Args:
         payment_id (str): ID de pago de Mercado Pago
         
@@ -725,9 +1226,19 @@ def get_transaction_by_payment_id(payment_id):
     """
     if not payment_id:
         return None
-        
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(TRANSACTION_TABLE)
+    
+    try:
+        payment_key = get_table(PAYMENT_KEYS_TABLE).get_item(
+            Key={'payment_id': str(payment_id)}, ConsistentRead=True
+        ).get('Item')
+        if payment_key:
+            return get_table(TRANSACTION_TABLE).get_item(
+                Key={'transaction_id': payment_key['transaction_id']}, ConsistentRead=True
+            ).get('Item')
+    except Exception as e:
+        print(f"Error reading payment key {payment_id}: {e}")
+    
+    table = get_table(TRANSACTION_TABLE)
     
     try:
         # Usar el índice PaymentIdIndex para buscar eficientemente
@@ -745,6 +1256,40 @@ def get_transaction_by_payment_id(payment_id):
         print(f"Error querying transaction by payment_id: {e}")
         return None
 
+def backfill_payment_keys():
+    """
+    Registers a payment key for every ledger entry with a payment_id.
+    Existing keys are left untouched, so it can be re-run safely (also while
+    webhooks keep arriving). Run it with the backfill-payment-keys command,
+    then set PAYMENT_KEYS_BACKFILLED to stop the PaymentIdIndex lookups.
+    
+    Returns:
+        int: Number of keys written
+    """
+    payment_keys = get_table(PAYMENT_KEYS_TABLE)
+    written = 0
+    for item in dynamodb_scan.scan_items(
+        TRANSACTION_TABLE,
+        FilterExpression=Attr('payment_id').exists(),
+        ProjectionExpression='payment_id, transaction_id, user_id, #ts',
+        ExpressionAttributeNames={'#ts': 'timestamp'}
+    ):
+        try:
+            payment_keys.put_item(
+                Item={
+                    'payment_id': str(item['payment_id']),
+                    'transaction_id': item['transaction_id'],
+                    'user_id': item.get('user_id'),
+                    'created_at': item.get('timestamp')
+                },
+                ConditionExpression='attribute_not_exists(payment_id)'
+            )
+            written += 1
+        except payment_keys.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+    print(f"Backfilled {written} payment keys into {PAYMENT_KEYS_TABLE}")
+    return written
+
 # Admin Functions
 def create_admin_request(user_id, email):
     token = str(uuid.uuid4())
@@ -756,20 +1301,17 @@ def create_admin_request(user_id, email):
         'created_at': timestamp,
         'status': 'pending'
     }
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(ADMIN_REQUEST_TABLE)
+    table = get_table(ADMIN_REQUEST_TABLE)
     table.put_item(Item=item)
     return token
 
 def get_admin_request(token):
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(ADMIN_REQUEST_TABLE)
+    table = get_table(ADMIN_REQUEST_TABLE)
     response = table.get_item(Key={'token': token})
     return response.get('Item')
 
 def approve_admin_request(token):
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(ADMIN_REQUEST_TABLE)
+    table = get_table(ADMIN_REQUEST_TABLE)
     table.update_item(
         Key={'token': token},
         UpdateExpression='SET #s = :s',
@@ -778,8 +1320,7 @@ def approve_admin_request(token):
     )
 
 def update_user_role(user_id, new_role):
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(USER_TABLE)
+    table = get_table(USER_TABLE)
     response = table.update_item(
         Key={'user_id': user_id},
         UpdateExpression='SET #r = :role',
@@ -787,7 +1328,7 @@ def update_user_role(user_id, new_role):
         ExpressionAttributeValues={':role': new_role},
         ReturnValues='ALL_NEW'
     )
-    return response.get('Attributes') 
+    return _user_written(response.get('Attributes'))
 
 
 def update_user_name(user_id, new_name):
@@ -799,8 +1340,7 @@ def update_user_name(user_id, new_name):
     Returns:
         dict: Usuario actualizado
     """
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(USER_TABLE)
+    table = get_table(USER_TABLE)
     timestamp = int(time.time())
     response = table.update_item(
         Key={'user_id': user_id},
@@ -812,4 +1352,19 @@ def update_user_name(user_id, new_name):
         },
         ReturnValues='ALL_NEW'
     )
-    return response.get('Attributes') 
\ No newline at end of file
+    return _user_written(response.get('Attributes')) 
+
+
+if __name__ == '__main__':
+    # Uso (desde la raíz del repo):
+    #   PYTHONPATH=app python -m utils.dynamodb_utils backfill-transaction-timestamps
+    #   PYTHONPATH=app python -m utils.dynamodb_utils backfill-payment-keys
+    import sys
+    if sys.argv[1:] == ['backfill-transaction-timestamps']:
+        backfill_transaction_timestamps()
+    elif sys.argv[1:] == ['backfill-payment-keys']:
+        backfill_payment_keys()
+        if not PAYMENT_KEYS_BACKFILLED:
+            print("Once a run writes 0 keys, set PAYMENT_KEYS_BACKFILLED=True to skip the PaymentIdIndex lookups")
+    else:
+        print("Usage: python -m utils.dynamodb_utils backfill-transaction-timestamps | backfill-payment-keys")
@@ -0,0 +1,157 @@
+import json
+import hashlib
+import logging
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from PIL import Image
+
+from utils import upload_spool
+from utils.s3_key_resolver import canonical_key, resolve_key
+
+from config import (
+    S3_SPRITES_FOLDER, S3_BATCH_MAX_WORKERS,
+    HISTORY_SPRITE_TILE_SIZE, HISTORY_SPRITE_COLUMNS, HISTORY_SPRITE_QUALITY
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Sprite sheets for history pages: one WebP with every thumbnail of the page
+# plus a JSON map of tile offsets, so a page costs two requests instead of one
+# per sticker.
+# - Sprites are stored in S3 under {S3_SPRITES_FOLDER}/{owner}/ and named after
+#   a hash of the page contents (filenames, tile size and layout), so a page
+#   whose contents didn't change always reuses the same sprite.
+# - A new sticker changes the first page's contents and therefore its name, so
+#   a stale sprite is never served. Nothing deletes sprites on the request
+#   path: the bucket lifecycle rule from setup-bucket expires them after
+#   HISTORY_SPRITE_EXPIRATION_DAYS and they are rebuilt on the next visit.
+
+# Se incrementa si cambia el formato del sprite o del mapa
+SPRITE_VERSION = 1
+
+
+def _owner_prefix(owner):
+    return f"{S3_SPRITES_FOLDER}/{owner}/"
+
+
+def sprite_name(owner, filenames):
+    """
+    Content hash for a page: the same page always maps to the same sprite
+    """
+    payload = json.dumps({
+        'version': SPRITE_VERSION,
+        'owner': owner,
+        'filenames': filenames,
+        'tile_size': HISTORY_SPRITE_TILE_SIZE,
+        'columns': HISTORY_SPRITE_COLUMNS
+    }, sort_keys=True)
+    return f"sprite_{hashlib.sha256(payload.encode('utf-8')).hexdigest()}.webp"
+
+
+def sprite_key(owner, name):
+    return f"{_owner_prefix(owner)}{name}"
+
+
+def _map_key(owner, name):
+    return f"{sprite_key(owner, name)}.json"
+
+
+def _read_sticker(s3_client, bucket, filename):
+    # Un sticker recién generado puede seguir en el spool de subida
+    spooled_file, _ = upload_spool.get(canonical_key(filename))
+    if spooled_file:
+        with spooled_file:
+            return spooled_file.read()
+    key, _ = resolve_key(s3_client, bucket, filename)
+    if not key:
+        raise FileNotFoundError(filename)
+    return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+def _fetch_thumbnail(s3_client, bucket, filename):
+    try:
+        image = Image.open(BytesIO(_read_sticker(s3_client, bucket, filename)))
+        image = image.convert('RGBA')
+        image.thumbnail((HISTORY_SPRITE_TILE_SIZE, HISTORY_SPRITE_TILE_SIZE), Image.LANCZOS)
+        return image
+    except Exception as e:
+        logger.error(f"Error loading {filename} for history sprite: {e}")
+        return None
+
+
+def _build_sprite(s3_client, bucket, filenames):
+    """
+    Composite the thumbnails into a grid. Returns (webp bytes, sprite map).
+    """
+    with ThreadPoolExecutor(max_workers=min(S3_BATCH_MAX_WORKERS, len(filenames))) as executor:
+        thumbnails = list(executor.map(lambda f: _fetch_thumbnail(s3_client, bucket, f), filenames))
+    # Reintentar una vez las que fallaron (p.ej. un error transitorio de S3)
+    for index, filename in enumerate(filenames):
+        if thumbnails[index] is None:
+            thumbnails[index] = _fetch_thumbnail(s3_client, bucket, filename)
+
+    columns = min(HISTORY_SPRITE_COLUMNS, len(filenames))
+    rows = (len(filenames) + columns - 1) // columns
+    tile = HISTORY_SPRITE_TILE_SIZE
+    sheet = Image.new('RGBA', (columns * tile, rows * tile), (0, 0, 0, 0))
+
+    tiles = {}
+    for index, (filename, thumbnail) in enumerate(zip(filenames, thumbnails)):
+        if thumbnail is None:
+            # get_or_build_sprite no guarda sprites incompletos
+            continue
+        # Centrar la miniatura en su celda
+        x = (index % columns) * tile + (tile - thumbnail.width) // 2
+        y = (index // columns) * tile + (tile - thumbnail.height) // 2
+        sheet.paste(thumbnail, (x, y), thumbnail)
+        tiles[filename] = {'x': x, 'y': y, 'w': thumbnail.width, 'h': thumbnail.height}
+
+    output = BytesIO()
+    sheet.save(output, format='WEBP', quality=HISTORY_SPRITE_QUALITY, method=4)
+    sprite_map = {'width': sheet.width, 'height': sheet.height, 'tile_size': tile, 'tiles': tiles}
+    return output.getvalue(), sprite_map
+
+
+def get_or_build_sprite(s3_client, bucket, owner, filenames):
+    """
+    Return the sprite map for a history page, building and storing it in S3 if needed.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket (str): Bucket name
+        owner (str): user_id or session_id
+        filenames (list): Filenames of the page, in display order
+
+    Returns:
+        tuple: (str sprite name, dict sprite map), or (None, None) if some
+            thumbnail couldn't be loaded. An incomplete sprite is not stored
+            (its name is immutable), so the client loads the page per sticker
+            and the next visit tries again.
+    """
+    name = sprite_name(owner, filenames)
+    try:
+        s3_object = s3_client.get_object(Bucket=bucket, Key=_map_key(owner, name))
+        return name, json.loads(s3_object['Body'].read())
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            raise
+
+    data, sprite_map = _build_sprite(s3_client, bucket, filenames)
+    if len(sprite_map['tiles']) < len(filenames):
+        missing = [filename for filename in filenames if filename not in sprite_map['tiles']]
+        logger.warning(f"History sprite {name} for {owner} not stored, missing tiles: {missing}")
+        return None, None
+    # El sprite se sube antes que el mapa: si existe el mapa, existe el sprite
+    s3_client.put_object(
+        Bucket=bucket, Key=sprite_key(owner, name), Body=data,
+        ContentType='image/webp', CacheControl='public, max-age=31536000, immutable'
+    )
+    s3_client.put_object(
+        Bucket=bucket, Key=_map_key(owner, name), Body=json.dumps(sprite_map).encode('utf-8'),
+        ContentType='application/json'
+    )
+    logger.info(f"Built history sprite {name} for {owner}: {len(sprite_map['tiles'])} tiles, {len(data)} bytes")
+    return name, sprite_map
+
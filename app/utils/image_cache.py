@@ -0,0 +1,340 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import time
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows (desarrollo local): sin bloqueo entre procesos
+    fcntl = None
+
+from config import (
+    IMAGE_CACHE_ENABLED, IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES,
+    IMAGE_CACHE_MAX_ITEM_BYTES, IMAGE_CACHE_SCAN_INTERVAL
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Disk LRU cache for S3 images shared by all workers on the same machine.
+# - Entries are keyed by S3 key and written atomically (temp file + os.replace),
+#   so readers never see partial files.
+# - The file mtime is used as the LRU clock and is refreshed on every hit.
+# - Eviction runs under an exclusive flock so only one worker evicts at a time.
+#   Each worker tracks an estimate of the cache size and rescans the directory
+#   every IMAGE_CACHE_SCAN_INTERVAL seconds, so the cap is approximate.
+# - HTTP validators (ETag, Last-Modified) are kept in a '.meta' sidecar file so
+#   conditional requests can be answered without reading the image.
+
+_TMP_PREFIX = '.tmp-'
+_META_SUFFIX = '.meta'
+_LOCK_FILENAME = '.evict.lock'
+
+_state_lock = threading.Lock()
+_approx_size = None
+_last_scan = 0.0
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'bytes_saved': 0,
+    'bytes_written': 0,
+    'evictions': 0
+}
+
+
+def _cache_path(key):
+    """
+    Returns the on-disk path for an S3 key (sharded by hash prefix)
+    """
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    ext = os.path.splitext(key)[1].lower()
+    return os.path.join(IMAGE_CACHE_DIR, digest[:2], f"{digest}{ext}")
+
+
+def _record(stat, amount=1):
+    with _state_lock:
+        _stats[stat] += amount
+
+
+def contains(key):
+    """
+    Check if an S3 key is cached without counting it as a hit or miss
+    """
+    if not IMAGE_CACHE_ENABLED:
+        return False
+    return os.path.exists(_cache_path(key))
+
+
+def _read_metadata(path):
+    try:
+        with open(f"{path}{_META_SUFFIX}", 'r') as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def get(key):
+    """
+    Open a cached object for reading.
+
+    Args:
+        key (str): S3 key of the object
+
+    Returns:
+        tuple: (file or None, dict metadata) - metadata has 'etag', 'last_modified' and 'size'
+    """
+    if not IMAGE_CACHE_ENABLED:
+        return None, None
+
+    path = _cache_path(key)
+    try:
+        # Abrir el archivo antes de usarlo: si otro worker lo desaloja
+        # mientras se sirve, el descriptor sigue siendo válido
+        file_obj = open(path, 'rb')
+    except FileNotFoundError:
+        _record('misses')
+        return None, None
+    except OSError as e:
+        logger.error(f"Error reading image cache entry {path}: {e}")
+        _record('misses')
+        return None, None
+
+    try:
+        # Refrescar mtime para que la entrada sea la más reciente en el LRU
+        os.utime(path, None)
+        size = os.fstat(file_obj.fileno()).st_size
+    except OSError:
+        size = 0
+
+    metadata = _read_metadata(path)
+    metadata['size'] = size
+
+    _record('hits')
+    _record('bytes_saved', size)
+    return file_obj, metadata
+
+
+def put(key, data, etag=None, last_modified=None):
+    """
+    Store an object in the cache atomically.
+
+    Args:
+        key (str): S3 key of the object
+        data (bytes): Object contents
+        etag (str, optional): S3 ETag (quoted); an MD5 of the content is used if missing
+        last_modified (int, optional): Last modification time as a Unix timestamp
+
+    Returns:
+        bool: True if stored, False otherwise
+    """
+    writer = open_writer(key, len(data), etag, last_modified)
+    if not writer:
+        return False
+    writer.write(data)
+    return writer.commit()
+
+
+def open_writer(key, expected_size=None, etag=None, last_modified=None):
+    """
+    Start an incremental atomic write (used to tee a streamed S3 response).
+
+    Args:
+        key (str): S3 key of the object
+        expected_size (int, optional): Expected size; the entry is discarded if it doesn't match
+        etag (str, optional): S3 ETag (quoted); an MD5 of the content is used if missing
+        last_modified (int, optional): Last modification time as a Unix timestamp
+
+    Returns:
+        CacheWriter or None: Writer, or None if the object shouldn't be cached
+    """
+    if not IMAGE_CACHE_ENABLED:
+        return None
+    if expected_size is not None and expected_size > IMAGE_CACHE_MAX_ITEM_BYTES:
+        return None
+
+    path = _cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=os.path.dirname(path))
+    except OSError as e:
+        logger.error(f"Error creating image cache entry for {key}: {e}")
+        return None
+
+    return CacheWriter(fd, tmp_path, path, expected_size, etag, last_modified)
+
+
+class CacheWriter:
+    """
+    Writes to a temporary file and publishes it with os.replace on commit
+    """
+    def __init__(self, fd, tmp_path, path, expected_size=None, etag=None, last_modified=None):
+        self._file = os.fdopen(fd, 'wb')
+        self._tmp_path = tmp_path
+        self._path = path
+        self._expected_size = expected_size
+        self._etag = etag
+        self._last_modified = last_modified
+        self._md5 = hashlib.md5()
+        self._written = 0
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._md5.update(chunk)
+        self._written += len(chunk)
+
+    def _write_metadata(self):
+        metadata = {
+            'etag': self._etag or f'"{self._md5.hexdigest()}"',
+            'last_modified': self._last_modified or int(time.time())
+        }
+        meta_fd, meta_tmp = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=os.path.dirname(self._path))
+        with os.fdopen(meta_fd, 'w') as meta_file:
+            json.dump(metadata, meta_file)
+        os.replace(meta_tmp, f"{self._path}{_META_SUFFIX}")
+
+    def commit(self):
+        try:
+            self._file.close()
+            if self._written > IMAGE_CACHE_MAX_ITEM_BYTES or \
+                    (self._expected_size is not None and self._written != self._expected_size):
+                self.abort()
+                return False
+            self._write_metadata()
+            os.replace(self._tmp_path, self._path)
+        except OSError as e:
+            logger.error(f"Error committing image cache entry {self._path}: {e}")
+            self.abort()
+            return False
+
+        _record('bytes_written', self._written)
+        _track_size(self._written)
+        return True
+
+    def abort(self):
+        try:
+            if not self._file.closed:
+                self._file.close()
+            if os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+def _scan():
+    """
+    Returns (total_size, entries) for the cache directory. Stale temp files are removed.
+    """
+    total = 0
+    entries = []
+    now = time.time()
+    if not os.path.isdir(IMAGE_CACHE_DIR):
+        return 0, entries
+
+    for shard in os.scandir(IMAGE_CACHE_DIR):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith(_TMP_PREFIX):
+                # Escrituras abandonadas (p.ej. un worker que murió)
+                if now - st.st_mtime > 3600:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                continue
+            if entry.name.endswith(_META_SUFFIX):
+                continue
+            total += st.st_size
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    return total, entries
+
+
+def _track_size(added):
+    """
+    Update the size estimate and evict if the cache is over its cap
+    """
+    global _approx_size, _last_scan
+
+    with _state_lock:
+        rescan = _approx_size is None or time.time() - _last_scan > IMAGE_CACHE_SCAN_INTERVAL
+        if not rescan:
+            _approx_size += added
+            if _approx_size <= IMAGE_CACHE_MAX_BYTES:
+                return
+
+    if rescan:
+        total, _ = _scan()
+        with _state_lock:
+            _approx_size = total
+            _last_scan = time.time()
+        if total <= IMAGE_CACHE_MAX_BYTES:
+            return
+
+    _evict()
+
+
+def _evict():
+    """
+    Delete least recently used entries until the cache is at 90% of its cap
+    """
+    global _approx_size, _last_scan
+
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    lock_path = os.path.join(IMAGE_CACHE_DIR, _LOCK_FILENAME)
+    with open(lock_path, 'a') as lock_file:
+        if fcntl:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Otro worker ya está desalojando
+                return
+        try:
+            total, entries = _scan()
+            target = int(IMAGE_CACHE_MAX_BYTES * 0.9)
+            evicted = 0
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    evicted += 1
+                    if os.path.exists(f"{path}{_META_SUFFIX}"):
+                        os.remove(f"{path}{_META_SUFFIX}")
+                except FileNotFoundError:
+                    total -= size
+                except OSError as e:
+                    logger.error(f"Error evicting image cache entry {path}: {e}")
+
+            with _state_lock:
+                _approx_size = total
+                _last_scan = time.time()
+            _record('evictions', evicted)
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def get_cache_stats():
+    """
+    Hit ratio and bytes saved for this worker process
+    """
+    with _state_lock:
+        stats = dict(_stats)
+        approx_size = _approx_size
+
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = (stats['hits'] / lookups) if lookups else 0.0
+    stats['enabled'] = IMAGE_CACHE_ENABLED
+    stats['pid'] = os.getpid()
+    stats['cache_dir'] = IMAGE_CACHE_DIR
+    stats['max_bytes'] = IMAGE_CACHE_MAX_BYTES
+    stats['approx_size_bytes'] = approx_size
+    return stats
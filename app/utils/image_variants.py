@@ -0,0 +1,149 @@
+import os
+from io import BytesIO
+import logging
+from botocore.exceptions import ClientError
+from PIL import Image
+
+from utils import image_cache
+from utils.s3_key_resolver import is_missing_error
+from config import (
+    S3_VARIANTS_FOLDER, IMAGE_VARIANT_WIDTHS, IMAGE_VARIANT_WEBP_QUALITY,
+    IMAGE_VARIANT_STORE_S3
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Resized / re-encoded variants of stored images for /img/<filename>?w=&fmt=.
+# - Only widths in IMAGE_VARIANT_WIDTHS and the formats in VARIANT_FORMATS are
+#   accepted, so the number of variants per image is bounded.
+# - Variants are keyed by the key holding the source bytes. With content
+#   addressing that is content/{sha256}.png, so identical images share their
+#   variants.
+# - The first render is stored in the local image cache and, if
+#   IMAGE_VARIANT_STORE_S3 is set, under S3_VARIANTS_FOLDER. Later requests are
+#   served without any PIL work.
+
+VARIANT_FORMATS = {
+    'webp': 'image/webp',
+    'png': 'image/png'
+}
+
+# Tamaño de la versión estándar de los stickers (ver save_image); para anchos
+# mayores se parte de la versión _high
+STANDARD_STICKER_SIZE = 250
+
+VARIANT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def parse_variant_request(args):
+    """
+    Validate the w/fmt query parameters.
+
+    Returns:
+        tuple: (int width or None, str format or None); (None, None) if no variant was requested
+
+    Raises:
+        ValueError: If the width or format isn't allowed
+    """
+    width = args.get('w')
+    fmt = args.get('fmt')
+    if width is None and fmt is None:
+        return None, None
+
+    if width is not None:
+        if not width.isdigit() or int(width) not in IMAGE_VARIANT_WIDTHS:
+            raise ValueError(f"w must be one of {', '.join(str(w) for w in IMAGE_VARIANT_WIDTHS)}")
+        width = int(width)
+    if fmt is not None:
+        fmt = fmt.lower()
+        if fmt not in VARIANT_FORMATS:
+            raise ValueError(f"fmt must be one of {', '.join(VARIANT_FORMATS)}")
+    return width, fmt
+
+
+def needs_high_source(width):
+    return bool(width) and width > STANDARD_STICKER_SIZE
+
+
+def variant_format(source_key, fmt):
+    if fmt:
+        return fmt
+    ext = os.path.splitext(source_key)[1].lower().lstrip('.')
+    return ext if ext in VARIANT_FORMATS else 'png'
+
+
+def variant_key(source_key, width, fmt):
+    stem = os.path.splitext(os.path.basename(source_key))[0]
+    return f"{S3_VARIANTS_FOLDER}/{stem}_w{width or 'orig'}.{variant_format(source_key, fmt)}"
+
+
+def render_variant(data, width, fmt):
+    """
+    Resize (never upscale) and encode an image
+    """
+    image = Image.open(BytesIO(data))
+    if width and image.width > width:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.LANCZOS)
+
+    output = BytesIO()
+    if fmt == 'webp':
+        image.save(output, format='WEBP', quality=IMAGE_VARIANT_WEBP_QUALITY, method=4)
+    else:
+        image.save(output, format='PNG')
+    return output.getvalue()
+
+
+def get_variant(s3_client, bucket, source_key, read_source, width, fmt):
+    """
+    Return a variant, rendering and storing it the first time.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket (str): Bucket name
+        source_key (str): Key holding the source bytes
+        read_source (callable): Returns the source bytes (or None if missing)
+        width (int): Target width (None keeps the original)
+        fmt (str): 'webp' or 'png' (None keeps the source format)
+
+    Returns:
+        tuple: (file object or None, dict metadata {'etag', 'last_modified', 'source'})
+    """
+    key = variant_key(source_key, width, fmt)
+    cached_file, metadata = image_cache.get(key)
+    if cached_file:
+        return cached_file, dict(metadata, source='cache')
+
+    if IMAGE_VARIANT_STORE_S3:
+        try:
+            s3_object = s3_client.get_object(Bucket=bucket, Key=key)
+            data = s3_object['Body'].read()
+            last_modified = s3_object.get('LastModified')
+            last_modified = int(last_modified.timestamp()) if last_modified else None
+            image_cache.put(key, data, s3_object.get('ETag'), last_modified)
+            return BytesIO(data), {'etag': s3_object.get('ETag'), 'last_modified': last_modified, 'source': 's3'}
+        except ClientError as e:
+            if not is_missing_error(e):
+                raise
+
+    source = read_source()
+    if source is None:
+        return None, None
+
+    fmt = variant_format(source_key, fmt)
+    data = render_variant(source, width, fmt)
+    etag = None
+    if IMAGE_VARIANT_STORE_S3:
+        try:
+            response = s3_client.put_object(
+                Bucket=bucket, Key=key, Body=data,
+                ContentType=VARIANT_FORMATS[fmt], CacheControl=VARIANT_CACHE_CONTROL
+            )
+            etag = response.get('ETag')
+        except ClientError as e:
+            # Se sirve igualmente; se volverá a intentar guardar en el próximo miss
+            logger.error(f"Error storing image variant {key}: {e}")
+    image_cache.put(key, data, etag)
+    logger.info(f"Rendered image variant {key} ({len(source)} -> {len(data)} bytes)")
+    return BytesIO(data), {'etag': etag, 'last_modified': None, 'source': 'render'}
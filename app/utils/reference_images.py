@@ -0,0 +1,71 @@
+from io import BytesIO
+import logging
+from PIL import Image, ImageOps
+
+from config import REFERENCE_IMAGE_MAX_DIMENSION, REFERENCE_IMAGE_MAX_PIXELS
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# In-memory preprocessing of reference images before images.edit.
+# - Phone photos can be 12 MP; the model works at 1024x1024, so the image is
+#   downscaled first and the upload to OpenAI shrinks accordingly.
+# - JPEGs are decoded with draft(), which lets libjpeg scale by 1/2, 1/4 or
+#   1/8 while decoding instead of building the full bitmap.
+# - The EXIF orientation is applied (the pixels of phone photos are often
+#   stored rotated) and the result is encoded once as PNG into a BytesIO, with
+#   no temporary files.
+# - Images above REFERENCE_IMAGE_MAX_PIXELS are rejected from the header,
+#   before decoding anything (decompression bombs).
+
+REFERENCE_IMAGE_FILENAME = 'reference_image.png'
+
+
+def prepare_reference_image(img_bytes, max_dimension=None, max_pixels=None):
+    """
+    Orient, downscale and encode a reference image for the image edit API.
+
+    Args:
+        img_bytes (bytes): Original image (any format PIL can open)
+        max_dimension (int, optional): Longest side after downscaling
+        max_pixels (int, optional): Largest accepted width * height
+
+    Returns:
+        BytesIO: RGBA PNG, positioned at 0, with a .name for MIME detection
+
+    Raises:
+        ValueError: If the image can't be decoded or is too large
+    """
+    max_dimension = max_dimension or REFERENCE_IMAGE_MAX_DIMENSION
+    max_pixels = max_pixels or REFERENCE_IMAGE_MAX_PIXELS
+
+    try:
+        img = Image.open(BytesIO(img_bytes))
+    except Image.DecompressionBombError as e:
+        # open() ya rechaza las imágenes de más del doble de MAX_IMAGE_PIXELS
+        raise ValueError(f"La imagen es demasiado grande: {e}")
+    except (Image.UnidentifiedImageError, OSError) as e:
+        raise ValueError(f"Formato de imagen no soportado: {e}")
+
+    # open() solo lee la cabecera: se valida el tamaño antes de decodificar
+    width, height = img.size
+    if width * height > max_pixels:
+        raise ValueError(f"La imagen es demasiado grande ({width}x{height})")
+    logger.info(f"Imagen cargada: formato={img.format}, tamaño={img.size}, modo={img.mode}")
+
+    if img.format == 'JPEG':
+        img.draft('RGB', (max_dimension, max_dimension))
+
+    try:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        img = img.convert('RGBA')
+    except (Image.DecompressionBombError, OSError) as e:
+        raise ValueError(f"Error al procesar la imagen: {e}")
+
+    output = BytesIO()
+    img.save(output, format="PNG")
+    output.seek(0)
+    output.name = REFERENCE_IMAGE_FILENAME
+    logger.info(f"Imagen de referencia preparada: {img.size}, {output.getbuffer().nbytes} bytes")
+    return output
@@ -0,0 +1,85 @@
+from flask import g, has_app_context
+
+# Per-request identity map for user records, kept on flask.g.
+# - get_user / get_user_by_email look here first, so the route, the decorators
+#   and create_transaction share one read of the same user per request.
+# - Writes that return the whole item (ALL_NEW, or the balance computed by
+#   create_transaction) replace the cached copy; writes that don't, drop it.
+# - Misses are remembered too (None), until create_user stores the new user.
+# - Outside a request (background threads, scripts) nothing is cached.
+# - DynamoDB calls are counted per request for the debug response header.
+
+_MISSING = object()
+
+
+def _state():
+    if not has_app_context():
+        return None
+    state = g.get('_user_identity_map')
+    if state is None:
+        state = {'by_id': {}, 'by_email': {}, 'dynamodb_calls': 0}
+        g._user_identity_map = state
+    return state
+
+
+def lookup(user_id=None, email=None):
+    """
+    Cached user for this request: the item, None for a remembered miss, or
+    MISSING if it hasn't been read yet
+    """
+    state = _state()
+    if state is None:
+        return _MISSING
+    if user_id is not None:
+        return state['by_id'].get(user_id, _MISSING)
+    return state['by_email'].get(email, _MISSING)
+
+
+def is_missing(value):
+    return value is _MISSING
+
+
+def remember(user, user_id=None, email=None):
+    """
+    Store a read or written user item (or a miss, with user=None)
+    """
+    state = _state()
+    if state is None:
+        return user
+    if user:
+        # Si el email cambió, la entrada anterior ya no corresponde a este usuario
+        previous = state['by_id'].get(user.get('user_id'))
+        if previous and previous.get('email') != user.get('email'):
+            state['by_email'].pop(previous.get('email'), None)
+        state['by_id'][user['user_id']] = user
+        if user.get('email'):
+            state['by_email'][user['email']] = user
+    elif user_id is not None:
+        state['by_id'][user_id] = None
+    elif email is not None:
+        state['by_email'][email] = None
+    return user
+
+
+def forget(user_id):
+    """
+    Drop a user after a write that doesn't return the full item
+    """
+    state = _state()
+    if state is None:
+        return
+    previous = state['by_id'].pop(user_id, None)
+    if previous and previous.get('email'):
+        state['by_email'].pop(previous['email'], None)
+
+
+def count_dynamodb_call(**kwargs):
+    # Handler del evento before-call de botocore
+    state = _state()
+    if state is not None:
+        state['dynamodb_calls'] += 1
+
+
+def dynamodb_call_count():
+    state = _state()
+    return state['dynamodb_calls'] if state is not None else 0
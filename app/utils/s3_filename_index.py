@@ -0,0 +1,317 @@
+import os
+import time
+import sqlite3
+import threading
+import logging
+
+from config import (
+    AWS_S3_BUCKET_NAME, S3_STICKERS_FOLDER,
+    S3_INDEX_ENABLED, S3_INDEX_REFRESH_INTERVAL, S3_INDEX_PATH
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Filename -> S3 key index so image lookups never list the bucket on the
+# request path.
+# - The index is a sqlite file (S3_INDEX_PATH, WAL mode) shared by all the
+#   workers on the machine, so the bucket is listed once per machine, not once
+#   per worker.
+# - Uploads call add_key() from any worker and the key is visible to all of
+#   them immediately. That keeps the index current without re-listing.
+# - A full paginated listing only runs when the shared index was never built or
+#   is older than S3_INDEX_REFRESH_INTERVAL (to pick up objects written outside
+#   the app and drop deleted ones). One worker takes a lease and lists; the
+#   others keep serving from the shared index. Each page is merged as soon as it
+#   arrives, so a first build is usable before the listing finishes.
+# - A StartAfter listing can't replace the reconcile: keys sort by owner first,
+#   so there is no bucket-wide "newer than" position.
+# - If a filename exists under several prefixes, S3_STICKERS_FOLDER wins.
+# - With content addressing the index also keeps, per sticker filename, the key
+#   that holds its bytes (add_content/lookup_content), so readers skip the
+#   head_object on the reference. Listings don't return metadata: those rows
+#   come from the writes and from resolved references.
+
+# Cada cuánto mira cada worker si toca reconciliar
+_POLL_INTERVAL = 60
+# El worker que lista renueva la concesión en cada página; si muere, caduca
+_LEASE_SECONDS = 300
+# Límite de variables por sentencia en sqlite antiguos
+_QUERY_CHUNK = 500
+
+_local = threading.local()
+_refresher = None
+_stats = {
+    'last_refresh': None,
+    'last_refresh_seconds': None,
+    'refresh_count': 0,
+    'errors': 0
+}
+
+
+def _connection():
+    # Una conexión por hilo; WAL permite leer mientras otro worker escribe
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        directory = os.path.dirname(S3_INDEX_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(S3_INDEX_PATH, timeout=5)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS keys (filename TEXT PRIMARY KEY, key TEXT NOT NULL, seen_at REAL NOT NULL)'
+            )
+            connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS contents (filename TEXT PRIMARY KEY, content_key TEXT NOT NULL)')
+        _local.connection = connection
+    return connection
+
+
+def _get_meta(connection, name):
+    row = connection.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(connection, name, value):
+    connection.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, str(value)))
+
+
+def _prefer(existing, key):
+    """
+    Decide which key wins when two objects share the same filename
+    """
+    if existing is None:
+        return key
+    if existing.startswith(f"{S3_STICKERS_FOLDER}/"):
+        return existing
+    if key.startswith(f"{S3_STICKERS_FOLDER}/"):
+        return key
+    return existing
+
+
+def _merge(connection, keys, fresh_since=0):
+    """
+    Upsert keys into the shared index. Rows last seen before fresh_since (i.e.
+    not confirmed by the listing in progress) don't win over listed keys.
+    """
+    candidates = {}
+    for key in keys:
+        filename = os.path.basename(key)
+        if filename:
+            candidates[filename] = _prefer(candidates.get(filename), key)
+    if not candidates:
+        return
+
+    now = time.time()
+    with connection:
+        filenames = list(candidates)
+        for i in range(0, len(filenames), _QUERY_CHUNK):
+            chunk = filenames[i:i + _QUERY_CHUNK]
+            rows = connection.execute(
+                f"SELECT filename, key FROM keys WHERE seen_at >= ? AND filename IN ({','.join('?' * len(chunk))})",
+                [fresh_since] + chunk
+            ).fetchall()
+            for filename, existing in rows:
+                candidates[filename] = _prefer(existing, candidates[filename])
+        connection.executemany(
+            'INSERT OR REPLACE INTO keys (filename, key, seen_at) VALUES (?, ?, ?)',
+            [(filename, key, now) for filename, key in candidates.items()]
+        )
+
+
+def add_key(key):
+    """
+    Add a single key to the index (called after uploads)
+    """
+    if not S3_INDEX_ENABLED:
+        return
+    try:
+        _merge(_connection(), [key])
+    except sqlite3.Error as e:
+        logger.warning(f"Could not add {key} to the S3 filename index: {e}")
+
+
+def discard(filename):
+    """
+    Drop a filename whose indexed key no longer exists
+    """
+    if not S3_INDEX_ENABLED:
+        return
+    try:
+        with _connection() as connection:
+            connection.execute('DELETE FROM keys WHERE filename = ?', (filename,))
+            connection.execute('DELETE FROM contents WHERE filename = ?', (filename,))
+    except sqlite3.Error as e:
+        logger.warning(f"Could not remove {filename} from the S3 filename index: {e}")
+
+
+def add_content(filename, content_key):
+    """
+    Record the key that holds the bytes of a sticker stored as a reference
+    """
+    if not S3_INDEX_ENABLED:
+        return
+    try:
+        with _connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO contents (filename, content_key) VALUES (?, ?)', (filename, content_key)
+            )
+    except sqlite3.Error as e:
+        logger.warning(f"Could not add the content key of {filename} to the S3 filename index: {e}")
+
+
+def lookup_content(filename):
+    """
+    Key holding the bytes of a sticker, or None if it isn't recorded
+    """
+    if not S3_INDEX_ENABLED:
+        return None
+    try:
+        row = _connection().execute('SELECT content_key FROM contents WHERE filename = ?', (filename,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"S3 content key lookup failed for {filename}: {e}")
+        return None
+    return row[0] if row else None
+
+
+def lookup(filename):
+    """
+    O(1) filename -> key lookup.
+
+    Returns:
+        str or None: The S3 key, or None if the filename isn't indexed
+    """
+    if not S3_INDEX_ENABLED:
+        return None
+    try:
+        row = _connection().execute('SELECT key FROM keys WHERE filename = ?', (filename,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"S3 filename index lookup failed for {filename}: {e}")
+        return None
+    return row[0] if row else None
+
+
+def is_ready():
+    """
+    True once a full listing of the bucket has been indexed
+    """
+    try:
+        return _get_meta(_connection(), 'completed_at') is not None
+    except sqlite3.Error:
+        return False
+
+
+def _acquire_lease(connection, force=False):
+    """
+    Take the refresh lease if a full listing is due and nobody else holds it
+    """
+    now = time.time()
+    with connection:
+        # BEGIN IMMEDIATE: solo un worker puede evaluar y tomar la concesión a la vez
+        connection.execute('BEGIN IMMEDIATE')
+        completed_at = _get_meta(connection, 'completed_at')
+        if not force and completed_at is not None and now - float(completed_at) < S3_INDEX_REFRESH_INTERVAL:
+            return False
+        lease_until = _get_meta(connection, 'lease_until')
+        if lease_until is not None and float(lease_until) > now and _get_meta(connection, 'lease_owner') != str(os.getpid()):
+            return False
+        _set_meta(connection, 'lease_owner', os.getpid())
+        _set_meta(connection, 'lease_until', now + _LEASE_SECONDS)
+        return True
+
+
+def _renew_lease(connection):
+    with connection:
+        _set_meta(connection, 'lease_until', time.time() + _LEASE_SECONDS)
+
+
+def refresh(s3_client, bucket=None, force=False):
+    """
+    Reconcile the shared index with a paginated listing of the whole bucket,
+    if it is due and no other worker is already doing it.
+
+    Returns:
+        bool: True if this worker listed the bucket
+    """
+    bucket = bucket or AWS_S3_BUCKET_NAME
+    connection = _connection()
+    if not _acquire_lease(connection, force):
+        return False
+
+    start = time.time()
+    try:
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket):
+            keys = [obj['Key'] for obj in page.get('Contents', []) if not obj['Key'].endswith('/')]
+            _merge(connection, keys, fresh_since=start)
+            _renew_lease(connection)
+
+        with connection:
+            # Lo que no apareció en el listado ni se subió durante él ya no existe
+            removed = connection.execute('DELETE FROM keys WHERE seen_at < ?', (start,)).rowcount
+            connection.execute('DELETE FROM contents WHERE filename NOT IN (SELECT filename FROM keys)')
+            _set_meta(connection, 'completed_at', time.time())
+            _set_meta(connection, 'lease_until', 0)
+        size = connection.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+    except Exception:
+        with connection:
+            _set_meta(connection, 'lease_until', 0)
+        raise
+
+    elapsed = time.time() - start
+    _stats['last_refresh'] = int(time.time())
+    _stats['last_refresh_seconds'] = round(elapsed, 3)
+    _stats['refresh_count'] += 1
+    logger.info(f"S3 filename index reconciled: {size} keys ({removed} removed) in {elapsed:.2f}s")
+    return True
+
+
+def _refresh_loop(client_factory, bucket):
+    while True:
+        try:
+            refresh(client_factory(), bucket)
+        except Exception as e:
+            _stats['errors'] += 1
+            logger.error(f"Error refreshing S3 filename index: {e}")
+        time.sleep(_POLL_INTERVAL)
+
+
+def start_background_refresh(client_factory, bucket=None):
+    """
+    Start the daemon thread that reconciles the shared index when it is due
+    (once per process; only one worker per machine lists at a time)
+
+    Args:
+        client_factory (callable): Returns a boto3 S3 client
+        bucket (str, optional): Bucket name (defaults to AWS_S3_BUCKET_NAME)
+    """
+    global _refresher
+
+    if not S3_INDEX_ENABLED or _refresher is not None:
+        return
+    _refresher = threading.Thread(
+        target=_refresh_loop,
+        args=(client_factory, bucket or AWS_S3_BUCKET_NAME),
+        name='s3-filename-index',
+        daemon=True
+    )
+    _refresher.start()
+
+
+def get_index_stats():
+    stats = dict(_stats)
+    stats['enabled'] = S3_INDEX_ENABLED
+    stats['path'] = S3_INDEX_PATH
+    if not S3_INDEX_ENABLED:
+        return stats
+    try:
+        connection = _connection()
+        stats['size'] = connection.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+        completed_at = _get_meta(connection, 'completed_at')
+        stats['ready'] = completed_at is not None
+        stats['last_reconcile'] = int(float(completed_at)) if completed_at else None
+    except sqlite3.Error as e:
+        stats['error'] = str(e)
+    return stats
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from utils.content_store import ref_target
+from utils import s3_filename_index
+
+from config import (
+    AWS_S3_BUCKET_NAME, S3_STICKERS_FOLDER, STICKER_CONTENT_ADDRESSING,
+    S3_KEY_CACHE_TTL, S3_KEY_NEGATIVE_TTL, S3_KEY_CACHE_MAX, S3_KEY_MANIFEST_PATH
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Resolves an image filename to its S3 key without probing every possible folder.
+# - New stickers always live in S3_STICKERS_FOLDER (the canonical key).
+# - Images in legacy locations (bucket root, 'stickers/', 'images/', 'imgs/')
+#   are listed once by build_legacy_manifest() into a JSON manifest.
+# - Lookups are cached per process: positive results for S3_KEY_CACHE_TTL and
+#   "not found" results for S3_KEY_NEGATIVE_TTL seconds. The cache is an LRU
+#   of at most S3_KEY_CACHE_MAX filenames, so requests for arbitrary names
+#   (misses included) can't grow worker memory without bound.
+# - With content addressing the canonical key may be a zero-byte reference
+#   (see utils/content_store.py); it is dereferenced to the content key here,
+#   so callers always get the key that holds the bytes. Writers record the
+#   content key in the shared filename index, so reads only head the reference
+#   for stickers stored by another machine or before the index existed.
+
+# Carpetas antiguas, en el mismo orden de prioridad que usaba get_image
+LEGACY_PREFIXES = ['', 'stickers/', 'images/', 'imgs/']
+
+_MISSING = object()
+
+_lock = threading.Lock()
+_resolved = OrderedDict()
+_manifest = None
+
+
+def _load_manifest():
+    global _manifest
+    if _manifest is not None:
+        return _manifest
+
+    manifest = {}
+    if S3_KEY_MANIFEST_PATH and os.path.exists(S3_KEY_MANIFEST_PATH):
+        try:
+            with open(S3_KEY_MANIFEST_PATH, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            logger.info(f"Loaded S3 key manifest with {len(manifest)} legacy entries")
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading S3 key manifest {S3_KEY_MANIFEST_PATH}: {e}")
+    _manifest = manifest
+    return _manifest
+
+
+def _lookup(filename):
+    with _lock:
+        entry = _resolved.get(filename)
+        if not entry:
+            return _MISSING
+        key, expires_at = entry
+        if time.time() >= expires_at:
+            del _resolved[filename]
+            return _MISSING
+        _resolved.move_to_end(filename)
+        return key
+
+
+def _remember(filename, key, ttl):
+    with _lock:
+        _resolved[filename] = (key, time.time() + ttl)
+        _resolved.move_to_end(filename)
+        while len(_resolved) > S3_KEY_CACHE_MAX:
+            _resolved.popitem(last=False)
+
+
+def remember_key(filename, key):
+    """
+    Cache a positive lookup (the object exists at key)
+    """
+    _remember(filename, key, S3_KEY_CACHE_TTL)
+
+
+def remember_missing(filename):
+    """
+    Cache a negative lookup (the object doesn't exist)
+    """
+    _remember(filename, None, S3_KEY_NEGATIVE_TTL)
+
+
+def forget(filename):
+    """
+    Drop any cached lookup for filename (e.g. right after uploading it)
+    """
+    with _lock:
+        _resolved.pop(filename, None)
+
+
+def canonical_key(filename):
+    return f"{S3_STICKERS_FOLDER}/{filename}"
+
+
+def resolve_key(s3_client, bucket, filename, verify=True):
+    """
+    Resolve the S3 key for an image filename.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket (str): Bucket name
+        filename (str): Image filename
+        verify (bool): If True, confirm unknown keys with a single head_object.
+            If False, the canonical key is returned unverified and the caller
+            must report the outcome with remember_key/remember_missing.
+            With STICKER_CONTENT_ADDRESSING the content key recorded in the
+            filename index is used; without one the reference has to be read.
+
+    Returns:
+        tuple: (str key or None, bool verified)
+    """
+    cached = _lookup(filename)
+    if cached is not _MISSING:
+        return cached, True
+
+    legacy_key = _load_manifest().get(filename)
+    if legacy_key:
+        remember_key(filename, legacy_key)
+        return legacy_key, True
+
+    key = canonical_key(filename)
+    if STICKER_CONTENT_ADDRESSING:
+        content_key = s3_filename_index.lookup_content(filename)
+        if content_key:
+            remember_key(filename, content_key)
+            return content_key, True
+    elif not verify:
+        return key, False
+
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+        # Los stickers anteriores no tienen metadata y se sirven desde su clave
+        key = ref_target(response) or key
+        remember_key(filename, key)
+        if STICKER_CONTENT_ADDRESSING:
+            # Los demás workers ya no necesitan leer la referencia
+            s3_filename_index.add_content(filename, key)
+        return key, True
+    except ClientError as e:
+        if is_missing_error(e):
+            remember_missing(filename)
+            return None, True
+        raise
+
+
+def is_missing_error(error):
+    """
+    True if a ClientError means the object doesn't exist
+    """
+    code = error.response.get('Error', {}).get('Code')
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in ('404', 'NoSuchKey', 'NotFound') or status == 404
+
+
+def build_legacy_manifest(s3_client, bucket=None, output_path=None):
+    """
+    One-off: list legacy image locations and write the filename -> key manifest.
+
+    Filenames that also exist in S3_STICKERS_FOLDER are skipped because the
+    canonical key always wins, as it did with the old sequential probing.
+
+    Returns:
+        dict: The manifest that was written
+    """
+    bucket = bucket or AWS_S3_BUCKET_NAME
+    output_path = output_path or S3_KEY_MANIFEST_PATH
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    def list_names(prefix, root_only=False):
+        params = {'Bucket': bucket, 'Prefix': prefix}
+        if root_only:
+            params['Delimiter'] = '/'
+        for page in paginator.paginate(**params):
+            for obj in page.get('Contents', []):
+                name = obj['Key'][len(prefix):]
+                if name and '/' not in name:
+                    yield name, obj['Key']
+
+    canonical_names = {name for name, _ in list_names(f"{S3_STICKERS_FOLDER}/")}
+
+    manifest = {}
+    for prefix in LEGACY_PREFIXES:
+        if prefix == f"{S3_STICKERS_FOLDER}/":
+            continue
+        for name, key in list_names(prefix, root_only=(prefix == '')):
+            if name in canonical_names or name in manifest:
+                continue
+            manifest[name] = key
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_path, output_path)
+
+    global _manifest
+    _manifest = manifest
+    return manifest
+
+
+if __name__ == '__main__':
+    # Uso (desde la raíz del repo): PYTHONPATH=app python -m utils.s3_key_resolver
+    from utils.s3_utils import get_s3_client
+    result = build_legacy_manifest(get_s3_client())
+    print(f"Wrote {len(result)} legacy entries to {S3_KEY_MANIFEST_PATH}")
@@ -1,8 +1,21 @@
 import os
+import time
+import threading
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
 import logging
+from utils import s3_filename_index, upload_spool, image_cache, content_store, sticker_ids
+from utils.s3_key_resolver import canonical_key, remember_key
+from config import (
+    S3_MULTIPART_THRESHOLD, S3_MULTIPART_CHUNKSIZE, S3_TRANSFER_MAX_CONCURRENCY,
+    S3_BATCH_MAX_WORKERS, S3_MAX_POOL_CONNECTIONS, STICKER_CONTENT_ADDRESSING,
+    S3_REFERENCE_UPLOADS_FOLDER, REFERENCE_UPLOAD_MAX_BYTES, REFERENCE_UPLOAD_EXPIRATION,
+    REFERENCE_UPLOAD_CONTENT_TYPES
+)
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -27,9 +40,128 @@ def get_s3_client():
         's3',
         aws_access_key_id=aws_access_key,
         aws_secret_access_key=aws_secret_key,
-        region_name=aws_region
+        region_name=aws_region,
+        # Pool suficiente para transferencias multipart y lotes concurrentes
+        config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
     )
 
+def get_transfer_config():
+    """
+    Returns the TransferConfig used for upload_file/download_file.
+    
+    Objects above S3_MULTIPART_THRESHOLD are sent as multipart transfers of
+    S3_MULTIPART_CHUNKSIZE parts, S3_TRANSFER_MAX_CONCURRENCY parts at a time.
+    """
+    return TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+        max_concurrency=S3_TRANSFER_MAX_CONCURRENCY,
+        use_threads=True
+    )
+
+# Id de la regla CORS de la app: se actualiza sin tocar las demás reglas del bucket
+APP_CORS_RULE_ID = 'sticker-app-browser-access'
+
+def ensure_bucket_cors(allowed_origins=None, bucket_name=None, allow_post=False):
+    """
+    Add or update this app's CORS rule on the S3 bucket, so images served via
+    redirect (presigned or CDN URLs) can be drawn on a canvas and reference
+    images can be uploaded from the browser. Other CORS rules are kept.
+    One-off setup (see the setup-bucket command), not run at startup.
+    
+    Args:
+        allowed_origins (list, optional): Origins allowed by the rule (defaults to '*', GET only)
+        bucket_name (str, optional): Override the default bucket name from env variables
+        allow_post (bool): Also allow browser POST uploads (presigned reference uploads)
+        
+    Returns:
+        bool: True if the rule is in place, False otherwise
+        
+    Raises:
+        ValueError: If POST is requested for every origin ('*')
+    """
+    bucket = bucket_name or os.getenv('AWS_S3_BUCKET_NAME')
+    if not bucket:
+        return False
+    
+    origins = allowed_origins or ['*']
+    if allow_post and '*' in origins:
+        raise ValueError("Browser uploads need explicit origins: set S3_CORS_ALLOWED_ORIGINS")
+    
+    rule = {
+        'ID': APP_CORS_RULE_ID,
+        'AllowedMethods': ['GET', 'HEAD', 'POST'] if allow_post else ['GET', 'HEAD'],
+        'AllowedOrigins': origins,
+        'AllowedHeaders': ['*'],
+        'ExposeHeaders': ['ETag', 'Content-Length', 'Content-Range'],
+        'MaxAgeSeconds': 86400
+    }
+    
+    s3_client = get_s3_client()
+    try:
+        try:
+            rules = s3_client.get_bucket_cors(Bucket=bucket).get('CORSRules', [])
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchCORSConfiguration':
+                raise
+            rules = []
+        if rule in rules:
+            return True
+        rules = [existing for existing in rules if existing.get('ID') != APP_CORS_RULE_ID] + [rule]
+        s3_client.put_bucket_cors(Bucket=bucket, CORSConfiguration={'CORSRules': rules})
+        return True
+    except ClientError as e:
+        logger.error(f"Error configuring CORS on S3 bucket: {e}")
+        return False
+
+# Ids de las reglas de lifecycle de la app: se actualizan sin tocar las demás reglas del bucket
+APP_REFERENCE_LIFECYCLE_RULE_ID = 'sticker-app-expire-reference-uploads'
+APP_SPRITES_LIFECYCLE_RULE_ID = 'sticker-app-expire-history-sprites'
+
+def ensure_expiration_rule(rule_id, prefix, expiration_days, bucket_name=None):
+    """
+    Add or update a lifecycle rule of this app that expires every object under
+    prefix. Other lifecycle rules are kept.
+    One-off setup (see the setup-bucket command), not run at startup.
+    
+    Args:
+        rule_id (str): Id of the rule (APP_*_LIFECYCLE_RULE_ID)
+        prefix (str): Key prefix the rule applies to
+        expiration_days (int): Days after which an object is deleted
+        bucket_name (str, optional): Override the default bucket name from env variables
+        
+    Returns:
+        bool: True if the rule is in place, False otherwise
+    """
+    bucket = bucket_name or os.getenv('AWS_S3_BUCKET_NAME')
+    if not bucket:
+        return False
+    
+    rule = {
+        'ID': rule_id,
+        'Filter': {'Prefix': prefix},
+        'Status': 'Enabled',
+        'Expiration': {'Days': expiration_days},
+        'AbortIncompleteMultipartUpload': {'DaysAfterInitiation': expiration_days}
+    }
+    
+    s3_client = get_s3_client()
+    try:
+        try:
+            rules = s3_client.get_bucket_lifecycle_configuration(Bucket=bucket).get('Rules', [])
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchLifecycleConfiguration':
+                raise
+            rules = []
+        if rule in rules:
+            return True
+        rules = [existing for existing in rules if existing.get('ID') != rule_id] + [rule]
+        s3_client.put_bucket_lifecycle_configuration(Bucket=bucket, LifecycleConfiguration={'Rules': rules})
+        return True
+    except ClientError as e:
+        logger.error(f"Error configuring lifecycle on S3 bucket: {e}")
+        return False
+
 def upload_file_to_s3(file_path, object_name=None, folder=S3_STICKERS_FOLDER, bucket_name=None):
     """
     Upload a file to an S3 bucket
@@ -58,7 +190,8 @@ def upload_file_to_s3(file_path, object_name=None, folder=S3_STICKERS_FOLDER, bu
     # Upload the file
     s3_client = get_s3_client()
     try:
-        s3_client.upload_file(file_path, bucket, object_name)
+        s3_client.upload_file(file_path, bucket, object_name, Config=get_transfer_config())
+        s3_filename_index.add_key(object_name)
         
         # Generate URL for the file
         presigned_url = s3_client.generate_presigned_url(
@@ -102,6 +235,7 @@ def upload_bytes_to_s3(file_bytes, object_name, content_type='image/png', folder
             Key=object_name,
             ContentType=content_type
         )
+        s3_filename_index.add_key(object_name)
         
         # Generate URL for the file
         presigned_url = s3_client.generate_presigned_url(
@@ -114,6 +248,173 @@ def upload_bytes_to_s3(file_bytes, object_name, content_type='image/png', folder
         logger.error(f"Error uploading to S3: {e}")
         return False, str(e)
 
+def upload_bytes_write_behind(file_bytes, object_name, content_type='image/png', folder=S3_STICKERS_FOLDER, bucket_name=None):
+    """
+    Like upload_bytes_to_s3, but returns as soon as the data is in the local
+    upload spool; the S3 upload happens in the background. Falls back to a
+    synchronous upload if the spool isn't running.
+    
+    Returns:
+        tuple: (bool success, str url_or_error)
+    """
+    bucket = bucket_name or os.getenv('AWS_S3_BUCKET_NAME')
+    if not bucket:
+        return False, "AWS S3 bucket name not specified"
+    
+    if folder and not object_name.startswith(f"{folder}/"):
+        object_name = f"{folder}/{object_name}"
+    
+    data = file_bytes.getvalue() if hasattr(file_bytes, 'getvalue') else bytes(file_bytes)
+    if not upload_spool.spool(object_name, data, content_type, bucket):
+        return upload_bytes_to_s3(BytesIO(data), object_name, content_type=content_type, folder=None, bucket_name=bucket)
+    
+    # Calentar la cache local para que siga sirviéndose sin S3 una vez subido
+    image_cache.put(object_name, data)
+    s3_filename_index.add_key(object_name)
+    
+    # La URL prefirmada se genera localmente; es válida en cuanto termine la subida
+    presigned_url = get_s3_client().generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': object_name},
+        ExpiresIn=604800  # URL expires in 7 days (in seconds)
+    )
+    return True, presigned_url
+
+def store_sticker_bytes(file_bytes, filename, content_type='image/png', bucket_name=None):
+    """
+    Store a generated sticker content-addressed: the bytes go once to
+    {S3_CONTENT_FOLDER}/{sha256}.ext and the sticker key becomes a reference to
+    them. Identical bytes (placeholders, retries) skip put_object entirely.
+    Falls back to upload_bytes_write_behind if content addressing is disabled.
+    
+    Args:
+        file_bytes (BytesIO or bytes): Image contents
+        filename (str): Sticker filename (sticker_{owner}_{ts}[_high].png)
+        content_type (str): MIME type of the image
+        bucket_name (str, optional): Override the default bucket name from env variables
+        
+    Returns:
+        tuple: (bool success, str url_or_error)
+    """
+    if not STICKER_CONTENT_ADDRESSING:
+        return upload_bytes_write_behind(file_bytes, filename, content_type=content_type, bucket_name=bucket_name)
+    
+    bucket = bucket_name or os.getenv('AWS_S3_BUCKET_NAME')
+    if not bucket:
+        return False, "AWS S3 bucket name not specified"
+    
+    data = file_bytes.getvalue() if hasattr(file_bytes, 'getvalue') else bytes(file_bytes)
+    content_key = content_store.content_key_for(data, filename)
+    ref_key = canonical_key(filename)
+    s3_client = get_s3_client()
+    
+    use_spool = True
+    try:
+        try:
+            spooled_ref = upload_spool.add_ref(content_key, ref_key)
+        except OSError as e:
+            # Disco local lleno o sin permisos: el sticker ya está generado (y
+            # pagado), así que se sube directamente a S3 sin pasar por el spool
+            logger.error(f"Error spooling reference {ref_key}, uploading directly: {e}")
+            spooled_ref, use_spool = False, False
+        
+        if spooled_ref:
+            # El mismo contenido aún está pendiente de subir: la referencia se
+            # escribe cuando termine
+            logger.info(f"Deduplicated {filename} against spooled {content_key}")
+        elif content_store.content_exists(s3_client, bucket, content_key):
+            content_store.put_ref(s3_client, bucket, ref_key, content_key, content_type)
+            logger.info(f"Deduplicated {filename} against {content_key}")
+        elif not (use_spool and upload_spool.spool(content_key, data, content_type, bucket, refs=[ref_key],
+                                                   cache_control=content_store.IMMUTABLE_CACHE_CONTROL)):
+            s3_client.put_object(
+                Bucket=bucket, Key=content_key, Body=data, ContentType=content_type,
+                CacheControl=content_store.IMMUTABLE_CACHE_CONTROL
+            )
+            content_store.mark_known(content_key)
+            content_store.put_ref(s3_client, bucket, ref_key, content_key, content_type)
+    except ClientError as e:
+        logger.error(f"Error storing {filename} as {content_key}: {e}")
+        return False, str(e)
+    
+    # Los lectores ya no necesitan leer la referencia (en ningún worker de la máquina)
+    remember_key(filename, content_key)
+    s3_filename_index.add_content(filename, content_key)
+    image_cache.put(content_key, data)
+    s3_filename_index.add_key(ref_key)
+    
+    presigned_url = s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': content_key},
+        ExpiresIn=604800  # URL expires in 7 days (in seconds)
+    )
+    return True, presigned_url
+
+def reference_upload_prefix(owner):
+    return f"{S3_REFERENCE_UPLOADS_FOLDER}/{owner}/"
+
+def create_reference_upload(owner, content_type, bucket_name=None):
+    """
+    Presigned POST for a browser to upload a reference image straight to the
+    staging prefix of its owner, limited in size and content type.
+    
+    Args:
+        owner (str): user_id or session_id
+        content_type (str): MIME type the browser will upload
+        bucket_name (str, optional): Override the default bucket name from env variables
+        
+    Returns:
+        dict: {'url', 'fields', 'key'} for the upload form, or None if not allowed
+    """
+    bucket = bucket_name or os.getenv('AWS_S3_BUCKET_NAME')
+    if not bucket or content_type not in REFERENCE_UPLOAD_CONTENT_TYPES:
+        return None
+    
+    key = f"{reference_upload_prefix(owner)}{sticker_ids.new_sticker_id()}"
+    try:
+        post = get_s3_client().generate_presigned_post(
+            Bucket=bucket,
+            Key=key,
+            Fields={'Content-Type': content_type},
+            Conditions=[
+                {'Content-Type': content_type},
+                ['content-length-range', 1, REFERENCE_UPLOAD_MAX_BYTES]
+            ],
+            ExpiresIn=REFERENCE_UPLOAD_EXPIRATION
+        )
+    except ClientError as e:
+        logger.error(f"Error creating presigned POST for {key}: {e}")
+        return None
+    return {'url': post['url'], 'fields': post['fields'], 'key': key}
+
+def is_reference_upload_of(key, owner):
+    """
+    True if key is a staged reference upload created for owner
+    """
+    return bool(key) and key.startswith(reference_upload_prefix(owner)) and '..' not in key
+
+def open_reference_upload(key, bucket_name=None):
+    """
+    Open a staged reference image for reading (check ownership with is_reference_upload_of first)
+    
+    Returns:
+        StreamingBody: Object body (read it once), or None if missing or not allowed
+    """
+    bucket = bucket_name or os.getenv('AWS_S3_BUCKET_NAME')
+    if not bucket or not key or not key.startswith(f"{S3_REFERENCE_UPLOADS_FOLDER}/"):
+        return None
+    try:
+        s3_object = get_s3_client().get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        logger.error(f"Error opening reference upload {key}: {e}")
+        return None
+    # La política del POST ya limita el tamaño; se comprueba por si cambió la configuración
+    if s3_object.get('ContentLength', 0) > REFERENCE_UPLOAD_MAX_BYTES:
+        s3_object['Body'].close()
+        logger.error(f"Reference upload {key} exceeds {REFERENCE_UPLOAD_MAX_BYTES} bytes")
+        return None
+    return s3_object['Body']
+
 def delete_file_from_s3(object_name, folder=None, bucket_name=None):
     """
     Delete a file from an S3 bucket
@@ -163,6 +464,131 @@ def upload_template_to_s3(template_file_path, template_name=None):
         folder=S3_TEMPLATES_FOLDER
     )
 
+class _BatchProgress:
+    """
+    Aggregates per-object byte callbacks from boto3 into a single progress callback
+    """
+    def __init__(self, total_files, progress_callback=None):
+        self._lock = threading.Lock()
+        self.total_files = total_files
+        self.completed_files = 0
+        self.bytes_transferred = 0
+        self._progress_callback = progress_callback
+
+    def _notify(self):
+        if self._progress_callback:
+            try:
+                self._progress_callback(self.completed_files, self.total_files, self.bytes_transferred)
+            except Exception as e:
+                logger.error(f"Error in S3 batch progress callback: {e}")
+
+    def add_bytes(self, amount):
+        with self._lock:
+            self.bytes_transferred += amount
+            self._notify()
+
+    def file_done(self):
+        with self._lock:
+            self.completed_files += 1
+            self._notify()
+
+def upload_files_to_s3(files, folder=S3_STICKERS_FOLDER, bucket_name=None, max_workers=None, progress_callback=None):
+    """
+    Upload many files to S3 concurrently
+    
+    Args:
+        files (list): List of (file_path, object_name) tuples; object_name may be None
+        folder (str, optional): S3 folder to store the files in
+        bucket_name (str, optional): Override the default bucket name from env variables
+        max_workers (int, optional): Files transferred in parallel (defaults to S3_BATCH_MAX_WORKERS)
+        progress_callback (callable, optional): Called as (completed_files, total_files, bytes_transferred)
+        
+    Returns:
+        dict: object_name -> (bool success, str url_or_error)
+    """
+    bucket = bucket_name or os.getenv('AWS_S3_BUCKET_NAME')
+    if not bucket:
+        return {obj or os.path.basename(path): (False, "AWS S3 bucket name not specified") for path, obj in files}
+    
+    s3_client = get_s3_client()
+    transfer_config = get_transfer_config()
+    progress = _BatchProgress(len(files), progress_callback)
+    
+    def upload_one(file_path, object_name):
+        if object_name is None:
+            object_name = os.path.basename(file_path)
+        if folder and not object_name.startswith(f"{folder}/"):
+            object_name = f"{folder}/{object_name}"
+        try:
+            s3_client.upload_file(
+                file_path, bucket, object_name,
+                Config=transfer_config,
+                Callback=progress.add_bytes
+            )
+            s3_filename_index.add_key(object_name)
+            presigned_url = s3_client.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': bucket, 'Key': object_name},
+                ExpiresIn=604800  # URL expires in 7 days (in seconds)
+            )
+            return object_name, (True, presigned_url)
+        except (ClientError, OSError) as e:
+            logger.error(f"Error uploading {file_path} to S3: {e}")
+            return object_name, (False, str(e))
+        finally:
+            progress.file_done()
+    
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers or S3_BATCH_MAX_WORKERS) as executor:
+        futures = [executor.submit(upload_one, path, obj) for path, obj in files]
+        for future in as_completed(futures):
+            object_name, result = future.result()
+            results[object_name] = result
+    return results
+
+def download_files_from_s3(downloads, bucket_name=None, max_workers=None, progress_callback=None):
+    """
+    Download many S3 objects to local files concurrently
+    
+    Args:
+        downloads (list): List of (object_name, local_path) tuples
+        bucket_name (str, optional): Override the default bucket name from env variables
+        max_workers (int, optional): Files transferred in parallel (defaults to S3_BATCH_MAX_WORKERS)
+        progress_callback (callable, optional): Called as (completed_files, total_files, bytes_transferred)
+        
+    Returns:
+        dict: object_name -> bool success
+    """
+    bucket = bucket_name or os.getenv('AWS_S3_BUCKET_NAME')
+    if not bucket:
+        return {obj: False for obj, _ in downloads}
+    
+    s3_client = get_s3_client()
+    transfer_config = get_transfer_config()
+    progress = _BatchProgress(len(downloads), progress_callback)
+    
+    def download_one(object_name, local_path):
+        try:
+            s3_client.download_file(
+                bucket, object_name, local_path,
+                Config=transfer_config,
+                Callback=progress.add_bytes
+            )
+            return object_name, True
+        except (ClientError, OSError) as e:
+            logger.error(f"Error downloading {object_name} from S3: {e}")
+            return object_name, False
+        finally:
+            progress.file_done()
+    
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers or S3_BATCH_MAX_WORKERS) as executor:
+        futures = [executor.submit(download_one, obj, path) for obj, path in downloads]
+        for future in as_completed(futures):
+            object_name, success = future.result()
+            results[object_name] = success
+    return results
+
 def list_files_in_s3_folder(folder=S3_STICKERS_FOLDER, bucket_name=None):
     """
     List all files in a specific folder in the S3 bucket
@@ -202,7 +628,7 @@ def list_files_in_s3_folder(folder=S3_STICKERS_FOLDER, bucket_name=None):
         logger.error(f"Error listing files in S3 folder: {e}")
         return []
 
-def list_files_by_user_id(user_id, folder=S3_STICKERS_FOLDER, bucket_name=None):
+def list_files_by_user_id(user_id, folder=S3_STICKERS_FOLDER, bucket_name=None, newer_than=None):
     """
     List all files for a specific user_id in the S3 bucket
     
@@ -210,6 +636,7 @@ def list_files_by_user_id(user_id, folder=S3_STICKERS_FOLDER, bucket_name=None):
         user_id (str): The user ID to filter files by
         folder (str): The folder path in S3 to list
         bucket_name (str, optional): Override the default bucket name
+        newer_than (str, optional): Sticker filename or id; only newer stickers are listed
         
     Returns:
         list: List of file keys for the user
@@ -224,22 +651,176 @@ def list_files_by_user_id(user_id, folder=S3_STICKERS_FOLDER, bucket_name=None):
         if not folder.endswith('/'):
             folder = f"{folder}/"
         
-        response = s3_client.list_objects_v2(
-            Bucket=bucket,
-            Prefix=folder
-        )
+        # Listar solo el prefijo del usuario (antes se listaba la carpeta entera)
+        prefix = f"{folder}sticker_{user_id}_"
+        params = {'Bucket': bucket, 'Prefix': prefix}
+        
+        after_id = None
+        if newer_than:
+            parsed = sticker_ids.parse_sticker_filename(newer_than)
+            after_id = parsed[1] if parsed else newer_than
+        if sticker_ids.is_ulid(after_id):
+            # Las keys están ordenadas por tiempo: empezar justo después de after_id
+            # ('~' es mayor que '.' y '_', así se saltan también sus variantes)
+            params['StartAfter'] = f"{prefix}{after_id}~"
         
         files = []
-        if 'Contents' in response:
-            for obj in response['Contents']:
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**params):
+            for obj in page.get('Contents', []):
                 key = obj['Key']
-                # Skip the folder itself and filter by user_id in filename
-                if key != folder:
-                    filename = os.path.basename(key)
-                    if filename.startswith(f"sticker_{user_id}_"):
-                        files.append(key)
+                parsed = sticker_ids.parse_sticker_filename(key)
+                if 'StartAfter' in params and parsed and not sticker_ids.is_ulid(parsed[1]):
+                    # Tras los ULID vienen los ids antiguos, todos anteriores
+                    return files
+                files.append(key)
         
+        if after_id and not sticker_ids.is_ulid(after_id):
+            # Id antiguo: no hay rango contiguo, filtrar por orden de creación
+            bound = sticker_ids.sticker_sort_key(f"sticker_{user_id}_{after_id}_high.png")
+            files = [key for key in files if sticker_ids.sticker_sort_key(key) > bound]
         return files
     except ClientError as e:
         logger.error(f"Error listing files by user_id in S3 folder: {e}")
-        return [] 
\ No newline at end of file
+        return []
+
+# Ventana inicial al buscar hacia atrás los stickers de una página (se duplica
+# hasta completarla)
+HISTORY_SEEK_WINDOW_MS = 7 * 24 * 3600 * 1000
+
+def _list_sticker_range(s3_client, bucket, prefix, start_after=None, end=None, ulid=True, page_size=None):
+    """
+    Standard-resolution sticker filenames with keys in (start_after, end), in
+    key order. With ulid=True the listing stops at the first legacy id.
+    """
+    params = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after:
+        params['StartAfter'] = start_after
+    if page_size:
+        # Una página del historial (más sus _high) por petición: lo que se lea
+        # más allá de end se descarta
+        params['PaginationConfig'] = {'PageSize': page_size}
+    
+    filenames = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**params):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if end and key >= end:
+                return filenames
+            parsed = sticker_ids.parse_sticker_filename(key)
+            if not parsed:
+                continue
+            if sticker_ids.is_ulid(parsed[1]) != ulid:
+                if ulid:
+                    # Tras los ULID vienen los ids antiguos
+                    return filenames
+                continue
+            if not parsed[2] and key.endswith('.png'):
+                filenames.append(os.path.basename(key))
+    return filenames
+
+def list_sticker_page(user_id, cursor=None, page_size=20, folder=S3_STICKERS_FOLDER, bucket_name=None):
+    """
+    One page of a user's stickers (standard resolution), newest first, read by
+    key range instead of listing the user's whole prefix.
+    
+    ULID keys sort by creation time, so the stickers before the cursor are
+    found by listing time windows backwards from it: StartAfter at the start of
+    the window, stopping at its end, doubling the window until the page is
+    full. Legacy timestamp ids sort after every ULID but are older, so they are
+    only listed once the ULIDs run out.
+    
+    Args:
+        user_id (str): The user ID (or session_id) that owns the stickers
+        cursor (str, optional): Last filename of the previous page
+        page_size (int): Stickers per page
+        folder (str): The folder path in S3 to list
+        bucket_name (str, optional): Override the default bucket name
+        
+    Returns:
+        tuple: (list filenames, str next_cursor or None)
+    """
+    bucket = bucket_name or os.getenv('AWS_S3_BUCKET_NAME')
+    if not bucket:
+        return [], None
+    if not folder.endswith('/'):
+        folder = f"{folder}/"
+    
+    s3_client = get_s3_client()
+    prefix = f"{folder}sticker_{user_id}_"
+    # Uno más para saber si hay página siguiente
+    wanted = page_size + 1
+    request_size = page_size * 2 + 2
+    parsed = sticker_ids.parse_sticker_filename(cursor) if cursor else None
+    cursor_id = parsed[1] if parsed else None
+    
+    filenames = []
+    try:
+        if cursor_id is None or sticker_ids.is_ulid(cursor_id):
+            end = f"{prefix}{cursor_id}" if cursor_id else None
+            # Margen de un minuto por relojes desfasados entre workers
+            high_ms = sticker_ids.id_timestamp_ms(cursor_id) if cursor_id else int(time.time() * 1000) + 60000
+            window_ms = HISTORY_SEEK_WINDOW_MS
+            while len(filenames) < wanted:
+                low_ms = max(high_ms - window_ms, 0)
+                start_after = f"{prefix}{sticker_ids.ulid_time_prefix(low_ms)}" if low_ms else None
+                window = _list_sticker_range(s3_client, bucket, prefix, start_after, end, page_size=request_size)
+                filenames.extend(sorted(window, key=sticker_ids.sticker_sort_key, reverse=True))
+                if not low_ms:
+                    break
+                end, high_ms, window_ms = start_after, low_ms, window_ms * 2
+        
+        if len(filenames) < wanted:
+            # Ids antiguos: empiezan por un dígito distinto de 0, después de todos los ULID
+            legacy = _list_sticker_range(s3_client, bucket, prefix, f"{prefix}0~", ulid=False)
+            if cursor_id and not sticker_ids.is_ulid(cursor_id):
+                bound = sticker_ids.sticker_sort_key(cursor)
+                legacy = [name for name in legacy if sticker_ids.sticker_sort_key(name) < bound]
+            filenames.extend(sorted(legacy, key=sticker_ids.sticker_sort_key, reverse=True))
+    except ClientError as e:
+        logger.error(f"Error listing sticker page for {user_id}: {e}")
+        return [], None
+    
+    page = filenames[:page_size]
+    next_cursor = page[-1] if len(filenames) > page_size else None
+    return page, next_cursor
+
+
+if __name__ == '__main__':
+    # Configuración única del bucket (desde la raíz del repo), no al arrancar:
+    #   PYTHONPATH=app python -m utils.s3_utils setup-bucket
+    import sys
+    from config import (
+        AWS_S3_BUCKET_NAME, IMAGE_SERVE_MODE, S3_CORS_ALLOWED_ORIGINS, REFERENCE_DIRECT_UPLOAD_ENABLED,
+        S3_SPRITES_FOLDER, HISTORY_SPRITE_EXPIRATION_DAYS
+    )
+    
+    if sys.argv[1:] != ['setup-bucket']:
+        print("Usage: python -m utils.s3_utils setup-bucket")
+        sys.exit(1)
+    
+    if IMAGE_SERVE_MODE == 'redirect' or REFERENCE_DIRECT_UPLOAD_ENABLED:
+        try:
+            configured = ensure_bucket_cors(S3_CORS_ALLOWED_ORIGINS, AWS_S3_BUCKET_NAME,
+                                            allow_post=REFERENCE_DIRECT_UPLOAD_ENABLED)
+        except ValueError as e:
+            print(f"CORS not configured: {e}")
+            sys.exit(1)
+        print(f"CORS rule {APP_CORS_RULE_ID} {'configured' if configured else 'FAILED'} on {AWS_S3_BUCKET_NAME}")
+        if not configured:
+            sys.exit(1)
+    else:
+        print("CORS not needed (IMAGE_SERVE_MODE is not 'redirect' and direct uploads are disabled)")
+    
+    # Subidas de referencia que no se borraron (generación fallida o abandonada) y
+    # sprites del historial que ya no corresponden a ninguna página
+    expiration_rules = [(APP_SPRITES_LIFECYCLE_RULE_ID, f"{S3_SPRITES_FOLDER}/", HISTORY_SPRITE_EXPIRATION_DAYS)]
+    if REFERENCE_DIRECT_UPLOAD_ENABLED:
+        expiration_rules.append((APP_REFERENCE_LIFECYCLE_RULE_ID, f"{S3_REFERENCE_UPLOADS_FOLDER}/", 1))
+    for rule_id, prefix, days in expiration_rules:
+        expiring = ensure_expiration_rule(rule_id, prefix, days, AWS_S3_BUCKET_NAME)
+        print(f"Lifecycle rule {rule_id} {'configured' if expiring else 'FAILED'} "
+              f"on {AWS_S3_BUCKET_NAME} ({prefix} expires after {days} days)")
+        if not expiring:
+            sys.exit(1)
@@ -0,0 +1,285 @@
+import os
+import re
+import json
+import time
+import logging
+import argparse
+from datetime import datetime, timezone, timedelta
+from botocore.exceptions import ClientError
+
+from utils.sticker_ids import STICKER_ID_PATTERN
+from config import (
+    AWS_S3_BUCKET_NAME, S3_STICKERS_FOLDER, S3_PURCHASES_FOLDER, S3_CONTENT_FOLDER,
+    STICKER_CLEANUP_MIN_AGE_DAYS, STICKER_CLEANUP_BATCHES_PER_SECOND,
+    STICKER_CLEANUP_CHECKPOINT_PATH
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Deletes stickers of abandoned anonymous sessions from S3_STICKERS_FOLDER.
+# - Stickers are named sticker_{owner}_{id}[_high].ext (id: ULID or legacy
+#   unix timestamp, see utils/sticker_ids.py), where owner is
+#   the user_id for registered users and the session_id for anonymous visitors.
+#   Keys are listed in lexicographic order, so all stickers of an owner are
+#   contiguous and each owner is decided once.
+# - An owner is deleted only if it isn't a registered user, never purchased
+#   (no marker in S3_PURCHASES_FOLDER) and its newest sticker is older than
+#   min_age_days.
+# - Deletions use DeleteObjects in batches of 1000 keys, rate limited to
+#   batches_per_second. After each batch the last deleted key is checkpointed
+#   so an interrupted run resumes with StartAfter.
+# - With STICKER_CONTENT_ADDRESSING the sticker keys are zero-byte references
+#   and only they are deleted; the objects in S3_CONTENT_FOLDER may be shared
+#   and are not collected, so bytes_reclaimed stays near zero. The report counts
+#   them as content_refs_deleted.
+
+DELETE_BATCH_SIZE = 1000
+
+STICKER_OWNER_PATTERN = re.compile(r'^sticker_([A-Za-z0-9-]+)_' + STICKER_ID_PATTERN + r'(?:_high)?\.[A-Za-z0-9]+$')
+
+
+def sticker_owner(key):
+    """
+    Returns the owner (user_id or session_id) encoded in a sticker key, or None
+    """
+    match = STICKER_OWNER_PATTERN.match(os.path.basename(key))
+    return match.group(1) if match else None
+
+
+def record_purchase(filenames, s3_client=None, bucket=None):
+    """
+    Mark the owners of purchased stickers so cleanup never deletes them.
+
+    Args:
+        filenames (list): Sticker filenames (or keys) included in the purchase
+        s3_client (optional): boto3 S3 client
+        bucket (str, optional): Bucket name (defaults to AWS_S3_BUCKET_NAME)
+
+    Returns:
+        int: Number of owners marked
+    """
+    owners = {owner for owner in (sticker_owner(name) for name in filenames) if owner}
+    if not owners:
+        return 0
+
+    if s3_client is None:
+        from utils.s3_utils import get_s3_client
+        s3_client = get_s3_client()
+    bucket = bucket or AWS_S3_BUCKET_NAME
+
+    marked = 0
+    for owner in owners:
+        try:
+            s3_client.put_object(Bucket=bucket, Key=f"{S3_PURCHASES_FOLDER}/{owner}", Body=b'')
+            marked += 1
+        except ClientError as e:
+            logger.error(f"Error recording purchase marker for {owner}: {e}")
+    return marked
+
+
+def load_purchased_owners(s3_client, bucket):
+    """
+    Returns the set of owners with a purchase marker
+    """
+    owners = set()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{S3_PURCHASES_FOLDER}/"):
+        for obj in page.get('Contents', []):
+            owner = obj['Key'][len(S3_PURCHASES_FOLDER) + 1:]
+            if owner:
+                owners.add(owner)
+    return owners
+
+
+def _is_registered_user(users_table, owner):
+    # A diferencia de get_user(), un error de DynamoDB se propaga: ante la
+    # duda nunca se trata a un usuario registrado como anónimo
+    return 'Item' in users_table.get_item(Key={'user_id': owner}, ProjectionExpression='user_id')
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path, 'r') as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get('completed'):
+        return None
+    return checkpoint.get('last_key')
+
+
+def _save_checkpoint(path, last_key, report, completed=False):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump({
+            'last_key': last_key,
+            'completed': completed,
+            'updated_at': int(time.time()),
+            'report': report
+        }, checkpoint_file)
+    os.replace(tmp_path, path)
+
+
+def cleanup_anonymous_stickers(s3_client=None, bucket=None, min_age_days=None, dry_run=True,
+                               batches_per_second=None, checkpoint_path=None, resume=True,
+                               users_table=None):
+    """
+    Delete the stickers of abandoned anonymous sessions.
+
+    Args:
+        s3_client (optional): boto3 S3 client
+        bucket (str, optional): Bucket name (defaults to AWS_S3_BUCKET_NAME)
+        min_age_days (int, optional): Minimum age of the owner's newest sticker
+        dry_run (bool): If True, only report what would be deleted
+        batches_per_second (float, optional): Max DeleteObjects calls per second
+        checkpoint_path (str, optional): Checkpoint file (not written in dry runs)
+        resume (bool): Continue after the key stored in the checkpoint
+        users_table (optional): DynamoDB users Table used to detect registered owners
+
+    Returns:
+        dict: Report with scanned/deleted counts and bytes reclaimed
+    """
+    if s3_client is None:
+        from utils.s3_utils import get_s3_client
+        s3_client = get_s3_client()
+    if users_table is None:
+        from utils.dynamodb_utils import get_table, USER_TABLE
+        users_table = get_table(USER_TABLE)
+
+    bucket = bucket or AWS_S3_BUCKET_NAME
+    min_age_days = STICKER_CLEANUP_MIN_AGE_DAYS if min_age_days is None else min_age_days
+    batches_per_second = batches_per_second or STICKER_CLEANUP_BATCHES_PER_SECOND
+    checkpoint_path = checkpoint_path or STICKER_CLEANUP_CHECKPOINT_PATH
+    cutoff = datetime.now(timezone.utc) - timedelta(days=min_age_days)
+
+    report = {
+        'dry_run': dry_run,
+        'min_age_days': min_age_days,
+        'scanned_keys': 0,
+        'owners_checked': 0,
+        'owners_deleted': 0,
+        'kept_registered': 0,
+        'kept_purchased': 0,
+        'kept_recent': 0,
+        'skipped_unrecognized': 0,
+        'deleted_keys': 0,
+        'bytes_reclaimed': 0,
+        'content_refs_deleted': 0,
+        'delete_errors': 0,
+        'batches': 0
+    }
+
+    purchased = load_purchased_owners(s3_client, bucket)
+    start_after = _load_checkpoint(checkpoint_path) if resume and not dry_run else None
+    if start_after:
+        logger.info(f"Resuming sticker cleanup after {start_after}")
+
+    pending = []
+    min_interval = 1.0 / batches_per_second if batches_per_second > 0 else 0
+    last_batch_at = [0.0]
+
+    def flush(objects):
+        report['batches'] += 1
+        if dry_run:
+            report['deleted_keys'] += len(objects)
+            report['bytes_reclaimed'] += sum(size for _, size in objects)
+            report['content_refs_deleted'] += sum(1 for _, size in objects if size == 0)
+            return
+
+        wait = min_interval - (time.time() - last_batch_at[0])
+        if wait > 0:
+            time.sleep(wait)
+        last_batch_at[0] = time.time()
+
+        sizes = dict(objects)
+        response = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key, _ in objects], 'Quiet': True}
+        )
+        failed = {error['Key'] for error in response.get('Errors', [])}
+        for error in response.get('Errors', []):
+            logger.error(f"Error deleting {error['Key']}: {error.get('Code')} {error.get('Message')}")
+        report['delete_errors'] += len(failed)
+        report['deleted_keys'] += len(objects) - len(failed)
+        report['bytes_reclaimed'] += sum(size for key, size in sizes.items() if key not in failed)
+        report['content_refs_deleted'] += sum(1 for key, size in sizes.items() if key not in failed and size == 0)
+        # Las claves se procesan en orden: todo lo anterior ya está decidido.
+        # Repetir un borrado al reanudar es inofensivo (DeleteObjects es idempotente)
+        _save_checkpoint(checkpoint_path, objects[-1][0], report)
+
+    def decide(owner, objects):
+        report['owners_checked'] += 1
+        if owner in purchased:
+            report['kept_purchased'] += 1
+        elif max(modified for _, _, modified in objects) > cutoff:
+            report['kept_recent'] += 1
+        elif _is_registered_user(users_table, owner):
+            report['kept_registered'] += 1
+        else:
+            report['owners_deleted'] += 1
+            pending.extend((key, size) for key, size, _ in objects)
+
+        while len(pending) >= DELETE_BATCH_SIZE:
+            flush(pending[:DELETE_BATCH_SIZE])
+            del pending[:DELETE_BATCH_SIZE]
+
+    params = {'Bucket': bucket, 'Prefix': f"{S3_STICKERS_FOLDER}/"}
+    if start_after:
+        params['StartAfter'] = start_after
+
+    current_owner, current_objects = None, []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**params):
+        for obj in page.get('Contents', []):
+            report['scanned_keys'] += 1
+            owner = sticker_owner(obj['Key'])
+            if owner is None:
+                report['skipped_unrecognized'] += 1
+                continue
+            if owner != current_owner and current_objects:
+                decide(current_owner, current_objects)
+                current_objects = []
+            current_owner = owner
+            current_objects.append((obj['Key'], obj['Size'], obj['LastModified']))
+
+    if current_objects:
+        decide(current_owner, current_objects)
+    if pending:
+        flush(pending)
+        del pending[:]
+    if not dry_run:
+        _save_checkpoint(checkpoint_path, None, report, completed=True)
+
+    if report['content_refs_deleted']:
+        logger.warning(f"{report['content_refs_deleted']} deleted keys were content references; "
+                       f"their objects in {S3_CONTENT_FOLDER}/ were not reclaimed")
+    logger.info(f"Sticker cleanup finished: {report}")
+    return report
+
+
+if __name__ == '__main__':
+    # Uso (desde la raíz del repo):
+    #   PYTHONPATH=app python -m utils.sticker_cleanup --days 45            (dry run)
+    #   PYTHONPATH=app python -m utils.sticker_cleanup --days 45 --execute
+    parser = argparse.ArgumentParser(description="Borra stickers de sesiones anónimas abandonadas")
+    parser.add_argument('--days', type=int, default=STICKER_CLEANUP_MIN_AGE_DAYS)
+    parser.add_argument('--execute', action='store_true', help="Borrar de verdad (por defecto solo dry run)")
+    parser.add_argument('--batches-per-second', type=float, default=STICKER_CLEANUP_BATCHES_PER_SECOND)
+    parser.add_argument('--checkpoint', default=STICKER_CLEANUP_CHECKPOINT_PATH)
+    parser.add_argument('--restart', action='store_true', help="Ignorar el checkpoint y empezar desde el principio")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    result = cleanup_anonymous_stickers(
+        min_age_days=args.days,
+        dry_run=not args.execute,
+        batches_per_second=args.batches_per_second,
+        checkpoint_path=args.checkpoint,
+        resume=not args.restart
+    )
+    action = "Deleted" if args.execute else "Would delete"
+    print(f"{action} {result['deleted_keys']} keys from {result['owners_deleted']} sessions, "
+          f"{result['bytes_reclaimed'] / 1024 / 1024:.1f} MB reclaimed")
+    print(json.dumps(result, indent=2))
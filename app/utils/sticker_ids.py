@@ -0,0 +1,115 @@
+import os
+import re
+import time
+import threading
+
+# Time-sortable sticker ids (ULID: 48-bit millisecond timestamp + 80 random
+# bits, 26 chars of Crockford base32).
+# - Stickers used to be named sticker_{owner}_{unix seconds}.png, so two
+#   generations in the same second overwrote each other. ULIDs are unique and
+#   monotonic within a process (same millisecond -> random part + 1).
+# - Within an owner prefix, keys sort by creation time, so "newer than X" and
+#   "page after Y" are a StartAfter on the listing instead of reading everything.
+# - Legacy ids are all digits and start with '1'; every ULID of this era starts
+#   with '0', so legacy stickers sort after the ULIDs in S3 listings. They are
+#   older, and sticker_sort_key() orders both formats consistently.
+
+CROCKFORD_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+ULID_LENGTH = 26
+_TIME_LENGTH = 10
+_RANDOM_BITS = 80
+
+# Id de un sticker: timestamp en segundos (formato antiguo) o ULID
+STICKER_ID_PATTERN = r'(?:\d+|[0-9A-HJKMNP-TV-Z]{26})'
+_FILENAME_PATTERN = re.compile(r'^sticker_([A-Za-z0-9-]+)_(' + STICKER_ID_PATTERN + r')(_high)?\.[A-Za-z0-9]+$')
+_ULID_PATTERN = re.compile(r'^[0-9A-HJKMNP-TV-Z]{26}$')
+
+_lock = threading.Lock()
+_last_ms = -1
+_last_random = 0
+
+
+def _encode(value, length):
+    chars = []
+    for _ in range(length):
+        chars.append(CROCKFORD_ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def _decode(text):
+    value = 0
+    for char in text:
+        value = (value << 5) | CROCKFORD_ALPHABET.index(char)
+    return value
+
+
+def new_sticker_id(now_ms=None):
+    """
+    New ULID, strictly greater than any previous one generated by this process
+    """
+    global _last_ms, _last_random
+
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+    with _lock:
+        if now_ms <= _last_ms:
+            # Mismo milisegundo (o reloj hacia atrás): incrementar la parte aleatoria
+            now_ms = _last_ms
+            _last_random += 1
+            if _last_random >= 1 << _RANDOM_BITS:
+                now_ms += 1
+                _last_random = int.from_bytes(os.urandom(10), 'big') >> 1
+        else:
+            # El bit alto a 0 deja margen para incrementos sin desbordar
+            _last_random = int.from_bytes(os.urandom(10), 'big') >> 1
+        _last_ms = now_ms
+        return _encode(now_ms, _TIME_LENGTH) + _encode(_last_random, ULID_LENGTH - _TIME_LENGTH)
+
+
+def ulid_time_prefix(timestamp_ms):
+    """
+    First 10 chars of any ULID created at timestamp_ms: sorts before all of them
+    """
+    return _encode(timestamp_ms, _TIME_LENGTH)
+
+
+def is_ulid(sticker_id):
+    return bool(sticker_id) and bool(_ULID_PATTERN.match(sticker_id))
+
+
+def sticker_filename(owner, sticker_id=None, ext='.png'):
+    """
+    Filename for a new sticker: sticker_{owner}_{ulid}.png
+    """
+    return f"sticker_{owner}_{sticker_id or new_sticker_id()}{ext}"
+
+
+def parse_sticker_filename(filename):
+    """
+    Returns (owner, sticker_id, is_high) for a sticker filename or key, or None
+    """
+    match = _FILENAME_PATTERN.match(os.path.basename(filename))
+    if not match:
+        return None
+    return match.group(1), match.group(2), bool(match.group(3))
+
+
+def id_timestamp_ms(sticker_id):
+    """
+    Creation time in milliseconds encoded in a sticker id (ULID or legacy seconds)
+    """
+    if is_ulid(sticker_id):
+        return _decode(sticker_id[:_TIME_LENGTH])
+    return int(sticker_id) * 1000
+
+
+def sticker_sort_key(filename):
+    """
+    Sort key for sticker filenames in creation order (legacy ids before ULIDs).
+    Use with reverse=True for newest first.
+    """
+    parsed = parse_sticker_filename(filename)
+    if not parsed:
+        return (0, 0, os.path.basename(filename))
+    _, sticker_id, is_high = parsed
+    return (1, id_timestamp_ms(sticker_id), sticker_id, is_high)
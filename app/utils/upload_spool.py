@@ -0,0 +1,395 @@
+import os
+import json
+import time
+import queue
+import hashlib
+import tempfile
+import threading
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows (desarrollo local): sin bloqueo entre procesos
+    fcntl = None
+
+from config import (
+    AWS_S3_BUCKET_NAME, UPLOAD_SPOOL_ENABLED, UPLOAD_SPOOL_DIR, UPLOAD_SPOOL_WORKERS,
+    UPLOAD_SPOOL_RETRY_BASE_DELAY, UPLOAD_SPOOL_MAX_RETRY_DELAY, UPLOAD_SPOOL_SCAN_INTERVAL
+)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Write-behind spool for generated stickers: /generate returns as soon as the
+# images are on local disk and they are uploaded to S3 in the background.
+# - Each entry is a '.data' file plus a '.job' JSON file, both written
+#   atomically (temp file + os.replace). The job is written last, so a job on
+#   disk always has its data.
+# - Upload threads take jobs from an in-memory queue and retry failures with
+#   exponential backoff (capped at UPLOAD_SPOOL_MAX_RETRY_DELAY).
+# - Every UPLOAD_SPOOL_SCAN_INTERVAL seconds the spool directory is rescanned,
+#   so jobs left by a crashed or restarted process are picked up again. A flock
+#   on the job file keeps two workers from uploading the same entry.
+# - Until the upload completes, /img/ serves the spooled file (see get()).
+# - A job can carry sticker references (see utils/content_store.py): they are
+#   written right after the content object, and a '.ref' marker per reference
+#   lets get() serve the content through the sticker key meanwhile.
+
+_DATA_SUFFIX = '.data'
+_JOB_SUFFIX = '.job'
+_REF_SUFFIX = '.ref'
+_TMP_PREFIX = '.tmp-'
+
+_queue = queue.Queue()
+_client_factory = None
+_workers = []
+_state_lock = threading.Lock()
+_last_scan = 0.0
+_stats = {
+    'spooled': 0,
+    'uploaded': 0,
+    'failures': 0,
+    'recovered': 0
+}
+
+
+def _paths(key):
+    digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    base = os.path.join(UPLOAD_SPOOL_DIR, digest)
+    return f"{base}{_DATA_SUFFIX}", f"{base}{_JOB_SUFFIX}"
+
+
+def _ref_path(ref_key):
+    digest = hashlib.sha256(ref_key.encode('utf-8')).hexdigest()
+    return os.path.join(UPLOAD_SPOOL_DIR, f"{digest}{_REF_SUFFIX}")
+
+
+def _read_ref(ref_key):
+    try:
+        with open(_ref_path(ref_key), 'r') as ref_file:
+            return ref_file.read().strip() or None
+    except OSError:
+        return None
+
+
+def _record(stat, amount=1):
+    with _state_lock:
+        _stats[stat] += amount
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=UPLOAD_SPOOL_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def is_running():
+    return UPLOAD_SPOOL_ENABLED and _client_factory is not None
+
+
+def spool(key, data, content_type='image/png', bucket=None, refs=None, cache_control=None):
+    """
+    Persist an object to the local spool and queue it for upload.
+
+    Args:
+        key (str): Destination S3 key
+        data (bytes): Object contents
+        content_type (str): MIME type of the object
+        bucket (str, optional): Bucket name (defaults to AWS_S3_BUCKET_NAME)
+        refs (list, optional): Sticker keys to point at this object once uploaded
+        cache_control (str, optional): Cache-Control stored with the object
+
+    Returns:
+        bool: True if spooled, False if the spool isn't running (upload synchronously instead)
+    """
+    if not is_running():
+        return False
+
+    data_path, job_path = _paths(key)
+    job = {
+        'key': key,
+        'bucket': bucket or AWS_S3_BUCKET_NAME,
+        'content_type': content_type,
+        'etag': f'"{hashlib.md5(data).hexdigest()}"',
+        'created_at': int(time.time()),
+        'attempts': 0,
+        'next_attempt_at': 0,
+        'refs': list(refs or []),
+        'cache_control': cache_control
+    }
+    try:
+        os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+        _write_atomic(data_path, data)
+        for ref_key in job['refs']:
+            _write_atomic(_ref_path(ref_key), key.encode('utf-8'))
+        _write_atomic(job_path, json.dumps(job).encode('utf-8'))
+    except OSError as e:
+        logger.error(f"Error spooling {key}: {e}")
+        return False
+
+    _record('spooled')
+    _queue.put(job_path)
+    return True
+
+
+def add_ref(content_key, ref_key):
+    """
+    Attach a sticker reference to a content object that is still spooled.
+
+    Returns:
+        bool: True if attached, False if the content isn't pending (write the reference directly)
+
+    Raises:
+        OSError: If the spool can't be written; nothing is left attached
+    """
+    if not UPLOAD_SPOOL_ENABLED:
+        return False
+
+    job_path = _paths(content_key)[1]
+    try:
+        lock_file = open(job_path, 'r')
+    except FileNotFoundError:
+        return False
+
+    with lock_file:
+        if fcntl:
+            # Bloqueante: si un worker la está subiendo, esperar a que termine
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        job = _read_job(job_path)
+        if not job:
+            return False
+        _write_atomic(_ref_path(ref_key), content_key.encode('utf-8'))
+        job['refs'] = job.get('refs', []) + [ref_key]
+        try:
+            _write_atomic(job_path, json.dumps(job).encode('utf-8'))
+        except OSError:
+            # Sin el job actualizado nadie escribiría la referencia: quitar el marcador
+            os.remove(_ref_path(ref_key))
+            raise
+    return True
+
+
+def contains(key):
+    """
+    True if the key (or the sticker reference key) is still waiting in the spool
+    """
+    if not UPLOAD_SPOOL_ENABLED:
+        return False
+    return os.path.exists(_paths(key)[1]) or os.path.exists(_ref_path(key))
+
+
+def get(key):
+    """
+    Open a spooled object that hasn't been uploaded yet.
+
+    Returns:
+        tuple: (file or None, dict metadata) - metadata has 'etag', 'last_modified', 'size' and 'content_type'
+    """
+    if not UPLOAD_SPOOL_ENABLED:
+        return None, None
+
+    data_path, job_path = _paths(key)
+    job = _read_job(job_path)
+    if not job:
+        # Referencia pendiente: servir el contenido al que apunta
+        content_key = _read_ref(key)
+        return get(content_key) if content_key and content_key != key else (None, None)
+    try:
+        file_obj = open(data_path, 'rb')
+    except OSError:
+        return None, None
+
+    metadata = {
+        'etag': job.get('etag'),
+        'last_modified': job.get('created_at'),
+        'size': os.fstat(file_obj.fileno()).st_size,
+        'content_type': job.get('content_type')
+    }
+    return file_obj, metadata
+
+
+def _read_job(job_path):
+    try:
+        with open(job_path, 'r') as job_file:
+            return json.load(job_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _upload(job_path):
+    """
+    Try to upload one job. Returns True when the job is finished (uploaded or gone).
+    """
+    from utils import s3_filename_index
+    from utils.content_store import put_ref, mark_known
+
+    data_path = job_path[:-len(_JOB_SUFFIX)] + _DATA_SUFFIX
+    try:
+        lock_file = open(job_path, 'r')
+    except FileNotFoundError:
+        return True
+
+    with lock_file:
+        if fcntl:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Otro worker está subiendo esta entrada
+                return True
+
+        job = _read_job(job_path)
+        if not job or not os.path.exists(job_path):
+            return True
+        if job.get('next_attempt_at', 0) > time.time():
+            return False
+
+        try:
+            s3_client = _client_factory()
+            params = {
+                'Bucket': job['bucket'],
+                'Key': job['key'],
+                'ContentType': job['content_type']
+            }
+            if job.get('cache_control'):
+                params['CacheControl'] = job['cache_control']
+            with open(data_path, 'rb') as data_file:
+                s3_client.put_object(Body=data_file, **params)
+            # Las referencias se escriben después del contenido al que apuntan
+            for ref_key in job.get('refs', []):
+                put_ref(s3_client, job['bucket'], ref_key, job['key'], job['content_type'])
+        except FileNotFoundError:
+            logger.error(f"Spooled data for {job['key']} is missing, dropping job")
+            os.remove(job_path)
+            return True
+        except Exception as e:
+            job['attempts'] = job.get('attempts', 0) + 1
+            delay = min(UPLOAD_SPOOL_RETRY_BASE_DELAY * (2 ** (job['attempts'] - 1)), UPLOAD_SPOOL_MAX_RETRY_DELAY)
+            job['next_attempt_at'] = time.time() + delay
+            _write_atomic(job_path, json.dumps(job).encode('utf-8'))
+            _record('failures')
+            logger.error(f"Error uploading spooled {job['key']} (attempt {job['attempts']}, retry in {delay:.0f}s): {e}")
+            return False
+
+        s3_filename_index.add_key(job['key'])
+        mark_known(job['key'])
+        for ref_key in job.get('refs', []):
+            s3_filename_index.add_key(ref_key)
+            if os.path.exists(_ref_path(ref_key)):
+                os.remove(_ref_path(ref_key))
+        # Primero el job: sin job la entrada deja de servirse desde el spool
+        os.remove(job_path)
+        os.remove(data_path)
+
+    _record('uploaded')
+    logger.info(f"Uploaded spooled object {job['key']}")
+    return True
+
+
+def _scan():
+    """
+    Queue every pending job on disk and remove stale temp/orphan files
+    """
+    if not os.path.isdir(UPLOAD_SPOOL_DIR):
+        return 0
+
+    found = 0
+    now = time.time()
+    for entry in os.scandir(UPLOAD_SPOOL_DIR):
+        if entry.name.endswith(_JOB_SUFFIX):
+            _queue.put(entry.path)
+            found += 1
+        elif entry.name.endswith(_REF_SUFFIX):
+            # Referencia cuyo contenido ya no está pendiente (p.ej. un crash tras subirlo)
+            try:
+                with open(entry.path, 'r') as ref_file:
+                    content_key = ref_file.read().strip()
+                if not os.path.exists(_paths(content_key)[1]) and now - entry.stat().st_mtime > 3600:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+        elif entry.name.startswith(_TMP_PREFIX) or entry.name.endswith(_DATA_SUFFIX):
+            # Datos sin job: escritura interrumpida antes de confirmar el job
+            job_path = entry.path[:-len(_DATA_SUFFIX)] + _JOB_SUFFIX
+            if entry.name.startswith(_TMP_PREFIX) or not os.path.exists(job_path):
+                try:
+                    if now - entry.stat().st_mtime > 3600:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+    return found
+
+
+def _scan_due():
+    """
+    True for exactly one worker once every UPLOAD_SPOOL_SCAN_INTERVAL seconds
+    """
+    global _last_scan
+    with _state_lock:
+        if time.time() - _last_scan < UPLOAD_SPOOL_SCAN_INTERVAL:
+            return False
+        _last_scan = time.time()
+        return True
+
+
+def _worker_loop():
+    while True:
+        try:
+            job_path = _queue.get(timeout=UPLOAD_SPOOL_SCAN_INTERVAL)
+        except queue.Empty:
+            job_path = None
+
+        if job_path:
+            try:
+                _upload(job_path)
+            except Exception as e:
+                logger.error(f"Unexpected error processing spool job {job_path}: {e}")
+            finally:
+                _queue.task_done()
+
+        # Los jobs que aún esperan su reintento se recogen en el próximo escaneo
+        if _scan_due():
+            _scan()
+
+
+def start(client_factory):
+    """
+    Start the upload threads and recover jobs left on disk (once per process)
+
+    Args:
+        client_factory (callable): Returns a boto3 S3 client
+    """
+    global _client_factory, _last_scan
+
+    if not UPLOAD_SPOOL_ENABLED or _client_factory is not None:
+        return
+    _client_factory = client_factory
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+
+    recovered = _scan()
+    _last_scan = time.time()
+    if recovered:
+        _record('recovered', recovered)
+        logger.info(f"Recovered {recovered} pending uploads from {UPLOAD_SPOOL_DIR}")
+
+    for i in range(UPLOAD_SPOOL_WORKERS):
+        worker = threading.Thread(target=_worker_loop, name=f'upload-spool-{i}', daemon=True)
+        worker.start()
+        _workers.append(worker)
+
+
+def get_spool_stats():
+    with _state_lock:
+        stats = dict(_stats)
+    stats['enabled'] = UPLOAD_SPOOL_ENABLED
+    stats['running'] = is_running()
+    stats['queued'] = _queue.qsize()
+    stats['pid'] = os.getpid()
+    return stats
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+from decimal import Decimal
+
+from config import USER_CACHE_BACKEND, USER_CACHE_TTL, USER_CACHE_MAX_ENTRIES, USER_CACHE_PATH
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Short-TTL read-through cache of user items for balance/profile reads
+# (/, /get-coins, /api/coins/balance, /api/auth/me), which the front end polls.
+# - Backends (USER_CACHE_BACKEND):
+#   'memory': LRU per process. A write in another worker (e.g. the payment
+#             webhook) is only seen after USER_CACHE_TTL.
+#   'sqlite': file shared by all workers on the machine, so write-through
+#             from any worker is seen by all of them.
+#   'none':   disabled.
+# - Writes go through: dynamodb_utils stores the new item after writes that
+#   return it and invalidates after writes that don't.
+# - PIN fields are never cached.
+# - Cache errors are logged and treated as misses; DynamoDB stays the source.
+
+_EXCLUDED_FIELDS = ('login_pin', 'pin_expiry')
+
+
+def _json_number(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Cannot cache value of type {type(value).__name__}")
+
+
+def _encode(user):
+    item = {k: v for k, v in user.items() if k not in _EXCLUDED_FIELDS}
+    # Los números de DynamoDB son Decimal; al leer todos vuelven como Decimal
+    return json.dumps(item, default=_json_number)
+
+
+def _decode(data):
+    return json.loads(data, parse_float=Decimal, parse_int=Decimal)
+
+
+class _MemoryBackend:
+    def __init__(self, max_entries):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return data
+
+    def set(self, user_id, data, ttl):
+        with self._lock:
+            self._entries[user_id] = (data, time.time() + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+class _SQLiteBackend:
+    # Purga de entradas caducadas cada N escrituras
+    _PURGE_EVERY = 500
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+
+    def _connection(self):
+        # Una conexión por hilo; WAL permite leer mientras otro worker escribe
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=1)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, user_id):
+        row = self._connection().execute(
+            'SELECT data FROM users WHERE user_id = ? AND expires_at > ?', (user_id, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, user_id, data, ttl):
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO users (user_id, data, expires_at) VALUES (?, ?, ?)',
+                (user_id, data, now + ttl)
+            )
+            self._writes += 1
+            if self._writes % self._PURGE_EVERY == 0:
+                connection.execute('DELETE FROM users WHERE expires_at <= ?', (now,))
+
+    def delete(self, user_id):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+
+
+_backend_lock = threading.Lock()
+_backend = None
+
+
+def _get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if USER_CACHE_BACKEND == 'sqlite':
+                    _backend = _SQLiteBackend(USER_CACHE_PATH)
+                elif USER_CACHE_BACKEND == 'memory':
+                    _backend = _MemoryBackend(USER_CACHE_MAX_ENTRIES)
+                else:
+                    _backend = False
+    return _backend
+
+
+def get(user_id):
+    """
+    Cached user item, or None on a miss or if it expired
+    """
+    backend = _get_backend()
+    if not backend or not user_id:
+        return None
+    try:
+        data = backend.get(user_id)
+        return _decode(data) if data is not None else None
+    except Exception as e:
+        logger.warning(f"User cache read failed for {user_id}: {e}")
+        return None
+
+
+def put(user):
+    """
+    Store a user item read from or written to DynamoDB
+    """
+    backend = _get_backend()
+    if not backend or not user or not user.get('user_id'):
+        return
+    try:
+        backend.set(user['user_id'], _encode(user), USER_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"User cache write failed for {user.get('user_id')}: {e}")
+
+
+def invalidate(user_id):
+    """
+    Drop a user after a write whose result isn't known
+    """
+    backend = _get_backend()
+    if not backend or not user_id:
+        return
+    try:
+        backend.delete(user_id)
+    except Exception as e:
+        logger.warning(f"User cache invalidation failed for {user_id}: {e}")
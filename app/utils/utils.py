@@ -8,7 +8,7 @@ import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
-from utils.s3_utils import upload_file_to_s3, upload_bytes_to_s3, S3_STICKERS_FOLDER, S3_TEMPLATES_FOLDER
+from utils.s3_utils import upload_file_to_s3, store_sticker_bytes, S3_TEMPLATES_FOLDER
 from datetime import datetime
 from decimal import Decimal
 
@@ -21,6 +21,9 @@ def save_image(result, img_path):
     1. Original high resolution (1024x1024)
     2. Compressed low resolution (250x250)
     
+    Uploads are write-behind: both versions are stored in the local upload
+    spool and sent to S3 in the background (see utils/upload_spool.py).
+    
     Args:
         result: The image generation result with b64_json data
         img_path: Path used only for filename reference, file not saved locally
@@ -44,11 +47,10 @@ def save_image(result, img_path):
     original_image.save(high_res_buffered, format="PNG")
     high_res_buffered.seek(0)
     
-    success_high, result_high = upload_bytes_to_s3(
+    success_high, result_high = store_sticker_bytes(
         high_res_buffered, 
         high_res_filename, 
-        content_type='image/png',
-        folder=S3_STICKERS_FOLDER
+        content_type='image/png'
     )
     
     if success_high:
@@ -68,11 +70,10 @@ def save_image(result, img_path):
     low_res_buffered.seek(0)
 
     # Upload compressed version to S3
-    success, result = upload_bytes_to_s3(
+    success, result = store_sticker_bytes(
         low_res_buffered, 
         filename, 
-        content_type='image/png',
-        folder=S3_STICKERS_FOLDER
+        content_type='image/png'
     )
     
     if success:
@@ -134,11 +135,10 @@ def create_placeholder_image(img_path, use_s3=True):
     high_res_img.save(high_res_buffered, format="PNG")
     high_res_buffered.seek(0)
     
-    success_high, result_high = upload_bytes_to_s3(
+    success_high, result_high = store_sticker_bytes(
         high_res_buffered,
         high_res_filename,
-        content_type='image/png',
-        folder=S3_STICKERS_FOLDER
+        content_type='image/png'
     )
     
     if success_high:
@@ -157,11 +157,10 @@ def create_placeholder_image(img_path, use_s3=True):
     
     # Upload low resolution to S3
     low_res_buffered.seek(0)  # Reset buffer position
-    success, result = upload_bytes_to_s3(
+    success, result = store_sticker_bytes(
         low_res_buffered,
         filename,
-        content_type='image/png',
-        folder=S3_STICKERS_FOLDER
+        content_type='image/png'
     )
     
     if success: